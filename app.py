@@ -3,39 +3,137 @@ Paras Institute WhatsApp Bot (Cloud API) — BOT + ADMIN + CHAT LOG
 -----------------------------------------------------------------
 - Flow:
   • Know about our Institute  (list: Social/Features/Results/Contacts)
-  • CA Coaching (course -> attempt -> group (if needed) -> mode -> features -> thanks)
+  • CA Coaching (course -> attempt -> group (if needed) -> mode -> features -> documents -> thanks)
 
 - Admin:
   • /admin (login) : recent conversations list + pause/resume
-  • /admin/chat/<wa_id> : full chat transcript + reply box
+  • /admin/chat/<wa_id> : latest transcript page + reply box; older pages load on scroll
+  • /admin/api/chat/<wa_id>/messages?before_ts=&before_id= : keyset-paged transcript (JSON)
+  • /admin/stream?after=<id>[&wa_id=] : SSE feed of new messages, conversation
+    changes and pause flips; both admin pages update live from it. Each open tab
+    holds a worker thread, so run gunicorn with threads (-k gthread); at most
+    SSE_MAX_STREAMS per worker, further tabs are told to retry later.
+  • /admin/search?q= : full-text search over every message (FTS5, ranked + highlighted)
+  • /admin/leads.csv?from=&to=&course= : streamed CSV export of leads
+  • /admin/analytics : COACH funnel (started → course → attempt → mode → lead) with drop-off,
+    per day / last 48h / per course, leads by attempt, group and mode. Reads only the
+    funnel_hourly/funnel_daily rollups, which a trigger updates as each transition lands
+    in 'funnel_events' (written by set_state/clear_state).
+  • /admin/delivery : sent/delivered/read/failed rates and delivery/read latency per day,
+    from status callbacks (table 'statuses', rolled up by trigger into status_rollup/status_latency)
+  • /admin/stats/outbound : send queue depth, latency, outbox/breaker state + Graph client counters (JSON)
+  • /admin/broadcasts : bulk send (template or text) to leads filtered by course/attempt/mode,
+    with live progress, pause/resume/cancel and retry-failed. Sent at BROADCAST_MPS by one
+    worker at a time (lease); a restart resumes without sending anyone the same job twice.
+
+- Sending:
+  • Replies are first written to 'outbox' (and to messages, delivery='queued') in one
+    transaction, one per handled webhook; OUTBOUND lane threads then call Graph. One lane
+    per wa_id (hashed) keeps each user's messages in order, and a reply waits behind an
+    earlier one that is pending a retry, whichever worker queued it. Failed sends are retried with backoff by the outbox
+    poller until OUTBOX_MAX_ATTEMPTS / OUTBOX_MAX_AGE_SEC; rows a crashed worker had
+    claimed are sent again after a restart. The transcript shows each reply's state
+    (queued → retrying → sent → delivered → read, or failed).
+  • BREAKER: after BREAKER_FAILURES consecutive outages (timeouts, 5xx) sends stop for
+    BREAKER_COOLDOWN_SEC and rows are pushed back instead of each waiting out a timeout.
+  • GraphClient: keep-alive sessions, token buckets (per number + per recipient),
+    429/Retry-After aware jittered backoff. GRAPH_BASE_URL points it at a stand-in.
+  • send_document / send_image: files in MEDIA_DIR (the course "documents" in content.json:
+    brochure, fees, timetable) are uploaded to Graph /media once and sent by media id.
+    MEDIA keeps id + sha256 + expiry in 'media_cache'; a changed file or an id older than
+    MEDIA_TTL_SEC is uploaded again. Workers warm it at start, so leads never wait on an upload.
+  • serve_async.py (optional, aiohttp): same routes in one asyncio process; sends
+    become coroutines (ASYNC_SENDS in flight), SQLite work stays on executor threads.
+
+- Numbers:
+  • One deployment can serve several WhatsApp numbers. PHONE_NUMBER_ID is the primary;
+    NUMBERS_FILE (numbers.json) adds more, each with its own label, content file, token,
+    MPS, send lanes and media dir (see load_lines). Webhooks are routed by
+    metadata.phone_number_id; unknown numbers are ignored (webhook_unknown_number_total).
+  • Each number (LINES) has its own GraphClient token bucket and OUTBOUND lanes, so one
+    busy number cannot starve the others. The circuit breaker stays shared.
+  • Conversations, messages, flow state, pauses, leads, funnel/delivery rollups and
+    broadcasts are keyed by (phone_number_id, wa_id); admin pages take ?number=.
+
+- Running:
+  • gunicorn -c gunicorn.conf.py : preloaded create_app() factory. Import + create_app()
+    (env check, migrations) run once in the master; init_worker() after each fork starts
+    that worker's threads and connections; shutdown_worker() drains them on exit.
+  • python app.py / serve_async.py call the same hooks themselves.
+
+- Metrics:
+  • /metrics : Prometheus text format (webhook/Graph/DB latency histograms, per type/
+    stage/button counters), summed across gunicorn workers via METRICS_DIR snapshots.
 
 - Storage:
-  • leads.csv (same as before)
-  • chat.db (SQLite) — table 'messages' to log inbound/outbound
+  • overrides.json — pause flags per number; cached in PAUSES, re-checked every PAUSE_RECHECK_SEC
+  • 'flow_state' — per-user flow state with TTL, shared by workers (STATE_BACKEND=sqlite)
+  • 'seen_messages' — handled WhatsApp message ids, so webhook retries are no-ops
+  • 'leads' — one row per (number, wa_id, course, attempt, mode), upserted; /admin/leads.csv
+    streams them out. An existing leads.csv is imported once and then left alone.
+  • chat.db (SQLite, WAL) — table 'messages' to log inbound/outbound.
+    Rows go through WRITER, which group-commits them from one long-lived connection.
+  • 'conversations' — per-contact summary (last message, counts, paused) kept by trigger.
+    Schema changes live in MIGRATIONS, tracked with PRAGMA user_version.
+  • 'payloads' — zlib-compressed raw payloads keyed by sha1; outbound menus stored once.
+  • 'outbox' — replies not yet accepted by Graph (pending/sending with a lease, or failed).
+  • 'media_cache' — Graph media ids of uploaded files, by content hash, with expiry.
+  • archive/chat-YYYY-MM.db — old months moved out by `flask --app app archive --before YYYY-MM`;
+    opened read-only when a transcript pages past what chat.db holds.
 
 Notes:
 - Button titles ≤ 20 chars; ≤ 3 buttons
 - List row titles ≤ 24 chars
+- Content (menus, replies, course flow) lives in content.json. It is validated
+  and rendered once into an immutable Catalogue (menu payloads, reply texts,
+  button routes) and hot-swapped when the file changes — no restart needed.
 """
 
 import os
+import io
 import csv
 import json
+import time
+import zlib
+import glob
+import hashlib
+import queue
+import random
+import bisect
+import socket
+import atexit
 import sqlite3
+import threading
+import concurrent.futures
+from contextlib import contextmanager
+import tempfile
+import click
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
+from types import MappingProxyType
+from collections import OrderedDict
+from markupsafe import Markup, escape
 from flask import (
     Flask, request, session, redirect, url_for,
-    render_template_string, jsonify
+    render_template_string, jsonify, Response, stream_with_context
 )
 from dotenv import load_dotenv
+try:
+    import fcntl   # cross-process lock for overrides.json writes (POSIX only)
+except ImportError:
+    fcntl = None
+
+IMPORT_STARTED = time.perf_counter()
 
-# ----------------- Load env & fail fast -----------------
+# ----------------- Load env (checked by create_app) -----------------
 load_dotenv()
+MISSING_ENV: list[str] = []
+
 def env(name, required=True, default=None):
     v = os.getenv(name, default)
     if required and (not v or v == "None"):
-        raise SystemExit(f"[ENV] {name} is missing. Put it in your .env")
+        MISSING_ENV.append(name)
     return v
 
 VERIFY_TOKEN    = env("VERIFY_TOKEN")
@@ -43,29 +141,338 @@ WHATSAPP_TOKEN  = env("WHATSAPP_TOKEN")
 PHONE_NUMBER_ID = env("PHONE_NUMBER_ID")
 GRAPH_API_VER   = os.getenv("GRAPH_API_VERSION", "v22.0")
 DEBUG           = os.getenv("DEBUG", "0") == "1"
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", "8"))     # parallel send lanes per process
+ADMIN_SEND_WAIT  = float(os.getenv("ADMIN_SEND_WAIT", "10"))   # admin reply waits this long before re-rendering
+INBOUND_WORKERS  = int(os.getenv("INBOUND_WORKERS", "8"))      # users handled in parallel per webhook batch
+
+# Graph client: base URL is overridable so a local stand-in server can be used
+GRAPH_BASE_URL   = os.getenv("GRAPH_BASE_URL", "https://graph.facebook.com").rstrip("/")
+GRAPH_TIMEOUT    = float(os.getenv("GRAPH_TIMEOUT", "10"))      # read timeout; failed sends are retried by the outbox
+GRAPH_CONNECT_TIMEOUT = float(os.getenv("GRAPH_CONNECT_TIMEOUT", "3"))
+GRAPH_MPS        = float(os.getenv("GRAPH_MPS", "80"))         # per phone number throughput (msgs/sec)
+GRAPH_PAIR_RATE  = float(os.getenv("GRAPH_PAIR_RATE", "0.17")) # per recipient refill (msgs/sec, ~1 per 6s)
+GRAPH_PAIR_BURST = float(os.getenv("GRAPH_PAIR_BURST", "10"))  # per recipient burst allowance
+GRAPH_MAX_RETRIES = int(os.getenv("GRAPH_MAX_RETRIES", "4"))
+
+# Message log writer: rows are buffered and committed in batches
+LOG_BATCH_SIZE   = int(os.getenv("LOG_BATCH_SIZE", "200"))
+LOG_FLUSH_MS     = int(os.getenv("LOG_FLUSH_MS", "200"))
+TRANSCRIPT_PAGE  = int(os.getenv("TRANSCRIPT_PAGE", "50"))     # messages per /admin/chat page
+PAUSE_RECHECK_SEC = float(os.getenv("PAUSE_RECHECK_SEC", "1")) # max delay for pause toggles to reach other workers
+SSE_POLL_SEC     = float(os.getenv("SSE_POLL_SEC", "1"))       # /admin/stream checks for new rows this often
+SSE_MAX_SEC      = float(os.getenv("SSE_MAX_SEC", "300"))      # streams end after this; the browser reconnects
+SSE_MAX_STREAMS  = int(os.getenv("SSE_MAX_STREAMS", "4"))      # open streams per worker; keep below gunicorn THREADS
+SSE_BUSY_RETRY_SEC = float(os.getenv("SSE_BUSY_RETRY_SEC", "15"))  # a tab turned away reconnects after ~this
+
+# Conversation state (course -> attempt -> group -> mode)
+STATE_BACKEND    = os.getenv("STATE_BACKEND", "sqlite")        # 'sqlite' (shared by workers) | 'memory'
+STATE_TTL_SEC    = float(os.getenv("STATE_TTL_SEC", "86400"))  # abandoned flows expire after this
+STATE_CACHE_SIZE = int(os.getenv("STATE_CACHE_SIZE", "2048"))  # in-process LRU front cache entries
+STATE_SWEEP_SEC  = float(os.getenv("STATE_SWEEP_SEC", "300"))
+
+# Webhook retries: message ids seen within DEDUP_TTL_SEC are skipped
+DEDUP_CACHE_SIZE = int(os.getenv("DEDUP_CACHE_SIZE", "20000"))
+DEDUP_TTL_SEC    = float(os.getenv("DEDUP_TTL_SEC", "172800"))  # Meta retries for up to ~36h
 
 ADMIN_USER      = env("ADMIN_USER")
 ADMIN_PASS      = env("ADMIN_PASS")
 SECRET_KEY      = env("SECRET_KEY")
 
-GRAPH_URL = f"https://graph.facebook.com/{GRAPH_API_VER}/{PHONE_NUMBER_ID}/messages"
+GRAPH_URL = f"{GRAPH_BASE_URL}/{GRAPH_API_VER}/{PHONE_NUMBER_ID}/messages"
+PHONE_NUMBER_LABEL = os.getenv("PHONE_NUMBER_LABEL", "")   # name of PHONE_NUMBER_ID in the admin panel
+NUMBERS_FILE = os.getenv("NUMBERS_FILE", "numbers.json")   # optional: further numbers served by this deployment
 LEADS_CSV = "leads.csv"
 DB_FILE = "chat.db"
-OVERRIDES_JSON = "overrides.json"   # {"paused": {"<wa_id>": true/false}}
+OVERRIDES_JSON = "overrides.json"   # {"paused": {"<phone_number_id>": {"<wa_id>": true/false}}}
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "archive")   # chat-YYYY-MM.db files moved out of chat.db
+CONTENT_FILE = os.getenv("CONTENT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "content.json"))
+CONTENT_RECHECK_SEC = float(os.getenv("CONTENT_RECHECK_SEC", "2"))
+METRICS_DIR = os.getenv("METRICS_DIR", "metrics")    # one snapshot file per worker, merged by /metrics
+METRICS_FLUSH_SEC = float(os.getenv("METRICS_FLUSH_SEC", "5"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")            # optional: require "Authorization: Bearer <token>"
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "8"))  # broadcast sends in flight
+BROADCAST_MPS    = float(os.getenv("BROADCAST_MPS", "20"))     # leaves the rest of GRAPH_MPS for live chats
+BROADCAST_LEASE_SEC = float(os.getenv("BROADCAST_LEASE_SEC", "30"))   # a dead worker's job is picked up after this
+BROADCAST_POLL_SEC = float(os.getenv("BROADCAST_POLL_SEC", "2"))
+OUTBOX_INLINE_RETRIES = int(os.getenv("OUTBOX_INLINE_RETRIES", "1"))  # quick retries inside one attempt
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "10"))
+OUTBOX_MAX_AGE_SEC = float(os.getenv("OUTBOX_MAX_AGE_SEC", "21600"))  # a reply older than this is given up on
+OUTBOX_BACKOFF_CAP = float(os.getenv("OUTBOX_BACKOFF_CAP", "300"))
+OUTBOX_LEASE_SEC = float(os.getenv("OUTBOX_LEASE_SEC", "60"))     # claimed rows of a dead worker are resent after this
+OUTBOX_POLL_SEC  = float(os.getenv("OUTBOX_POLL_SEC", "1"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))        # consecutive Graph outages that open the circuit
+BREAKER_COOLDOWN_SEC = float(os.getenv("BREAKER_COOLDOWN_SEC", "30"))
+MEDIA_DIR = os.getenv("MEDIA_DIR", "media")          # brochures/images named in content.json live here
+MEDIA_TTL_SEC = float(os.getenv("MEDIA_TTL_SEC", str(29 * 86400)))  # Graph keeps uploads 30 days; re-upload a day early
 
 app = Flask(__name__)
 app.secret_key = SECRET_KEY
 
-print("GRAPH_URL ->", GRAPH_URL)
+# ----------------- Metrics (Prometheus text format) -----------------
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+METRIC_HELP = {
+    "webhook_seconds":     ("histogram", "Time spent in inbound() per webhook delivery"),
+    "graph_send_seconds":  ("histogram", "Graph /messages round trip incl. retries, by HTTP status"),
+    "db_write_seconds":    ("histogram", "Enqueue-to-commit latency of buffered writes, by kind"),
+    "db_commit_seconds":   ("histogram", "Duration of one group-commit transaction"),
+    "lookup_seconds":      ("histogram", "Pause / state / dedup lookups on the message path"),
+    "messages_in_total":   ("counter",   "Inbound messages by WhatsApp type"),
+    "flow_stage_total":    ("counter",   "Flow stage entries (KNOW, COURSE, ATTEMPT, GROUP, MODE, LEAD)"),
+    "button_taps_total":   ("counter",   "Button and list-row choices by id"),
+    "outbound_queue_depth": ("gauge",    "Send jobs waiting in the outbound lanes"),
+    "outbound_sent_total": ("counter",   "Outbound send attempts by result (sent, retry, failed, deferred)"),
+    "broadcast_sent_total": ("counter",  "Broadcast sends by result"),
+    "outbox_backlog":      ("gauge",     "Outbox rows waiting for (re)delivery"),
+    "startup_import_seconds": ("gauge",  "Time to import app.py (config + content) in the process that forked the workers"),
+    "startup_create_app_seconds": ("gauge", "Time spent in create_app() (env check, migrations)"),
+    "worker_init_seconds": ("histogram", "Per-worker setup after fork (one sample per worker start)"),
+    "graph_circuit_open":  ("gauge",     "Workers whose Graph circuit breaker is open"),
+    "graph_upload_seconds": ("histogram", "Graph /media upload round trip incl. retries, by HTTP status"),
+    "media_lookups_total": ("counter",   "Media id lookups by result (hit, shared, upload, error)"),
+    "webhook_unknown_number_total": ("counter", "Webhook changes for a phone_number_id this deployment doesn't serve"),
+    "admin_streams_busy_total": ("counter", "/admin/stream requests turned away because SSE_MAX_STREAMS were open"),
+}
+
+class Metrics:
+    """
+    Counters and histograms kept in per-thread shards: recording is a plain
+    dict update on the calling thread's own shard, so the hot path never takes
+    a lock (the lock is only used when a thread records for the first time).
+    A flusher thread writes this process's merged snapshot to
+    METRICS_DIR/<pid>.json; /metrics sums every worker's file, so the numbers
+    are per deployment, not per gunicorn worker.
+    """
+    def __init__(self, directory: str, flush_sec: float):
+        self.directory = directory
+        self.flush_sec = flush_sec
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        self._gauges: dict[str, callable] = {}
+        self._shared: set[str] = set()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _shard(self) -> dict:
+        sh = getattr(self._local, "shard", None)
+        if sh is None or self._pid != os.getpid():
+            self._ensure_started()
+            sh = {"c": {}, "h": {}}
+            with self._lock:
+                self._shards.append(sh)
+            self._local.shard = sh
+        return sh
+
+    def inc(self, name: str, labels: tuple = (), n: float = 1):
+        c = self._shard()["c"]
+        key = (name, labels)
+        c[key] = c.get(key, 0) + n
+
+    def observe(self, name: str, seconds: float, labels: tuple = ()):
+        h = self._shard()["h"]
+        key = (name, labels)
+        v = h.get(key)
+        if v is None:
+            v = h[key] = [0] * (len(METRIC_BUCKETS) + 2)   # per-bucket counts, then sum, count
+        v[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        v[-2] += seconds
+        v[-1] += 1
+
+    def gauge(self, name: str, fn, shared: bool = False):
+        # evaluated at snapshot time; only live workers contribute. shared=True for values
+        # read from the database (same in every worker): taken from this process, not summed
+        self._gauges[name] = fn
+        if shared:
+            self._shared.add(name)
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._shards = []           # counts inherited over fork belong to the parent
+            self._pid = os.getpid()
+        threading.Thread(target=self._flusher, name="metrics-flush", daemon=True).start()
+
+    def snapshot(self) -> dict:
+        counters, hists = {}, {}
+        with self._lock:
+            shards = list(self._shards)
+        for sh in shards:
+            for key, n in list(sh["c"].items()):
+                counters[key] = counters.get(key, 0) + n
+            for key, v in list(sh["h"].items()):
+                acc = hists.setdefault(key, [0] * len(v))
+                for i, x in enumerate(v):
+                    acc[i] += x
+        gauges = {}
+        for name, fn in self._gauges.items():
+            try: gauges[name] = fn()
+            except Exception: pass
+        return {"pid": os.getpid(),
+                "counters": [[k[0], list(k[1]), n] for k, n in counters.items()],
+                "hists": [[k[0], list(k[1]), v] for k, v in hists.items()],
+                "gauges": gauges}
+
+    def write_snapshot(self):
+        if self._pid != os.getpid():
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp, path)
+
+    def _flusher(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flush_sec)
+            try:
+                self.write_snapshot()
+                self._retire_dead()
+            except OSError as e: print("Error writing metrics snapshot:", e)
+
+    def _retire_dead(self):
+        # Fold snapshots of exited workers into retired.json so recycled workers don't pile up files
+        dead = []
+        for path in glob.glob(os.path.join(self.directory, "[0-9]*.json")):
+            pid = int(os.path.basename(path).split(".")[0])
+            if not pid_alive(pid):
+                dead.append(path)
+        if not dead:
+            return
+        with open(os.path.join(self.directory, ".lock"), "a") as lock_f:
+            if fcntl: fcntl.flock(lock_f, fcntl.LOCK_EX)
+            retired_path = os.path.join(self.directory, "retired.json")
+            merged = {}
+            for path in [retired_path] + dead:
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        snap = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                for name, labels, n in snap["counters"]:
+                    key = ("c", name, tuple(tuple(x) for x in labels))
+                    merged[key] = merged.get(key, 0) + n
+                for name, labels, v in snap["hists"]:
+                    key = ("h", name, tuple(tuple(x) for x in labels))
+                    acc = merged.setdefault(key, [0] * len(v))
+                    for i, x in enumerate(v):
+                        acc[i] += x
+            retired = {"pid": None, "gauges": {},
+                       "counters": [[k[1], list(k[2]), v] for k, v in merged.items() if k[0] == "c"],
+                       "hists": [[k[1], list(k[2]), v] for k, v in merged.items() if k[0] == "h"]}
+            with open(retired_path + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(retired, f)
+            os.replace(retired_path + ".tmp", retired_path)
+            for path in dead:
+                try: os.remove(path)
+                except FileNotFoundError: pass
+            if fcntl: fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def collect(self) -> dict:
+        """All workers merged: this process live, the others from their last snapshot file."""
+        counters, hists, gauges = {}, {}, {}
+        snaps = [self.snapshot()]
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snap = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if snap.get("pid") == os.getpid():
+                continue
+            if not pid_alive(snap.get("pid")):
+                snap["gauges"] = {}      # a recycled worker's counts stay, its gauges don't
+            snaps.append(snap)
+        for snap in snaps:
+            for name, labels, n in snap["counters"]:
+                key = (name, tuple(tuple(x) for x in labels))
+                counters[key] = counters.get(key, 0) + n
+            for name, labels, v in snap["hists"]:
+                acc = hists.setdefault((name, tuple(tuple(x) for x in labels)), [0] * len(v))
+                for i, x in enumerate(v):
+                    acc[i] += x
+            for name, value in snap["gauges"].items():
+                if name in self._shared and snap is not snaps[0]:
+                    continue
+                gauges[name] = gauges.get(name, 0) + value
+        return {"counters": counters, "hists": hists, "gauges": gauges}
+
+    def render(self, prefix: str = "parasbot_") -> str:
+        data = self.collect()
+        by_name: dict[str, list[str]] = {}
+
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+        for (name, labels), n in sorted(data["counters"].items()):
+            by_name.setdefault(name, []).append(f"{prefix}{name}{fmt(labels)} {n}")
+        for (name, labels), v in sorted(data["hists"].items()):
+            lines, cum = by_name.setdefault(name, []), 0
+            for le, n in zip(METRIC_BUCKETS, v):
+                cum += n
+                lines.append(f"{prefix}{name}_bucket{fmt(labels, [('le', '+Inf' if le == float('inf') else le)])} {cum}")
+            lines.append(f"{prefix}{name}_sum{fmt(labels)} {v[-2]}")
+            lines.append(f"{prefix}{name}_count{fmt(labels)} {v[-1]}")
+        for name, value in sorted(data["gauges"].items()):
+            by_name.setdefault(name, []).append(f"{prefix}{name} {value}")
+        out = []
+        for name, lines in by_name.items():
+            kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+            out += [f"# HELP {prefix}{name} {help_text}", f"# TYPE {prefix}{name} {kind}"] + lines
+        return "\n".join(out) + "\n"
+
+def pid_alive(pid) -> bool:
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+METRICS = Metrics(METRICS_DIR, METRICS_FLUSH_SEC)
 
 # ----------------- DB init -----------------
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # readers never block the writer (and vice versa)
+    "PRAGMA synchronous=NORMAL",      # WAL + NORMAL: no fsync per commit, still crash-safe
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",       # ~16 MB page cache
+)
+
 def db():
-    conn = sqlite3.connect(DB_FILE)
+    conn = sqlite3.connect(DB_FILE, timeout=5)
     conn.row_factory = sqlite3.Row
     return conn
 
+_LOCAL_DB = threading.local()
+
+def local_db() -> sqlite3.Connection:
+    """Long-lived autocommit connection for the calling thread (hot-path point reads/writes)."""
+    conn = getattr(_LOCAL_DB, "conn", None)
+    if conn is None or getattr(_LOCAL_DB, "pid", None) != os.getpid():
+        conn = sqlite3.connect(DB_FILE, timeout=5, isolation_level=None)
+        for p in SQLITE_PRAGMAS:
+            conn.execute(p)
+        _LOCAL_DB.conn, _LOCAL_DB.pid = conn, os.getpid()
+    return conn
+
 def init_db():
-    with db() as conn:
+    conn = db()
+    try:
+        for p in SQLITE_PRAGMAS:
+            conn.execute(p)
         conn.execute("""
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -77,9 +484,572 @@ def init_db():
             payload TEXT                 -- JSON payload for debugging
         )
         """)
-init_db()
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for v, migrate in enumerate(MIGRATIONS, start=1):
+            if version < v:
+                migrate(conn)
+                conn.execute(f"PRAGMA user_version={v}")
+                conn.commit()
+        conn.commit()
+    finally:
+        conn.close()        # nothing opened here may survive into a forked worker
+
+def migrate_conversations(conn):
+    # One row per contact, maintained by a trigger on every messages insert,
+    # so /admin is a single indexed query instead of GROUP BY over the whole log.
+    conn.executescript("""
+    CREATE INDEX IF NOT EXISTS idx_messages_wa_ts ON messages(wa_id, ts, id);
+
+    CREATE TABLE IF NOT EXISTS conversations (
+        wa_id TEXT PRIMARY KEY,
+        last_ts TEXT NOT NULL,
+        last_preview TEXT,
+        msg_count INTEGER NOT NULL DEFAULT 0,
+        in_count INTEGER NOT NULL DEFAULT 0,
+        out_count INTEGER NOT NULL DEFAULT 0,
+        paused INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX IF NOT EXISTS idx_conversations_last_ts ON conversations(last_ts DESC);
+
+    CREATE TRIGGER IF NOT EXISTS trg_messages_conversations AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO conversations (wa_id, last_ts, last_preview, msg_count, in_count, out_count)
+        VALUES (NEW.wa_id, NEW.ts, substr(coalesce(NEW.text, ''), 1, 160), 1,
+                NEW.direction = 'in', NEW.direction = 'out')
+        ON CONFLICT(wa_id) DO UPDATE SET
+            last_preview = CASE WHEN excluded.last_ts >= conversations.last_ts
+                                THEN excluded.last_preview ELSE conversations.last_preview END,
+            last_ts   = max(conversations.last_ts, excluded.last_ts),
+            msg_count = conversations.msg_count + 1,
+            in_count  = conversations.in_count + excluded.in_count,
+            out_count = conversations.out_count + excluded.out_count;
+    END;
+    """)
+    # One-time backfill for chat.db files that predate the table
+    conn.execute("""
+        INSERT OR REPLACE INTO conversations (wa_id, last_ts, last_preview, msg_count, in_count, out_count)
+        SELECT m.wa_id, m.last_ts,
+               (SELECT substr(coalesce(text, ''), 1, 160) FROM messages
+                 WHERE wa_id = m.wa_id ORDER BY ts DESC, id DESC LIMIT 1),
+               m.n, m.n_in, m.n_out
+        FROM (SELECT wa_id, MAX(ts) AS last_ts, COUNT(*) AS n,
+                     SUM(direction = 'in') AS n_in, SUM(direction = 'out') AS n_out
+              FROM messages GROUP BY wa_id) AS m
+    """)
+    paused = [(w,) for w, flag in load_overrides().get("paused", {}).items() if flag]
+    conn.executemany("UPDATE conversations SET paused = 1 WHERE wa_id = ?", paused)
+
+# Applied in order; PRAGMA user_version records how many have run
+def migrate_flow_state(conn):
+    # Conversation state shared by all workers (see SQLiteStateStore)
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS flow_state (
+        wa_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,          -- JSON dict: stage, course, attempt, group
+        expires_at REAL NOT NULL     -- unix time
+    );
+    CREATE INDEX IF NOT EXISTS idx_flow_state_expires ON flow_state(expires_at);
+    """)
+
+def migrate_seen_messages(conn):
+    # WhatsApp message ids already handled (webhook retry dedup, see SeenMessages)
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS seen_messages (
+        msg_id TEXT PRIMARY KEY,
+        seen_at REAL NOT NULL
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_seen_messages_seen_at ON seen_messages(seen_at);
+    """)
+
+def migrate_leads(conn):
+    # Leads move from leads.csv into chat.db; one row per (wa_id, course, attempt, mode)
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS leads (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        wa_id TEXT NOT NULL,
+        course TEXT NOT NULL DEFAULT '',
+        attempt TEXT NOT NULL DEFAULT '',
+        grp TEXT NOT NULL DEFAULT '',
+        mode TEXT NOT NULL DEFAULT '',
+        flow TEXT,
+        name TEXT,
+        city TEXT,
+        profile_name TEXT,
+        created_at TEXT NOT NULL,    -- first enquiry (ISO)
+        updated_at TEXT NOT NULL,    -- latest enquiry (ISO)
+        enquiries INTEGER NOT NULL DEFAULT 1,
+        UNIQUE (wa_id, course, attempt, mode)
+    );
+    CREATE INDEX IF NOT EXISTS idx_leads_updated ON leads(updated_at);
+    CREATE INDEX IF NOT EXISTS idx_leads_course_updated ON leads(course, updated_at);
+    """)
+    # One-time import of the old CSV (kept on disk, no longer written)
+    if os.path.isfile(LEADS_CSV):
+        with open(LEADS_CSV, newline="", encoding="utf-8") as f:
+            rows = [lead_params(r, r.get("timestamp") or datetime.now().isoformat(timespec="seconds"))
+                    for r in csv.DictReader(f) if r.get("wa_id")]
+        conn.executemany(LEAD_UPSERT_SQL, rows)
+
+def migrate_payload_store(conn):
+    # Raw payloads move to a zlib-compressed, content-addressed side table.
+    # Outbound payloads are stored without 'to', so every copy of a menu shares one row.
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS payloads (
+        hash TEXT PRIMARY KEY,       -- sha1 of the canonical JSON
+        body BLOB NOT NULL           -- zlib(JSON)
+    ) WITHOUT ROWID;
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(messages)")}
+    if "payload_hash" not in cols:
+        conn.execute("ALTER TABLE messages ADD COLUMN payload_hash TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_payload_hash ON messages(payload_hash)")
+    # Convert existing rows in chunks so a big chat.db doesn't need it all in memory
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            "SELECT id, direction, payload FROM messages WHERE id > ? AND payload IS NOT NULL ORDER BY id LIMIT 5000",
+            (last_id,)
+        ).fetchall()
+        if not rows:
+            break
+        blobs, links = {}, []
+        for mid, direction, raw in rows:
+            try: payload = json.loads(raw)
+            except ValueError: payload = {"raw": raw}
+            h, body = pack_payload(payload, direction)
+            blobs[h] = body
+            links.append((h, mid))
+        conn.executemany("INSERT OR IGNORE INTO payloads (hash, body) VALUES (?, ?)", blobs.items())
+        conn.executemany("UPDATE messages SET payload_hash = ?, payload = NULL WHERE id = ?", links)
+        last_id = rows[-1][0]
+
+def migrate_search_index(conn):
+    # FTS5 index over messages.text (external content: the text itself isn't stored twice).
+    # Triggers keep it in step with every insert/update/delete, archival included.
+    try:
+        conn.executescript("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            text, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_ai AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts(rowid, text) VALUES (NEW.id, NEW.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_ad AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS trg_messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+            INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', OLD.id, OLD.text);
+            INSERT INTO messages_fts(rowid, text) VALUES (NEW.id, NEW.text);
+        END;
+        INSERT INTO messages_fts(messages_fts) VALUES ('rebuild');
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5: everything else works, /admin/search says so
+        print("[DB] full-text search disabled:", e)
+
+def migrate_broadcasts(conn):
+    # One row per broadcast job, one per (job, recipient); the recipient row is
+    # the send ledger that makes a restart resume instead of starting over.
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        kind TEXT NOT NULL,              -- 'text' | 'template'
+        body TEXT NOT NULL,              -- message text, or template name
+        lang TEXT,                       -- template language code
+        filters TEXT NOT NULL,           -- JSON {course, attempt, mode}
+        status TEXT NOT NULL,            -- 'running' | 'paused' | 'cancelled' | 'done'
+        total INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        finished_at TEXT,
+        lease_owner TEXT,                -- worker currently sending ('host:pid')
+        lease_until REAL                 -- unix time; expired lease = free to take over
+    );
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id INTEGER NOT NULL,
+        wa_id TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'pending',   -- 'pending' | 'sending' | 'sent' | 'failed'
+        error TEXT,
+        updated_at TEXT,
+        PRIMARY KEY (broadcast_id, wa_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_state ON broadcast_recipients(broadcast_id, state);
+    """)
+
+# Latency histogram bounds (seconds) for delivered/read after sent
+STATUS_LATENCY_BUCKETS = (1, 2, 5, 10, 30, 60, 300, 1800, 3600, 21600, 86400)
+
+def status_bucket_sql(expr: str) -> str:
+    return "CASE " + " ".join(f"WHEN {expr} <= {b} THEN {b}" for b in STATUS_LATENCY_BUCKETS) + " ELSE 9e999 END"
+
+def migrate_delivery_status(conn):
+    # Status callbacks (sent/delivered/read/failed) keyed by the Graph message id (wamid),
+    # which outbound messages rows now carry. Triggers keep daily rollups current as rows
+    # land, so the admin panel never aggregates raw statuses.
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(messages)")]
+    if "wamid" not in cols:
+        conn.execute("ALTER TABLE messages ADD COLUMN wamid TEXT")
+    day = "date(NEW.ts, 'unixepoch', 'localtime')"
+    mtype = "coalesce((SELECT mtype FROM messages WHERE wamid = NEW.wamid), 'unknown')"
+    conn.executescript(f"""
+    CREATE INDEX IF NOT EXISTS idx_messages_wamid ON messages(wamid) WHERE wamid IS NOT NULL;
+    CREATE TABLE IF NOT EXISTS statuses (
+        wamid TEXT NOT NULL,
+        status TEXT NOT NULL,            -- 'sent' | 'delivered' | 'read' | 'failed'
+        ts INTEGER NOT NULL,             -- unix time reported by WhatsApp
+        recipient TEXT,
+        error_code INTEGER,
+        error_title TEXT,
+        PRIMARY KEY (wamid, status)      -- retried callbacks are no-ops
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_statuses_failed ON statuses(ts) WHERE status = 'failed';
+    CREATE TABLE IF NOT EXISTS status_rollup (
+        day TEXT NOT NULL, mtype TEXT NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0, delivered INTEGER NOT NULL DEFAULT 0,
+        read INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, mtype)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS status_latency (
+        day TEXT NOT NULL,               -- day of the 'sent' event
+        kind TEXT NOT NULL,              -- 'delivered' | 'read'
+        le REAL NOT NULL,                -- histogram bucket upper bound (seconds)
+        n INTEGER NOT NULL DEFAULT 0,
+        total_sec REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, kind, le)
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS trg_statuses_count AFTER INSERT ON statuses BEGIN
+        INSERT INTO status_rollup (day, mtype, sent, delivered, read, failed)
+        VALUES ({day}, {mtype}, NEW.status = 'sent', NEW.status = 'delivered', NEW.status = 'read', NEW.status = 'failed')
+        ON CONFLICT(day, mtype) DO UPDATE SET
+            sent = sent + excluded.sent, delivered = delivered + excluded.delivered,
+            read = read + excluded.read, failed = failed + excluded.failed;
+    END;
+    -- latency needs both ends; whichever callback arrives second records it
+    CREATE TRIGGER IF NOT EXISTS trg_statuses_latency AFTER INSERT ON statuses
+    WHEN NEW.status IN ('delivered', 'read') BEGIN
+        INSERT INTO status_latency (day, kind, le, n, total_sec)
+        SELECT date(s.ts, 'unixepoch', 'localtime'), NEW.status, {status_bucket_sql("max(NEW.ts - s.ts, 0)")}, 1, max(NEW.ts - s.ts, 0)
+        FROM statuses s WHERE s.wamid = NEW.wamid AND s.status = 'sent'
+        ON CONFLICT(day, kind, le) DO UPDATE SET n = n + 1, total_sec = total_sec + excluded.total_sec;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_statuses_latency_late_sent AFTER INSERT ON statuses
+    WHEN NEW.status = 'sent' BEGIN
+        INSERT INTO status_latency (day, kind, le, n, total_sec)
+        SELECT {day}, s.status, {status_bucket_sql("max(s.ts - NEW.ts, 0)")}, 1, max(s.ts - NEW.ts, 0)
+        FROM statuses s WHERE s.wamid = NEW.wamid AND s.status IN ('delivered', 'read')
+        ON CONFLICT(day, kind, le) DO UPDATE SET n = n + 1, total_sec = total_sec + excluded.total_sec;
+    END;
+    """)
+
+def migrate_outbox(conn):
+    # Replies are written here (and to messages with delivery='queued') before any
+    # Graph call; the row lives until the send succeeds or is given up on.
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(messages)")]
+    if "delivery" not in cols:
+        conn.execute("ALTER TABLE messages ADD COLUMN delivery TEXT")   # NULL for inbound / older rows
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        message_id INTEGER NOT NULL,     -- messages row (text, payload_hash, delivery)
+        wa_id TEXT NOT NULL,
+        state TEXT NOT NULL,             -- 'pending' | 'sending' | 'failed' (sent rows are deleted)
+        attempts INTEGER NOT NULL DEFAULT 0,
+        due_at REAL NOT NULL,            -- pending: next attempt; sending: lease expiry (unix time)
+        lease_owner TEXT,
+        created_at REAL NOT NULL,
+        last_error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(due_at) WHERE state IN ('pending', 'sending');
+    """)
+
+def migrate_funnel(conn):
+    # One compact row per flow transition (set_state / clear_state); a trigger folds each
+    # into hourly and daily counters, so /admin/analytics only ever reads the rollups.
+    # Dimension columns use '' for "not chosen yet" so they can be part of the keys.
+    dims = "stage, prev, course, attempt, grp, mode"
+    rollup_cols = """stage TEXT NOT NULL, prev TEXT NOT NULL, course TEXT NOT NULL, attempt TEXT NOT NULL,
+        grp TEXT NOT NULL, mode TEXT NOT NULL, n INTEGER NOT NULL DEFAULT 0"""
+    conn.executescript(f"""
+    CREATE TABLE IF NOT EXISTS funnel_events (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,             -- unix time
+        wa_id TEXT NOT NULL,
+        stage TEXT NOT NULL,             -- stage entered (KNOW, COURSE, ATTEMPT, GROUP, MODE) or LEAD / RESTART
+        prev TEXT NOT NULL DEFAULT '',   -- stage the user was at before
+        course TEXT NOT NULL DEFAULT '',
+        attempt TEXT NOT NULL DEFAULT '',
+        grp TEXT NOT NULL DEFAULT '',
+        mode TEXT NOT NULL DEFAULT ''
+    );
+    CREATE INDEX IF NOT EXISTS idx_funnel_events_ts ON funnel_events(ts);
+    CREATE TABLE IF NOT EXISTS funnel_hourly (
+        hour TEXT NOT NULL,              -- 'YYYY-MM-DD HH' local time
+        {rollup_cols},
+        PRIMARY KEY (hour, {dims})
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS funnel_daily (
+        day TEXT NOT NULL,
+        {rollup_cols},
+        PRIMARY KEY (day, {dims})
+    ) WITHOUT ROWID;
+
+    CREATE TRIGGER IF NOT EXISTS trg_funnel_rollup AFTER INSERT ON funnel_events BEGIN
+        INSERT INTO funnel_hourly (hour, {dims}, n)
+        VALUES (strftime('%Y-%m-%d %H', NEW.ts, 'unixepoch', 'localtime'),
+                NEW.stage, NEW.prev, NEW.course, NEW.attempt, NEW.grp, NEW.mode, 1)
+        ON CONFLICT(hour, {dims}) DO UPDATE SET n = n + 1;
+        INSERT INTO funnel_daily (day, {dims}, n)
+        VALUES (date(NEW.ts, 'unixepoch', 'localtime'), NEW.stage, NEW.prev, NEW.course, NEW.attempt, NEW.grp, NEW.mode, 1)
+        ON CONFLICT(day, {dims}) DO UPDATE SET n = n + 1;
+    END;
+    """)
+
+def migrate_media_cache(conn):
+    # Graph media ids of uploaded files, keyed by content: an edited file hashes
+    # differently and is uploaded again, an unchanged one is reused by every worker.
+    conn.executescript("""
+    CREATE TABLE IF NOT EXISTS media_cache (
+        sha256 TEXT PRIMARY KEY,
+        media_id TEXT NOT NULL,
+        mime TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        path TEXT NOT NULL,              -- file it was uploaded from (informational)
+        uploaded_at REAL NOT NULL,       -- unix time
+        expires_at REAL NOT NULL         -- uploaded_at + MEDIA_TTL_SEC
+    ) WITHOUT ROWID;
+    """)
+
+def migrate_numbers(conn):
+    # One deployment can serve several WhatsApp numbers (NUMBERS_FILE). Everything kept per
+    # contact is keyed by (phone_number_id, wa_id) from here on, and the rollups gain the
+    # number as a dimension. Existing rows belong to PHONE_NUMBER_ID, the number this
+    # deployment used to serve on its own. Tables whose keys change are rebuilt.
+    primary = "'" + (PHONE_NUMBER_ID or "").replace("'", "''") + "'"
+    for table in ("messages", "outbox", "broadcasts", "funnel_events", "statuses"):
+        cols = [r[1] for r in conn.execute(f"PRAGMA table_info({table})")]
+        if "phone_number_id" not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN phone_number_id TEXT NOT NULL DEFAULT {primary}")
+    dims = "stage, prev, course, attempt, grp, mode"
+    rollup_cols = """phone_number_id TEXT NOT NULL, stage TEXT NOT NULL, prev TEXT NOT NULL, course TEXT NOT NULL,
+        attempt TEXT NOT NULL, grp TEXT NOT NULL, mode TEXT NOT NULL, n INTEGER NOT NULL DEFAULT 0"""
+    day = "date(NEW.ts, 'unixepoch', 'localtime')"
+    mtype = "coalesce((SELECT mtype FROM messages WHERE wamid = NEW.wamid), 'unknown')"
+    conn.executescript(f"""
+    BEGIN;
+    DROP TRIGGER IF EXISTS trg_messages_conversations;
+    DROP TRIGGER IF EXISTS trg_funnel_rollup;
+    DROP TRIGGER IF EXISTS trg_statuses_count;
+    DROP TRIGGER IF EXISTS trg_statuses_latency;
+    DROP TRIGGER IF EXISTS trg_statuses_latency_late_sent;
+
+    CREATE TABLE conversations_v2 (
+        phone_number_id TEXT NOT NULL,
+        wa_id TEXT NOT NULL,
+        last_ts TEXT NOT NULL,
+        last_preview TEXT,
+        msg_count INTEGER NOT NULL DEFAULT 0,
+        in_count INTEGER NOT NULL DEFAULT 0,
+        out_count INTEGER NOT NULL DEFAULT 0,
+        paused INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (phone_number_id, wa_id)
+    );
+    INSERT INTO conversations_v2
+    SELECT {primary}, wa_id, last_ts, last_preview, msg_count, in_count, out_count, paused FROM conversations;
+    DROP TABLE conversations;
+    ALTER TABLE conversations_v2 RENAME TO conversations;
+    CREATE INDEX idx_conversations_last_ts ON conversations(last_ts DESC);
+    CREATE INDEX idx_conversations_number_last_ts ON conversations(phone_number_id, last_ts DESC);
+
+    CREATE TRIGGER trg_messages_conversations AFTER INSERT ON messages
+    BEGIN
+        INSERT INTO conversations (phone_number_id, wa_id, last_ts, last_preview, msg_count, in_count, out_count)
+        VALUES (NEW.phone_number_id, NEW.wa_id, NEW.ts, substr(coalesce(NEW.text, ''), 1, 160), 1,
+                NEW.direction = 'in', NEW.direction = 'out')
+        ON CONFLICT(phone_number_id, wa_id) DO UPDATE SET
+            last_preview = CASE WHEN excluded.last_ts >= conversations.last_ts
+                                THEN excluded.last_preview ELSE conversations.last_preview END,
+            last_ts   = max(conversations.last_ts, excluded.last_ts),
+            msg_count = conversations.msg_count + 1,
+            in_count  = conversations.in_count + excluded.in_count,
+            out_count = conversations.out_count + excluded.out_count;
+    END;
+
+    CREATE TABLE flow_state_v2 (
+        phone_number_id TEXT NOT NULL,
+        wa_id TEXT NOT NULL,
+        data TEXT NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (phone_number_id, wa_id)
+    );
+    INSERT INTO flow_state_v2 SELECT {primary}, wa_id, data, expires_at FROM flow_state;
+    DROP TABLE flow_state;
+    ALTER TABLE flow_state_v2 RENAME TO flow_state;
+    CREATE INDEX idx_flow_state_expires ON flow_state(expires_at);
+
+    CREATE TABLE leads_v2 (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        phone_number_id TEXT NOT NULL,   -- number the enquiry came in on
+        wa_id TEXT NOT NULL,
+        course TEXT NOT NULL DEFAULT '',
+        attempt TEXT NOT NULL DEFAULT '',
+        grp TEXT NOT NULL DEFAULT '',
+        mode TEXT NOT NULL DEFAULT '',
+        flow TEXT,
+        name TEXT,
+        city TEXT,
+        profile_name TEXT,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        enquiries INTEGER NOT NULL DEFAULT 1,
+        UNIQUE (phone_number_id, wa_id, course, attempt, mode)
+    );
+    INSERT INTO leads_v2 (id, phone_number_id, wa_id, course, attempt, grp, mode, flow, name, city, profile_name,
+                          created_at, updated_at, enquiries)
+    SELECT id, {primary}, wa_id, course, attempt, grp, mode, flow, name, city, profile_name,
+           created_at, updated_at, enquiries FROM leads;
+    DROP TABLE leads;
+    ALTER TABLE leads_v2 RENAME TO leads;
+    CREATE INDEX idx_leads_updated ON leads(updated_at);
+    CREATE INDEX idx_leads_course_updated ON leads(course, updated_at);
+    CREATE INDEX idx_leads_number_updated ON leads(phone_number_id, updated_at);
+
+    CREATE TABLE media_cache_v2 (
+        phone_number_id TEXT NOT NULL,   -- media ids are only valid for the number that uploaded them
+        sha256 TEXT NOT NULL,
+        media_id TEXT NOT NULL,
+        mime TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        uploaded_at REAL NOT NULL,
+        expires_at REAL NOT NULL,
+        PRIMARY KEY (phone_number_id, sha256)
+    ) WITHOUT ROWID;
+    INSERT INTO media_cache_v2 SELECT {primary}, sha256, media_id, mime, size, path, uploaded_at, expires_at FROM media_cache;
+    DROP TABLE media_cache;
+    ALTER TABLE media_cache_v2 RENAME TO media_cache;
+
+    CREATE TABLE funnel_hourly_v2 (hour TEXT NOT NULL, {rollup_cols},
+        PRIMARY KEY (hour, phone_number_id, {dims})) WITHOUT ROWID;
+    INSERT INTO funnel_hourly_v2 SELECT hour, {primary}, {dims}, n FROM funnel_hourly;
+    DROP TABLE funnel_hourly;
+    ALTER TABLE funnel_hourly_v2 RENAME TO funnel_hourly;
+    CREATE TABLE funnel_daily_v2 (day TEXT NOT NULL, {rollup_cols},
+        PRIMARY KEY (day, phone_number_id, {dims})) WITHOUT ROWID;
+    INSERT INTO funnel_daily_v2 SELECT day, {primary}, {dims}, n FROM funnel_daily;
+    DROP TABLE funnel_daily;
+    ALTER TABLE funnel_daily_v2 RENAME TO funnel_daily;
 
-# ----------------- Pause map (persisted JSON) -----------------
+    CREATE TRIGGER trg_funnel_rollup AFTER INSERT ON funnel_events BEGIN
+        INSERT INTO funnel_hourly (hour, phone_number_id, {dims}, n)
+        VALUES (strftime('%Y-%m-%d %H', NEW.ts, 'unixepoch', 'localtime'), NEW.phone_number_id,
+                NEW.stage, NEW.prev, NEW.course, NEW.attempt, NEW.grp, NEW.mode, 1)
+        ON CONFLICT(hour, phone_number_id, {dims}) DO UPDATE SET n = n + 1;
+        INSERT INTO funnel_daily (day, phone_number_id, {dims}, n)
+        VALUES (date(NEW.ts, 'unixepoch', 'localtime'), NEW.phone_number_id,
+                NEW.stage, NEW.prev, NEW.course, NEW.attempt, NEW.grp, NEW.mode, 1)
+        ON CONFLICT(day, phone_number_id, {dims}) DO UPDATE SET n = n + 1;
+    END;
+
+    CREATE TABLE status_rollup_v2 (
+        day TEXT NOT NULL, phone_number_id TEXT NOT NULL, mtype TEXT NOT NULL,
+        sent INTEGER NOT NULL DEFAULT 0, delivered INTEGER NOT NULL DEFAULT 0,
+        read INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, phone_number_id, mtype)
+    ) WITHOUT ROWID;
+    INSERT INTO status_rollup_v2 SELECT day, {primary}, mtype, sent, delivered, read, failed FROM status_rollup;
+    DROP TABLE status_rollup;
+    ALTER TABLE status_rollup_v2 RENAME TO status_rollup;
+    CREATE TABLE status_latency_v2 (
+        day TEXT NOT NULL, phone_number_id TEXT NOT NULL, kind TEXT NOT NULL, le REAL NOT NULL,
+        n INTEGER NOT NULL DEFAULT 0, total_sec REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, phone_number_id, kind, le)
+    ) WITHOUT ROWID;
+    INSERT INTO status_latency_v2 SELECT day, {primary}, kind, le, n, total_sec FROM status_latency;
+    DROP TABLE status_latency;
+    ALTER TABLE status_latency_v2 RENAME TO status_latency;
+
+    CREATE TRIGGER trg_statuses_count AFTER INSERT ON statuses BEGIN
+        INSERT INTO status_rollup (day, phone_number_id, mtype, sent, delivered, read, failed)
+        VALUES ({day}, NEW.phone_number_id, {mtype},
+                NEW.status = 'sent', NEW.status = 'delivered', NEW.status = 'read', NEW.status = 'failed')
+        ON CONFLICT(day, phone_number_id, mtype) DO UPDATE SET
+            sent = sent + excluded.sent, delivered = delivered + excluded.delivered,
+            read = read + excluded.read, failed = failed + excluded.failed;
+    END;
+    CREATE TRIGGER trg_statuses_latency AFTER INSERT ON statuses
+    WHEN NEW.status IN ('delivered', 'read') BEGIN
+        INSERT INTO status_latency (day, phone_number_id, kind, le, n, total_sec)
+        SELECT date(s.ts, 'unixepoch', 'localtime'), NEW.phone_number_id, NEW.status,
+               {status_bucket_sql("max(NEW.ts - s.ts, 0)")}, 1, max(NEW.ts - s.ts, 0)
+        FROM statuses s WHERE s.wamid = NEW.wamid AND s.status = 'sent'
+        ON CONFLICT(day, phone_number_id, kind, le) DO UPDATE SET n = n + 1, total_sec = total_sec + excluded.total_sec;
+    END;
+    CREATE TRIGGER trg_statuses_latency_late_sent AFTER INSERT ON statuses
+    WHEN NEW.status = 'sent' BEGIN
+        INSERT INTO status_latency (day, phone_number_id, kind, le, n, total_sec)
+        SELECT {day}, NEW.phone_number_id, s.status, {status_bucket_sql("max(s.ts - NEW.ts, 0)")}, 1, max(s.ts - NEW.ts, 0)
+        FROM statuses s WHERE s.wamid = NEW.wamid AND s.status IN ('delivered', 'read')
+        ON CONFLICT(day, phone_number_id, kind, le) DO UPDATE SET n = n + 1, total_sec = total_sec + excluded.total_sec;
+    END;
+    COMMIT;
+    """)
+    # pause flags by number, from either overrides.json format (the flat one means PHONE_NUMBER_ID)
+    conn.executemany("UPDATE conversations SET paused = 1 WHERE phone_number_id = ? AND wa_id = ?",
+                     [key for key, flag in paused_flags(load_overrides()).items() if flag])
+
+def migrate_flow_state_rev(conn):
+    # rev changes on every write, so a cached copy can be checked with one indexed read
+    conn.execute("ALTER TABLE flow_state ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+
+def migrate_outbox_order(conn):
+    # outbox_ready(): is an earlier reply to this user waiting for a retry?
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_outbox_pending_wa ON outbox(wa_id, phone_number_id) WHERE state = 'pending'")
+
+def migrate_status_reattribute(conn):
+    # A status callback can beat outbox_finish() (or a broadcast's log row) to the wamid;
+    # trg_statuses_count then files it under 'unknown'. When the wamid lands, move those
+    # counts to the message's mtype.
+    day = "date(s.ts, 'unixepoch', 'localtime')"
+    def move(sign: str, mtype: str) -> str:
+        return f"""
+        INSERT INTO status_rollup (day, phone_number_id, mtype, sent, delivered, read, failed)
+        SELECT {day}, s.phone_number_id, {mtype}, {sign}(s.status = 'sent'), {sign}(s.status = 'delivered'),
+               {sign}(s.status = 'read'), {sign}(s.status = 'failed')
+        FROM statuses s WHERE s.wamid = NEW.wamid AND true
+        ON CONFLICT(day, phone_number_id, mtype) DO UPDATE SET
+            sent = sent + excluded.sent, delivered = delivered + excluded.delivered,
+            read = read + excluded.read, failed = failed + excluded.failed;"""
+    body = f"""BEGIN{move("-", "'unknown'")}{move("", "NEW.mtype")}
+        DELETE FROM status_rollup WHERE mtype = 'unknown' AND sent = 0 AND delivered = 0 AND read = 0 AND failed = 0
+            AND (day, phone_number_id) IN (SELECT {day}, s.phone_number_id FROM statuses s WHERE s.wamid = NEW.wamid);
+    END;"""
+    conn.executescript(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_wamid_set AFTER UPDATE OF wamid ON messages
+    WHEN OLD.wamid IS NULL AND NEW.wamid IS NOT NULL AND coalesce(NEW.mtype, 'unknown') != 'unknown' {body}
+    CREATE TRIGGER IF NOT EXISTS trg_messages_wamid_insert AFTER INSERT ON messages
+    WHEN NEW.wamid IS NOT NULL AND coalesce(NEW.mtype, 'unknown') != 'unknown' {body}
+    """)
+
+MIGRATIONS = [
+    migrate_conversations,
+    migrate_flow_state,
+    migrate_seen_messages,
+    migrate_leads,
+    migrate_payload_store,
+    migrate_search_index,
+    migrate_broadcasts,
+    migrate_delivery_status,
+    migrate_outbox,
+    migrate_funnel,
+    migrate_media_cache,
+    migrate_numbers,
+    migrate_flow_state_rev,
+    migrate_outbox_order,
+    migrate_status_reattribute,
+]
+
+# ----------------- Pause map (persisted JSON, cached in-process) -----------------
 def load_overrides():
     if not os.path.isfile(OVERRIDES_JSON):
         return {"paused": {}}
@@ -89,406 +1059,2469 @@ def load_overrides():
     except Exception:
         return {"paused": {}}
 
+def paused_flags(ov: dict) -> dict[tuple[str, str], bool]:
+    """{(phone_number_id, wa_id): flag}; the older flat {wa_id: flag} form belongs to PHONE_NUMBER_ID."""
+    flags = {}
+    for key, v in ov.get("paused", {}).items():
+        if isinstance(v, dict):
+            flags.update(((key, w), bool(flag)) for w, flag in v.items())
+        else:
+            flags[(PHONE_NUMBER_ID, key)] = bool(v)
+    return flags
+
 def save_overrides(data):
-    with open(OVERRIDES_JSON, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    # write-to-temp + rename: readers only ever see the old or the new file, never half of one
+    d = os.path.dirname(os.path.abspath(OVERRIDES_JSON))
+    fd, tmp = tempfile.mkstemp(prefix=".overrides-", suffix=".json", dir=d)
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, OVERRIDES_JSON)
+    except BaseException:
+        try: os.unlink(tmp)
+        except OSError: pass
+        raise
+
+class PauseRegistry:
+    """
+    Pause flags live in a plain dict; is_paused() never touches the file.
+    A background thread stats overrides.json every PAUSE_RECHECK_SEC and
+    reloads only when (inode, mtime, size) changed, so a toggle made by one
+    gunicorn worker reaches the others within that delay.
+    Writes take an exclusive lock, re-read, modify and atomically replace.
+    """
+    def __init__(self, path: str, recheck_sec: float):
+        self.path = path
+        self.recheck_sec = recheck_sec
+        self.paused: dict[tuple[str, str], bool] = {}   # (phone_number_id, wa_id) -> True
+        self.version = 0            # bumps on every observed change (for live admin views)
+        self._sig = None
+        self._pid = None
+        self._lock = threading.Lock()
 
-def is_paused(wa_id: str) -> bool:
-    return bool(load_overrides().get("paused", {}).get(wa_id))
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _reload(self, force: bool = False):
+        sig = self._signature()
+        if not force and sig == self._sig:
+            return
+        paused = {k: True for k, v in paused_flags(load_overrides()).items() if v}
+        with self._lock:
+            if paused != self.paused:
+                self.version += 1
+            self.paused, self._sig = paused, sig
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        self._reload(force=True)
+        threading.Thread(target=self._watch, name="pause-watch", daemon=True).start()
+
+    def _watch(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.recheck_sec)
+            try: self._reload()
+            except Exception as e: print("Error reloading overrides:", e)
+
+    def is_paused(self, number: str, wa_id: str) -> bool:
+        self._ensure_started()
+        return (number, wa_id) in self.paused
+
+    def snapshot(self) -> tuple[int, dict[tuple[str, str], bool]]:
+        self._ensure_started()
+        with self._lock:
+            return self.version, dict(self.paused)
+
+    def set(self, number: str, wa_id: str, flag: bool):
+        self._ensure_started()
+        lock_f = open(self.path + ".lock", "a+")
+        try:
+            if fcntl: fcntl.flock(lock_f, fcntl.LOCK_EX)
+            ov = load_overrides()
+            flags = paused_flags(ov)
+            flags[(number, wa_id)] = bool(flag)
+            ov["paused"] = {}               # rewritten per number (also upgrades the flat form)
+            for (n, w), f in flags.items():
+                ov["paused"].setdefault(n, {})[w] = f
+            save_overrides(ov)
+            self._reload(force=True)
+        finally:
+            if fcntl: fcntl.flock(lock_f, fcntl.LOCK_UN)
+            lock_f.close()
+
+PAUSES = PauseRegistry(OVERRIDES_JSON, PAUSE_RECHECK_SEC)
+
+def is_paused(wa_id: str, number: str | None = None) -> bool:
+    t0 = time.perf_counter()
+    paused = PAUSES.is_paused(number or current_line().id, wa_id)
+    METRICS.observe("lookup_seconds", time.perf_counter() - t0, (("kind", "pause"),))
+    return paused
+
+def set_paused(number: str, wa_id: str, flag: bool):
+    PAUSES.set(number, wa_id, flag)
+    # keep the /admin summary row in step
+    with db() as conn:
+        conn.execute("UPDATE conversations SET paused = ? WHERE phone_number_id = ? AND wa_id = ?",
+                     (int(bool(flag)), number, wa_id))
 
-def set_paused(wa_id: str, flag: bool):
-    ov = load_overrides()
-    ov.setdefault("paused", {})[wa_id] = bool(flag)
-    save_overrides(ov)
+# ----------------- Conversation state store -----------------
+class MemoryStateStore:
+    """Per-process dict with TTL. Fine for a single worker / local dev."""
+    def __init__(self, ttl_sec: float):
+        self.ttl_sec = ttl_sec
+        self._data: dict[tuple[str, str], tuple[dict, float]] = {}
+        self._lock = threading.Lock()
 
-# ----------------- In-memory state -----------------
-STATE = {}
+    def get(self, number: str, wa_id: str) -> dict:
+        hit = self._data.get((number, wa_id))
+        if not hit or hit[1] <= time.time():
+            return {}
+        return dict(hit[0])
 
+    def update(self, number: str, wa_id: str, **kwargs) -> dict:
+        with self._lock:
+            prev = self.get(number, wa_id)
+            self._data[(number, wa_id)] = ({**prev, **kwargs}, time.time() + self.ttl_sec)
+            return prev
+
+    def clear(self, number: str, wa_id: str):
+        self._data.pop((number, wa_id), None)
+
+    def sweep(self) -> int:
+        now = time.time()
+        with self._lock:
+            dead = [k for k, (_, exp) in self._data.items() if exp <= now]
+            for k in dead:
+                del self._data[k]
+        return len(dead)
+
+class SQLiteStateStore:
+    """
+    State rows in chat.db's flow_state table, so a button tap can land on any
+    gunicorn worker. Every read checks the row's rev; a small LRU front cache
+    only saves fetching + parsing the JSON when the row hasn't changed since
+    this process last saw it. update() merges into the row as it is in the
+    database, inside one write transaction, so two workers handling taps from
+    the same user can't drop each other's fields. Expired rows are treated as
+    missing and a sweeper thread deletes them every STATE_SWEEP_SEC.
+    """
+    def __init__(self, ttl_sec: float, cache_size: int, sweep_sec: float):
+        self.ttl_sec = ttl_sec
+        self.cache_size = cache_size
+        self.sweep_sec = sweep_sec
+        self._cache: OrderedDict[tuple[str, str], tuple[dict, int, float]] = OrderedDict()  # (number, wa_id) -> (data, rev, expires_at)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._cache.clear()
+            self._pid = os.getpid()
+        threading.Thread(target=self._sweeper, name="state-sweeper", daemon=True).start()
+
+    def _remember(self, key: tuple[str, str], data: dict, rev: int, expires_at: float):
+        with self._lock:
+            self._cache[key] = (data, rev, expires_at)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _read(self, conn: sqlite3.Connection, key: tuple[str, str]) -> dict:
+        hit = self._cache.get(key)
+        # data is only sent back when the row changed since we cached it
+        row = conn.execute(
+            "SELECT rev, expires_at, CASE WHEN rev = ? THEN NULL ELSE data END FROM flow_state "
+            "WHERE phone_number_id=? AND wa_id=? AND expires_at > ?",
+            (hit[1] if hit else None, *key, time.time())
+        ).fetchone()
+        if not row:
+            with self._lock:
+                self._cache.pop(key, None)
+            return {}
+        data = hit[0] if row[2] is None else json.loads(row[2])
+        self._remember(key, data, row[0], row[1])
+        return dict(data)
+
+    def get(self, number: str, wa_id: str) -> dict:
+        self._ensure_started()
+        return self._read(local_db(), (number, wa_id))
+
+    def update(self, number: str, wa_id: str, **kwargs) -> dict:
+        """Merge kwargs into the user's state; returns the state as it was before."""
+        self._ensure_started()
+        key, conn = (number, wa_id), local_db()
+        for attempt in range(5):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                prev = self._read(conn, key)
+                cur = {**prev, **kwargs}
+                rev, expires_at = random.getrandbits(62), time.time() + self.ttl_sec   # random: a re-created row never matches an old cache entry
+                conn.execute(
+                    "INSERT INTO flow_state (phone_number_id, wa_id, data, expires_at, rev) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT(phone_number_id, wa_id) DO UPDATE SET data=excluded.data, expires_at=excluded.expires_at, rev=excluded.rev",
+                    (number, wa_id, json.dumps(cur, ensure_ascii=False), expires_at, rev)
+                )
+                conn.execute("COMMIT")
+                self._remember(key, cur, rev, expires_at)
+                return prev
+            except sqlite3.OperationalError:
+                if conn.in_transaction: conn.execute("ROLLBACK")
+                if attempt == 4:
+                    raise
+                time.sleep(0.05 * (2 ** attempt))
+        return {}
+
+    def clear(self, number: str, wa_id: str):
+        self._ensure_started()
+        with self._lock:
+            self._cache.pop((number, wa_id), None)
+        local_db().execute("DELETE FROM flow_state WHERE phone_number_id=? AND wa_id=?", (number, wa_id))
+
+    def sweep(self) -> int:
+        now = time.time()
+        with self._lock:
+            for k in [k for k, (_, _, exp) in self._cache.items() if exp <= now]:
+                del self._cache[k]
+        return local_db().execute("DELETE FROM flow_state WHERE expires_at <= ?", (now,)).rowcount
+
+    def _sweeper(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.sweep_sec)
+            try: self.sweep()
+            except sqlite3.Error as e: print("Error sweeping flow state:", e)
+
+def make_state_store():
+    if STATE_BACKEND == "memory":
+        return MemoryStateStore(STATE_TTL_SEC)
+    if STATE_BACKEND == "sqlite":
+        return SQLiteStateStore(STATE_TTL_SEC, STATE_CACHE_SIZE, STATE_SWEEP_SEC)
+    raise SystemExit(f"[ENV] STATE_BACKEND must be 'sqlite' or 'memory', got {STATE_BACKEND!r}")
+
+STATE = make_state_store()
+
+# The flow helpers below act on the number being served (current_line(), see Lines)
 def set_state(wa_id: str, **kwargs):
-    cur = STATE.get(wa_id, {})
-    cur.update(kwargs)
-    STATE[wa_id] = cur
+    number = current_line().id
+    t0 = time.perf_counter()
+    prev = STATE.update(number, wa_id, **kwargs)
+    METRICS.observe("lookup_seconds", time.perf_counter() - t0, (("kind", "state_set"),))
+    if "stage" in kwargs:
+        METRICS.inc("flow_stage_total", (("stage", kwargs["stage"]),))
+        record_funnel(number, wa_id, kwargs["stage"], prev, {**prev, **kwargs})
 
 def get_state(wa_id: str):
-    return STATE.get(wa_id, {})
+    t0 = time.perf_counter()
+    st = STATE.get(current_line().id, wa_id)
+    METRICS.observe("lookup_seconds", time.perf_counter() - t0, (("kind", "state_get"),))
+    return st
 
-def clear_state(wa_id: str):
-    STATE.pop(wa_id, None)
+def clear_state(wa_id: str, outcome: str = "RESTART", **choices):
+    """Forget the user's flow; outcome says why (LEAD once the enquiry is complete)."""
+    number = current_line().id
+    prev = STATE.get(number, wa_id)
+    STATE.clear(number, wa_id)
+    if prev.get("stage"):
+        record_funnel(number, wa_id, outcome, prev, {**prev, **choices})
 
-# ----------------- Options (YOUR CONTENT) -----------------
-COURSES = [
-    ("COURSE_FOUNDATION",   "CA Foundation"),
-    ("COURSE_INTERMEDIATE", "CA Intermediate"),
-    ("COURSE_FINAL_TS",     "Final Test Series"),
-]
-ATTEMPTS_STD = [("ATTEMPT_SEP", "September"), ("ATTEMPT_MAY", "May"), ("ATTEMPT_JAN", "January")]
-GROUPS = [("GROUP_1", "Group 1"), ("GROUP_2", "Group 2"), ("GROUP_BOTH", "Both Groups")]
-MODES = [("MODE_FACE", "Face to Face"), ("MODE_ONLINE", "Online"), ("MODE_VIRTUAL", "Virtual")]
-
-SOCIAL_LINKS = {
-    "Instagram": "https://www.instagram.com/paras_institute_of_commerce/",
-    "YouTube":   "https://www.youtube.com/@ParasInstituteofCommercePvtLtd",
-    "Facebook":  "https://www.facebook.com/ParasInstituteIndia",
-}
-UNIQUE_FEATURES = [
-    "Paras Institute Of Commerce Since 1995",
-    "Face to Face, Virtual & Online Classes",
-    "30+ Years of Experience in teaching",
-    "A Core-competent, Efficient & Dedicated Faculty Team",
-    "Monthly Progress Report",
-    "Regular Doubt-Clearance Classes",
-    "Regular Classes Management",
-    "Regular co-ordination with parents",
-    "CA Foundation : 60 Chapter wise Tests, 12 Unit Tests and 12 Final Mock Test",
-    "CA Intermediate : 70 Chapter wise Tests, 12 Unit Tests and 12 Final Mock Test",
-    "CA Final : 16 Unit Tests and 12 Final Mock Tests",
-    "Timely Test Checking",
-]
-RESULTS_SUMMARY = [
-    "Excellent performance each year",
-    "Paras CA Foundation: 80–90% Result",
-    "Paras CA Intermediate: 70–80% Result",
-    "80+ All India Rank Holders",
-]
-IMPORTANT_CONTACTS = [
-    "Counselor 1 :            +91 9896162844",
-    "Counselor 2 :            +91 9896685777",
-    "Counselor 3 :            +91 8199996644",
-    "Face to Face Management: +91 8950329505",
-    "Online Management:       +91 9253076101",
-    "Test Dept:               +91 9034510124",
-]
+FUNNEL_INSERT_SQL = ("INSERT INTO funnel_events (ts, phone_number_id, wa_id, stage, prev, course, attempt, grp, mode) "
+                     "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)")
 
-FEATURES_TEXT = {
-    "Face to Face": (
-        "Face to Face Classes – Key Features:\n"
-        "• 30+ Years of Experience in teaching\n"
-        "• Daily in-class teaching\n"
-        "• Doubt counter & peer study rooms\n"
-        "• Regular tests & evaluation\n"
-        "• Parent coordination & progress reports\n"
-        "• Library & discipline-support on campus\n"
-        "• CA Foundation : 60 Chapter wise Tests, 12 Unit Tests and 12 Final Mock Test\n"
-        "• CA Intermediate : 70 Chapter wise Tests, 12 Unit Tests and 12 Final Mock Test\n"
-        "CA Final : 16 Unit Tests and 12 Final Mock Tests\n"
-        "• Timely Test Checking\n"
-        "• Individual Attention to Each Student"
-    ),
-    "Online": (
-        "Online Classes – Key Features:\n"
-        "• Leacture of face to face classes with two way communication between students and teachers.\n"
-        "• Unique teaching pattern with concept clarity form basic to advance.\n"
-        "• Best study material and updated questions banks covering all type of questions with 100% coverage of syllabus.\n"
-        "• Chapter wise, Unit wise and Final Test system for complete syllabus.\n"
-        "• Subject wise classes schedule managed by Paras Team on daily basis.\n"
-        "• Regular coordination by Paras management Team Members with students & Parents.\n"
-        "• Daily Home work PDF checking and revision classes.\n"
-        "• Monthly Performance Report and Analysis.\n"
-        "• Daily doubt clearance sessions by faculy.\n"
-        "• Regular work on physical and mental health."
-    ),
-    "Virtual": (
-        "Virtual Classes – Key Features:\n"
-        "• Fixed timetable (live virtual)\n"
-        "• Interactive doubt clearing\n"
-        "• Regular tests & mentor guidance\n"
-        "• Parent updates & performance summary\n"
-        "• List of City with Virtual centres of Paras Institute\n"
-        "- Bhiwani                  +919429049069\n"
-        "- Jind                     +919992757534\n"
-        "- Narwana                  +918168188426\n"
-        "- Bathinda                 +917888602120\n"
-        "- Kaithal                  +919097044004\n"
-        "- Rohtak                   +919034869678\n"
-        "- Sirsa                    +919416509909\n"
-        "- Yamunanagar              +917404909400\n"
-        "- Ambala                   +918708824618\n"
-        "- Jaipur                   +918802084656\n"
-        "- Shahdara, Delhi          +919716692702\n"
-        "- Laxmi Nagar, Delhi       +918199996644\n"
-        "- Tohana                   +917988476224\n"
-        "- Sonipat                  +917015755714\n"
-        "- Siliguri                 +919832062876\n"
-        "- Rewari                   +919729827454\n"
-    ),
-}
+def record_funnel(number: str, wa_id: str, stage: str, prev: dict, cur: dict):
+    # rides WRITER's next batch; trg_funnel_rollup keeps the hourly/daily counters
+    WRITER.submit(FUNNEL_INSERT_SQL, (int(time.time()), number, wa_id, stage, prev.get("stage") or "",
+                                      cur.get("course") or "", cur.get("attempt") or "",
+                                      cur.get("group") or "", cur.get("mode") or ""), "funnel")
 
-# ----------------- Logging helpers -----------------
-def log_message(wa_id: str, direction: str, mtype: str, text: str, payload: dict | None = None):
-    with db() as conn:
-        conn.execute(
-            "INSERT INTO messages (wa_id, direction, mtype, text, ts, payload) VALUES (?, ?, ?, ?, ?, ?)",
-            (wa_id, direction, mtype, text, datetime.now().isoformat(timespec="seconds"),
-             json.dumps(payload, ensure_ascii=False) if payload else None)
-        )
+# ----------------- Webhook dedup -----------------
+class SeenMessages:
+    """
+    Meta re-delivers a webhook when our 200 is slow. first_time(msg_id) says
+    whether this id is new: a bounded in-process LRU answers repeats for free,
+    and INSERT OR IGNORE into seen_messages settles it across workers and
+    restarts (only one worker's insert can win). A message whose handling
+    fails is forgotten again so a redelivery gets handled. Ids older than
+    DEDUP_TTL_SEC are pruned every sweep_sec.
+    """
+    def __init__(self, cache_size: int, ttl_sec: float, sweep_sec: float):
+        self.cache_size = cache_size
+        self.ttl_sec = ttl_sec
+        self.sweep_sec = sweep_sec
+        self._cache: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {"new": 0, "dup_cache": 0, "dup_db": 0}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._cache.clear()
+            self._pid = os.getpid()
+        threading.Thread(target=self._sweeper, name="dedup-sweeper", daemon=True).start()
+
+    def first_time(self, msg_id: str) -> bool:
+        self._ensure_started()
+        now = time.time()
+        with self._lock:
+            seen = self._cache.get(msg_id)
+            if seen is not None and now - seen < self.ttl_sec:
+                self.stats["dup_cache"] += 1
+                return False
+        inserted = local_db().execute(
+            "INSERT OR IGNORE INTO seen_messages (msg_id, seen_at) VALUES (?, ?)", (msg_id, now)
+        ).rowcount == 1
+        with self._lock:
+            self._cache[msg_id] = now
+            self._cache.move_to_end(msg_id)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            self.stats["new" if inserted else "dup_db"] += 1
+        return inserted
+
+    def forget(self, msg_id: str):
+        """Handling failed: let Meta's redelivery of this id through again."""
+        with self._lock:
+            self._cache.pop(msg_id, None)
+        local_db().execute("DELETE FROM seen_messages WHERE msg_id = ?", (msg_id,))
+
+    def _sweeper(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.sweep_sec)
+            try: local_db().execute("DELETE FROM seen_messages WHERE seen_at < ?", (time.time() - self.ttl_sec,))
+            except sqlite3.Error as e: print("Error pruning seen messages:", e)
+
+SEEN = SeenMessages(DEDUP_CACHE_SIZE, DEDUP_TTL_SEC, STATE_SWEEP_SEC)
+
+# ----------------- Logging helpers (group-commit writer) -----------------
+def db_locked(e: sqlite3.Error) -> bool:
+    """Another connection holds the write lock: worth retrying, unlike a bad statement."""
+    return getattr(e, "sqlite_errorcode", None) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED) or "locked" in str(e)
+
+class DBWriter:
+    """
+    Single long-lived SQLite connection owned by one background thread.
+    Callers enqueue (sql, params) and return immediately; the thread commits
+    whatever has piled up as one transaction once LOG_BATCH_SIZE rows are
+    waiting or LOG_FLUSH_MS has passed since the oldest one.
+    Consecutive rows with the same SQL go through executemany().
+    """
+    def __init__(self, path: str, batch_size: int, flush_ms: int):
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_sec = max(1, flush_ms) / 1000
+        self._lock = threading.Lock()
+        self._pid = None
+        self._q: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread: threading.Thread | None = None
+        self.stats = {"rows": 0, "batches": 0, "errors": 0, "dropped": 0}
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._q = queue.SimpleQueue()
+            self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, sql: str, params: tuple, kind: str = "other"):
+        self._ensure_started()
+        self._q.put((sql, params, kind, time.perf_counter()))
+
+    def call(self, fn, kind: str = "call", timeout: float = 10.0):
+        """
+        Run fn(conn) inside the next group commit, after everything queued
+        before it, and return its result once committed. Used where a write
+        must be durable before the caller goes on (outbox) yet stay ordered
+        with the rows already queued (the inbound message it answers).
+        """
+        box: dict = {}
+        self.submit(fn, box, kind)
+        if not self.flush(timeout) or "result" not in box:
+            raise RuntimeError(f"DB write ({kind}) not committed: {box.get('error', 'timeout')}")
+        return box["result"]
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Block until everything submitted so far is committed (admin pages, tests, shutdown)."""
+        self._ensure_started()
+        ev = threading.Event()
+        self._q.put(ev)
+        return ev.wait(timeout)
+
+    def stop(self, timeout: float = 10.0):
+        if self._pid != os.getpid():
+            return
+        self._q.put(None)
+        if self._thread:
+            self._thread.join(timeout)
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        for p in SQLITE_PRAGMAS:
+            conn.execute(p)
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        pending: list[tuple[str, tuple, str, float]] = []
+        waiters: list[threading.Event] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._q.get(timeout=timeout)
+            except queue.Empty:
+                item = False   # time threshold hit
+            if item is None:
+                self._commit(conn, pending)
+                for ev in waiters: ev.set()
+                conn.close()
+                return
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            elif item is not False:
+                pending.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_sec
+            if item is False or waiters or len(pending) >= self.batch_size:
+                self._commit(conn, pending)
+                pending = []
+                deadline = None
+                for ev in waiters: ev.set()
+                waiters = []
+
+    def _commit(self, conn: sqlite3.Connection, rows: list[tuple[str, tuple, str, float]]):
+        if not rows:
+            return
+        for attempt in range(5):
+            t0 = time.perf_counter()
+            results = []
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                i = 0
+                while i < len(rows):
+                    sql = rows[i][0]
+                    if callable(sql):               # WRITER.call(): params is the result box
+                        results.append((rows[i][1], self._call(conn, sql)))
+                        i += 1
+                        continue
+                    j = i
+                    while j < len(rows) and rows[j][0] == sql:
+                        j += 1
+                    conn.executemany(sql, [r[1] for r in rows[i:j]])
+                    i = j
+                conn.execute("COMMIT")
+                self._committed(rows, results, t0)
+                return
+            except sqlite3.Error as e:
+                try: conn.execute("ROLLBACK")
+                except sqlite3.Error: pass
+                if not db_locked(e):
+                    # one bad row (constraint, type...): don't take the rest of the batch down with it
+                    print("Error writing message log batch, retrying row by row:", e)
+                    self._commit_rows(conn, rows)
+                    return
+                # "database is locked" from another worker: back off and retry the whole batch
+                if attempt == 4:
+                    self.stats["errors"] += 1
+                    print("Error writing message log batch:", e)
+                    return
+                time.sleep(0.05 * (2 ** attempt))
+
+    def _commit_rows(self, conn: sqlite3.Connection, rows: list[tuple[str, tuple, str, float]]):
+        """The batch again, each row in its own savepoint; rows that fail are dropped and logged."""
+        for attempt in range(5):
+            t0 = time.perf_counter()
+            results, dropped = [], 0
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                for sql, params, kind, _ in rows:
+                    if callable(sql):
+                        results.append((params, self._call(conn, sql)))
+                        continue
+                    conn.execute("SAVEPOINT writer_row")
+                    try:
+                        conn.execute(sql, params)
+                    except sqlite3.Error as e:
+                        if db_locked(e):
+                            raise
+                        conn.execute("ROLLBACK TO writer_row")
+                        dropped += 1
+                        print(f"Dropped {kind} row: {e}")
+                    conn.execute("RELEASE writer_row")
+                conn.execute("COMMIT")
+                self.stats["dropped"] += dropped
+                self._committed(rows, results, t0)
+                return
+            except sqlite3.Error as e:
+                try: conn.execute("ROLLBACK")
+                except sqlite3.Error: pass
+                if attempt == 4 or not db_locked(e):
+                    self.stats["errors"] += 1
+                    print("Error writing message log batch:", e)
+                    return
+                time.sleep(0.05 * (2 ** attempt))
+
+    def _committed(self, rows: list[tuple[str, tuple, str, float]], results: list, t0: float):
+        for box, (key, value) in results:
+            box[key] = value
+        self.stats["rows"] += len(rows)
+        self.stats["batches"] += 1
+        done = time.perf_counter()
+        METRICS.observe("db_commit_seconds", done - t0)
+        for _, _, kind, queued in rows:
+            METRICS.observe("db_write_seconds", done - queued, (("kind", kind),))
+
+    @staticmethod
+    def _call(conn: sqlite3.Connection, fn) -> tuple[str, object]:
+        # a failing call is rolled back on its own; the rest of the batch still commits
+        conn.execute("SAVEPOINT writer_call")
+        try:
+            result = ("result", fn(conn))
+        except Exception as e:
+            if isinstance(e, sqlite3.Error) and db_locked(e):
+                raise
+            conn.execute("ROLLBACK TO writer_call")
+            result = ("error", e)
+        conn.execute("RELEASE writer_call")
+        return result
+
+WRITER = DBWriter(DB_FILE, LOG_BATCH_SIZE, LOG_FLUSH_MS)
+
+def pack_payload(payload: dict, direction: str) -> tuple[str, bytes]:
+    """(content hash, compressed body). Outbound copies drop 'to' so identical menus dedupe."""
+    if direction == "out" and "to" in payload:
+        payload = {k: v for k, v in payload.items() if k != "to"}
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return hashlib.sha1(raw).hexdigest(), zlib.compress(raw, 6)
+
+def unpack_payload(body: bytes) -> dict:
+    return json.loads(zlib.decompress(body))
+
+# Hashes this process already wrote; repeat menus skip compression and the payload insert
+_PAYLOADS_WRITTEN: OrderedDict[str, None] = OrderedDict()
+
+def log_message(wa_id: str, direction: str, mtype: str, text: str, payload: dict | None = None,
+                wamid: str | None = None, delivery: str | None = None, number: str | None = None):
+    # Never touches disk on the caller's thread; WRITER commits in batches
+    h = None
+    if payload:
+        h, body = pack_payload(payload, direction)
+        if h not in _PAYLOADS_WRITTEN:
+            WRITER.submit("INSERT OR IGNORE INTO payloads (hash, body) VALUES (?, ?)", (h, body), "payload")
+            _PAYLOADS_WRITTEN[h] = None
+            if len(_PAYLOADS_WRITTEN) > 4096:
+                _PAYLOADS_WRITTEN.popitem(last=False)
+    WRITER.submit(
+        "INSERT INTO messages (phone_number_id, wa_id, direction, mtype, text, ts, payload_hash, wamid, delivery) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (number or current_line().id, wa_id, direction, mtype, text, datetime.now().isoformat(timespec="seconds"),
+         h, wamid, delivery),
+        "message"
+    )
+
+def response_wamid(code: int, resp: str) -> str | None:
+    """Graph message id from a successful /messages response; status callbacks refer to it."""
+    if not 200 <= code < 300:
+        return None
+    try: return json.loads(resp)["messages"][0]["id"]
+    except (ValueError, KeyError, IndexError, TypeError): return None
+
+STATUS_INSERT_SQL = ("INSERT OR IGNORE INTO statuses (wamid, status, ts, recipient, error_code, error_title, "
+                     "phone_number_id) VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+def record_statuses(statuses: list[dict], number: str):
+    # Fast path: no lookups on the webhook thread, rows ride WRITER's next batch
+    for st in statuses:
+        wamid, status = st.get("id"), st.get("status")
+        if not wamid or not status:
+            continue
+        err = (st.get("errors") or [{}])[0]
+        try: ts = int(st.get("timestamp") or 0) or int(time.time())
+        except ValueError: ts = int(time.time())
+        WRITER.submit(STATUS_INSERT_SQL, (wamid, status, ts, st.get("recipient_id"), err.get("code"),
+                                          err.get("title") or err.get("message"), number), "status")
+
+def message_payload(conn: sqlite3.Connection, message_id: int) -> dict | None:
+    row = conn.execute(
+        "SELECT p.body FROM messages m JOIN payloads p ON p.hash = m.payload_hash WHERE m.id = ?", (message_id,)
+    ).fetchone()
+    return unpack_payload(row[0]) if row else None
+
+# ----------------- Archival (old months -> archive/chat-YYYY-MM.db) -----------------
+def archive_files() -> list[str]:
+    """Archive databases, newest month first."""
+    return sorted(glob.glob(os.path.join(ARCHIVE_DIR, "chat-????-??.db")), reverse=True)
+
+def open_archive(path: str) -> sqlite3.Connection:
+    # read-only: lookups can never modify an archive
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True, timeout=5)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def archive_before(cutoff_month: str) -> list[tuple[str, int]]:
+    """
+    Move every month strictly before cutoff_month ('YYYY-MM') out of chat.db
+    into ARCHIVE_DIR/chat-YYYY-MM.db (messages + the payloads they use), one
+    transaction per month. Re-running for a month appends to its file.
+    Returns [(month, rows moved)]. The conversations summary keeps its totals.
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    WRITER.flush()
+    moved = []
+    conn = sqlite3.connect(DB_FILE, timeout=30, isolation_level=None)
+    try:
+        months = [r[0] for r in conn.execute(
+            "SELECT DISTINCT substr(ts, 1, 7) FROM messages WHERE ts < ? ORDER BY 1", (cutoff_month,)
+        )]
+        live = [(r[1], r[2]) for r in conn.execute("PRAGMA main.table_info(messages)")]
+        cols = ", ".join(name for name, _ in live)
+        for month in months:
+            path = os.path.join(ARCHIVE_DIR, f"chat-{month}.db")
+            conn.execute("ATTACH DATABASE ? AS arc", (path,))
+            try:
+                conn.executescript("""
+                CREATE TABLE IF NOT EXISTS arc.messages (
+                    id INTEGER PRIMARY KEY, wa_id TEXT NOT NULL, direction TEXT NOT NULL, mtype TEXT,
+                    text TEXT, ts TEXT NOT NULL, payload TEXT, payload_hash TEXT, phone_number_id TEXT
+                );
+                CREATE INDEX IF NOT EXISTS arc.idx_messages_wa_ts ON messages(wa_id, ts, id);
+                CREATE TABLE IF NOT EXISTS arc.payloads (hash TEXT PRIMARY KEY, body BLOB NOT NULL) WITHOUT ROWID;
+                """)
+                # every column chat.db has (wamid, delivery, ...), also in archives made before it was added
+                have = {r[1] for r in conn.execute("PRAGMA arc.table_info(messages)")}
+                for name, decl in live:
+                    if name not in have:
+                        conn.execute(f"ALTER TABLE arc.messages ADD COLUMN {name} {decl}")
+                conn.execute("CREATE INDEX IF NOT EXISTS arc.idx_messages_wamid ON messages(wamid)")
+                lo, hi = f"{month}-", f"{month}-~"     # every ISO ts in that month sorts between these
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("""
+                    INSERT OR IGNORE INTO arc.payloads (hash, body)
+                    SELECT DISTINCT p.hash, p.body FROM main.messages m JOIN main.payloads p ON p.hash = m.payload_hash
+                    WHERE m.ts >= ? AND m.ts < ?""", (lo, hi))
+                conn.execute(f"""
+                    INSERT OR IGNORE INTO arc.messages ({cols}) SELECT {cols} FROM main.messages
+                    WHERE ts >= ? AND ts < ?""", (lo, hi))
+                n = conn.execute("DELETE FROM main.messages WHERE ts >= ? AND ts < ?", (lo, hi)).rowcount
+                # payloads nobody in chat.db points at any more
+                conn.execute("""
+                    DELETE FROM main.payloads WHERE NOT EXISTS
+                        (SELECT 1 FROM main.messages m WHERE m.payload_hash = payloads.hash)""")
+                conn.execute("COMMIT")
+                moved.append((month, n))
+            except BaseException:
+                if conn.in_transaction: conn.execute("ROLLBACK")
+                raise
+            finally:
+                conn.execute("DETACH DATABASE arc")
+        # raw status callbacks and funnel events for those months aren't needed once rolled up;
+        # the cutoff is local midnight, the same clock as messages.ts and the rollup day buckets
+        cutoff = conn.execute("SELECT CAST(strftime('%s', ?, 'utc') AS INTEGER)", (cutoff_month + "-01",)).fetchone()[0]
+        conn.execute("DELETE FROM funnel_events WHERE ts < ?", (cutoff,))
+        conn.execute("DELETE FROM statuses WHERE ts < ?", (cutoff,))
+        # given-up outbox rows whose message just moved out
+        conn.execute("DELETE FROM outbox WHERE state = 'failed' AND created_at < ?", (cutoff,))
+    finally:
+        conn.close()
+    _PAYLOADS_WRITTEN.clear()
+    return moved
+
+# ----------------- Graph API client (pooled + rate limited) -----------------
+class TokenBucket:
+    """Classic token bucket; reserve() hands out a token and says how long to wait for it."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        # Full again -> safe to forget
+        with self._lock:
+            return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+# Graph error codes that mean "slow down" even when the HTTP status isn't 429
+GRAPH_THROTTLE_CODES = {4, 80007, 130429, 131048, 131056}
+
+def graph_throttled(code: int, resp: str) -> bool:
+    if code == 429:
+        return True
+    if code < 400:
+        return False
+    try: return json.loads(resp).get("error", {}).get("code") in GRAPH_THROTTLE_CODES
+    except (ValueError, AttributeError): return False
+
+class GraphClient:
+    """
+    Keep-alive HTTP sessions (one per sending thread) with headers built once,
+    a token bucket for the phone number's throughput limit, one bucket per
+    recipient for the pair rate limit, and 429/Retry-After aware retries
+    with jittered exponential backoff.
+    """
+    def __init__(self, messages_url: str, token: str, mps: float, pair_rate: float, pair_burst: float,
+                 timeout: float = 30, max_retries: int = 4, backoff_base: float = 0.5, backoff_cap: float = 30.0,
+                 connect_timeout: float = 3):
+        self.messages_url = messages_url
+        self.media_url = messages_url.rsplit("/", 1)[0] + "/media"
+        self.headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.number_bucket = TokenBucket(mps, max(1.0, mps))
+        self.pair_rate = pair_rate
+        self.pair_burst = pair_burst
+        self._pairs: dict[str, TokenBucket] = {}
+        self._pairs_lock = threading.Lock()
+        self._local = threading.local()
+        self.stats = {"requests": 0, "throttled": 0, "retries": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+
+    def count(self, key: str):
+        # lane threads, media uploads and serve_async's loop all count into the same stats
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _session(self) -> requests.Session:
+        s = getattr(self._local, "session", None)
+        if s is None or getattr(self._local, "pid", None) != os.getpid():
+            s = requests.Session()
+            s.headers.update(self.headers)
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+            s.mount("https://", adapter)
+            s.mount("http://", adapter)
+            self._local.session, self._local.pid = s, os.getpid()
+        return s
+
+    def _pair(self, wa_id: str) -> TokenBucket:
+        with self._pairs_lock:
+            b = self._pairs.get(wa_id)
+            if b is None:
+                if len(self._pairs) > 10000:
+                    self._pairs = {k: v for k, v in self._pairs.items() if not v.idle()}
+                b = self._pairs[wa_id] = TokenBucket(self.pair_rate, self.pair_burst)
+            return b
+
+    def _backoff(self, attempt: int, retry_after: str | None) -> float:
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * (2 ** attempt)))
+        if retry_after:
+            try: delay = max(delay, float(retry_after))
+            except ValueError: pass
+        return delay
+
+    def post(self, url: str, payload: dict, to: str | None = None, max_retries: int | None = None,
+             files: dict | None = None):
+        """POST JSON (or multipart form + files) with rate limiting + retries. Returns (status_code, body_text)."""
+        attempt = 0
+        max_retries = self.max_retries if max_retries is None else max_retries
+        # None drops the session's JSON Content-Type so requests sets the multipart boundary
+        body = {"data": payload, "files": files, "headers": {"Content-Type": None}} if files else {"json": payload}
+        while True:
+            wait = self.number_bucket.reserve()
+            if to:
+                wait = max(wait, self._pair(to).reserve())
+            if wait > 0:
+                time.sleep(wait)
+            self.count("requests")
+            try:
+                r = self._session().post(url, timeout=(self.connect_timeout, self.timeout), **body)
+            except requests.RequestException as e:
+                self.count("errors")
+                if attempt >= max_retries:
+                    return 0, str(e)
+                time.sleep(self._backoff(attempt, None))
+                attempt += 1
+                self.count("retries")
+                continue
+            if (graph_throttled(r.status_code, r.text) or r.status_code >= 500) and attempt < max_retries:
+                if r.status_code < 500:
+                    self.count("throttled")
+                time.sleep(self._backoff(attempt, r.headers.get("Retry-After")))
+                attempt += 1
+                self.count("retries")
+                continue
+            return r.status_code, r.text
+
+    def send_message(self, payload: dict, max_retries: int | None = None):
+        return self.post(self.messages_url, payload, to=payload.get("to"), max_retries=max_retries)
+
+    def upload_media(self, data: bytes, mime: str, filename: str):
+        """Upload one file to the number's /media endpoint; the reply is {"id": "<media id>"}."""
+        return self.post(self.media_url, {"messaging_product": "whatsapp", "type": mime},
+                         files={"file": (filename, data, mime)})
+
+GRAPH = GraphClient(GRAPH_URL, WHATSAPP_TOKEN, GRAPH_MPS, GRAPH_PAIR_RATE, GRAPH_PAIR_BURST,
+                    timeout=GRAPH_TIMEOUT, max_retries=GRAPH_MAX_RETRIES, connect_timeout=GRAPH_CONNECT_TIMEOUT)
 
 # ----------------- WhatsApp send helpers (auto-log OUTBOUND) -----------------
-def wa_send(payload: dict):
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
-    r = requests.post(GRAPH_URL, headers=headers, json=payload, timeout=30)
+def wa_send(payload: dict, max_retries: int | None = None, line: "Line | None" = None):
+    t0 = time.perf_counter()
+    code, text = (line or current_line()).graph.send_message(payload, max_retries)
+    METRICS.observe("graph_send_seconds", time.perf_counter() - t0, (("status", str(code)),))
     if DEBUG:
         try: print("->", json.dumps(payload, ensure_ascii=False))
         except Exception: print("->", payload)
-        print("<-", r.status_code, r.text)
-    return r.status_code, r.text
+        print("<-", code, text)
+    return code, text
+
+# ----------------- Durable outbox (record first, deliver with retries) -----------------
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive Graph outages (no response or 5xx).
+    While open, sends are not attempted at all: outbox rows are pushed back
+    instead of every lane waiting out GRAPH_TIMEOUT. After `cooldown` one send
+    is let through as a probe; its result closes or re-opens the circuit.
+    A probe that never reaches Graph must be handed back with release().
+    """
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self.stats = {"opened": 0, "short_circuited": 0}
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self._probing = True
+                return True
+            self.stats["short_circuited"] += 1
+            return False
+
+    def release(self):
+        """An allowed send was dropped before Graph answered: let the next one probe."""
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok: bool):
+        with self._lock:
+            if ok:
+                if self.opened_at is not None:
+                    print("[graph] circuit closed")
+                self.failures, self.opened_at, self._probing = 0, None, False
+                return
+            self.failures += 1
+            if self._probing or (self.opened_at is None and self.failures >= self.threshold):
+                if self.opened_at is None:
+                    self.stats["opened"] += 1
+                    print(f"[graph] circuit open after {self.failures} failed sends; probing again in {self.cooldown:.0f}s")
+                self.opened_at, self._probing = time.monotonic(), False
+
+    def retry_in(self) -> float:
+        """Seconds until a send is worth trying again (0 while closed)."""
+        with self._lock:
+            if self.opened_at is None:
+                return 0.0
+            return max(1.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+    def state(self) -> str:
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            if self._probing or time.monotonic() - self.opened_at >= self.cooldown:
+                return "half-open"
+            return "open"
+
+BREAKER = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN_SEC)
+
+def graph_outage(code: int) -> bool:
+    # what counts against the breaker: no answer at all, or Graph itself failing
+    return code == 0 or code >= 500
+
+HOSTNAME = socket.gethostname()
+
+def outbox_owner() -> str:
+    return f"{HOSTNAME}:{os.getpid()}"
+
+def outbox_lease() -> str:
+    # owner plus a token per claim: a row this process re-claims while the old job is
+    # still queued in a lane gets a new lease, and the old job finds it lost
+    return f"{outbox_owner()}:{random.getrandbits(32):08x}"
+
+def outbox_record(jobs: list["SendJob"]):
+    """
+    Write the replies to messages (delivery='queued') and to the outbox,
+    leased to this process, with one WRITER.call for the whole list. It
+    commits after the inbound rows they answer; once it returns, a crash can
+    no longer lose them.
+    """
+    rows = [(job, *pack_payload(job.payload, "out")) for job in jobs]
+    ts = datetime.now().isoformat(timespec="seconds")
+    lease = outbox_lease()
+
+    def write(conn: sqlite3.Connection):
+        ids = []
+        for job, h, body in rows:
+            conn.execute("INSERT OR IGNORE INTO payloads (hash, body) VALUES (?, ?)", (h, body))
+            mid = conn.execute(
+                "INSERT INTO messages (phone_number_id, wa_id, direction, mtype, text, ts, payload_hash, delivery) "
+                "VALUES (?, ?, 'out', ?, ?, ?, ?, 'queued')", (job.line.id, job.to, job.mtype, job.log_text, ts, h)).lastrowid
+            now = time.time()
+            oid = conn.execute(
+                "INSERT INTO outbox (phone_number_id, message_id, wa_id, state, due_at, lease_owner, created_at) "
+                "VALUES (?, ?, ?, 'sending', ?, ?, ?)", (job.line.id, mid, job.to, now + OUTBOX_LEASE_SEC, lease, now)).lastrowid
+            ids.append((mid, oid, now))
+        return ids
+
+    for job, (mid, oid, created_at) in zip(jobs, WRITER.call(write, "outbox")):
+        job.message_id, job.outbox_id, job.created_at, job.lease = mid, oid, created_at, lease
+        job.claimed_at = time.monotonic()
+
+def outbox_tx(*statements: tuple[str, tuple]) -> int:
+    """Run a few statements as one transaction on this thread's connection; rowcount of the first."""
+    conn = local_db()
+    for attempt in range(5):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            first = None
+            for sql, params in statements:
+                n = conn.execute(sql, params).rowcount
+                first = n if first is None else first
+            conn.execute("COMMIT")
+            return first or 0
+        except sqlite3.OperationalError:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            if attempt == 4:
+                raise
+            time.sleep(0.05 * (2 ** attempt))
+    return 0
 
-def send_text(to_wa_id: str, text: str):
+def outbox_defer(job: "SendJob", until: float, reason: str):
+    # not an attempt: Graph was never asked, so attempts stay as they are
+    outbox_tx(("UPDATE outbox SET state = 'pending', due_at = ?, lease_owner = NULL, last_error = ? "
+               "WHERE id = ? AND state = 'sending' AND lease_owner = ?", (until, reason, job.outbox_id, job.lease)))
+    METRICS.inc("outbound_sent_total", (("result", "deferred"),))
+
+def outbox_ready(job: "SendJob") -> str | None:
+    """None if the job may be sent now, else why not ('deferred' / 'lost'); deferral is recorded."""
+    now = time.time()
+    if time.monotonic() - job.claimed_at > OUTBOX_LEASE_SEC / 2:
+        # sat in a lane for a while: extend the lease, or drop the job if another worker took it over
+        if not outbox_tx(("UPDATE outbox SET due_at = ? WHERE id = ? AND state = 'sending' AND lease_owner = ?",
+                          (now + OUTBOX_LEASE_SEC, job.outbox_id, job.lease))):
+            return "lost"
+        job.claimed_at = time.monotonic()
+    # an earlier reply to this user is waiting for a retry (on any worker): keep the order, wait behind it
+    blocked = local_db().execute(
+        "SELECT max(due_at) FROM outbox WHERE wa_id = ? AND phone_number_id = ? AND state = 'pending' AND id < ?",
+        (job.to, job.line.id, job.outbox_id)).fetchone()[0]
+    if blocked is not None:
+        outbox_defer(job, max(blocked, now + OUTBOX_POLL_SEC), "waiting for an earlier message")
+        return "deferred"
+    # last: once allowed, a half-open breaker waits for this send's outbox_finish() (or release())
+    if not BREAKER.allow():
+        outbox_defer(job, now + BREAKER.retry_in(), "circuit open")
+        return "deferred"
+    return None
+
+def outbox_finish(job: "SendJob", code: int, resp: str) -> str:
+    """Record one Graph attempt: 'sent', 'retry' (backed off) or 'failed' (given up)."""
+    BREAKER.record(not graph_outage(code))
+    now = time.time()
+    if 200 <= code < 300:
+        outbox_tx(("DELETE FROM outbox WHERE id = ?", (job.outbox_id,)),
+                  ("UPDATE messages SET delivery = 'sent', wamid = ? WHERE id = ?",
+                   (response_wamid(code, resp), job.message_id)))
+        result = "sent"
+    elif ((graph_outage(code) or graph_throttled(code, resp)) and job.attempts + 1 < OUTBOX_MAX_ATTEMPTS
+          and now - job.created_at < OUTBOX_MAX_AGE_SEC):
+        delay = min(OUTBOX_BACKOFF_CAP, 2.0 * 2 ** job.attempts) * random.uniform(0.5, 1.0)
+        due = now + max(delay, BREAKER.retry_in())
+        outbox_tx(("UPDATE outbox SET state = 'pending', attempts = attempts + 1, due_at = ?, lease_owner = NULL, "
+                   "last_error = ? WHERE id = ?", (due, f"{code} {resp[:200]}", job.outbox_id)),
+                  ("UPDATE messages SET delivery = 'retrying' WHERE id = ?", (job.message_id,)))
+        result = "retry"
+    else:
+        outbox_tx(("UPDATE outbox SET state = 'failed', attempts = attempts + 1, lease_owner = NULL, last_error = ? "
+                   "WHERE id = ?", (f"{code} {resp[:200]}", job.outbox_id)),
+                  ("UPDATE messages SET delivery = 'failed' WHERE id = ?", (job.message_id,)))
+        result = "failed"
+    METRICS.inc("outbound_sent_total", (("result", result),))
+    return result
+
+def outbox_deliver(job: "SendJob") -> str:
+    """One delivery attempt on a lane thread (sync server)."""
+    skip = outbox_ready(job)
+    if skip:
+        return skip
+    try:
+        code, resp = wa_send(job.payload, OUTBOX_INLINE_RETRIES, job.line)
+    except BaseException:
+        BREAKER.release()       # never reached outbox_finish(): don't leave a half-open probe hanging
+        raise
+    job.result = (code, resp)
+    return outbox_finish(job, code, resp)
+
+def outbox_claim(limit: int = 200) -> list["SendJob"]:
+    """
+    Lease due rows — retries whose backoff is over, and rows a dead worker
+    left 'sending' — to this process and rebuild their jobs from the log.
+    A reply interrupted mid-request may reach the user twice; losing it
+    would be worse. Rows for a number no longer in LINES are given up on.
+    """
+    conn = local_db()
+    now = time.time()
+    lease = outbox_lease()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("""
+            SELECT o.id, o.message_id, o.wa_id, o.attempts, o.created_at, m.mtype, m.text, p.body, o.phone_number_id
+            FROM outbox o JOIN messages m ON m.id = o.message_id LEFT JOIN payloads p ON p.hash = m.payload_hash
+            WHERE o.state IN ('pending', 'sending') AND o.due_at <= ?
+            ORDER BY o.id LIMIT ?""", (now, limit)).fetchall()
+        conn.executemany("UPDATE outbox SET state = 'sending', due_at = ?, lease_owner = ? WHERE id = ?",
+                         [(now + OUTBOX_LEASE_SEC, lease, r[0]) for r in rows if r[7] is not None and r[8] in LINES])
+        conn.executemany("UPDATE outbox SET state = 'failed', last_error = 'payload missing' WHERE id = ?",
+                         [(r[0],) for r in rows if r[7] is None])
+        conn.executemany("UPDATE outbox SET state = 'failed', last_error = 'number not configured' WHERE id = ?",
+                         [(r[0],) for r in rows if r[7] is not None and r[8] not in LINES])
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        raise
+    jobs = []
+    for oid, mid, wa_id, attempts, created_at, mtype, text, body, number in rows:
+        if body is None or number not in LINES:
+            continue
+        job = SendJob(wa_id, {**unpack_payload(body), "to": wa_id}, mtype, text, LINES[number])
+        job.outbox_id, job.message_id, job.attempts, job.created_at = oid, mid, attempts, created_at
+        job.lease, job.claimed_at = lease, time.monotonic()
+        jobs.append(job)
+    return jobs
+
+def outbox_release_dead():
+    """Rows leased by a process on this host that has died are due now, not when the lease runs out."""
+    conn = local_db()
+    owners = [r[0] for r in conn.execute(
+        "SELECT DISTINCT lease_owner FROM outbox WHERE state IN ('pending', 'sending') AND lease_owner LIKE ?",
+        (HOSTNAME + ":%",))]
+    dead = [o for o in owners if not pid_alive(int(o.split(":")[1]))]     # host:pid[:claim token]
+    if dead:
+        outbox_tx(*[("UPDATE outbox SET due_at = 0 WHERE state = 'sending' AND lease_owner = ?", (o,)) for o in dead])
+
+class OutboxPoller:
+    """Feeds due outbox rows to the send lanes of the number each was sent from."""
+    def __init__(self, poll_sec: float):
+        self.poll_sec = poll_sec
+        self._lock = threading.Lock()
+        self._pid = None
+        self.stats = {"claimed": 0}
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="outbox-poller", daemon=True).start()
+
+    def stop(self):
+        # rows already claimed keep their lease; the next worker picks them up after it
+        self._pid = None
+
+    def _run(self):
+        pid = os.getpid()
+        last_sweep = 0.0
+        while self._pid == pid:
+            try:
+                if time.monotonic() - last_sweep > 15:
+                    outbox_release_dead()
+                    last_sweep = time.monotonic()
+                jobs = outbox_claim()
+                self.stats["claimed"] += len(jobs)
+                for job in jobs:
+                    job.line.outbound.submit(job)
+                if len(jobs) < 200:
+                    time.sleep(self.poll_sec)
+            except Exception as e:
+                print("Error in outbox poller:", e)
+                time.sleep(self.poll_sec)
+
+OUTBOX = OutboxPoller(OUTBOX_POLL_SEC)
+
+def outbox_backlog() -> int:
+    return local_db().execute("SELECT count(*) FROM outbox WHERE state IN ('pending', 'sending')").fetchone()[0]
+
+METRICS.gauge("outbox_backlog", outbox_backlog, shared=True)
+METRICS.gauge("graph_circuit_open", lambda: int(BREAKER.state() == "open"))
+
+# ----------------- Outbound dispatcher (background send lanes) -----------------
+class SendJob:
+    """One outbound message: the Graph payload, its chat log line, its outbox row and the number it goes out from."""
+    __slots__ = ("to", "payload", "mtype", "log_text", "line", "enqueued_at", "result", "done",
+                 "outbox_id", "message_id", "attempts", "created_at", "claimed_at", "lease")
+
+    def __init__(self, to: str, payload: dict, mtype: str, log_text: str, line: "Line"):
+        self.to = to
+        self.line = line
+        self.payload = payload
+        self.mtype = mtype
+        self.log_text = log_text
+        self.enqueued_at = time.monotonic()
+        self.result = None
+        self.done = threading.Event()
+        self.outbox_id = self.message_id = None
+        self.attempts = 0
+        self.created_at = time.time()
+        self.claimed_at = time.monotonic()
+        self.lease = None       # outbox lease_owner while this process holds the row
+
+    def wait(self, timeout: float | None = None):
+        # (code, resp) of this attempt, None if still queued after timeout or pushed back (outbox retries it)
+        self.done.wait(timeout)
+        return self.result
+
+class OutboundDispatcher:
+    """
+    Webhook handlers record replies in the outbox, enqueue the SendJobs and
+    return; lane threads do the Graph POST. Each wa_id always maps to the same
+    lane, so one user's messages stay in order while different users are sent
+    in parallel. Failed sends go back to the outbox, which hands them out again.
+    Every number (Line) has its own dispatcher, so a busy one can't hold up the rest.
+    """
+    def __init__(self, workers: int, name: str = "outbound"):
+        self.workers = max(1, workers)
+        self.name = name
+        self._lock = threading.Lock()
+        self._pid = None
+        self._lanes: list[queue.Queue] = []
+        self._threads: list[threading.Thread] = []
+        self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "retry": 0, "deferred": 0,
+                      "send_ms_sum": 0.0, "send_ms_max": 0.0,
+                      "wait_ms_sum": 0.0, "wait_ms_max": 0.0}
+
+    def _ensure_started(self):
+        # Threads don't survive fork, so (re)start lanes in whichever process uses us first
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._lanes = [queue.Queue() for _ in range(self.workers)]
+            self._threads = []
+            for i, q in enumerate(self._lanes):
+                t = threading.Thread(target=self._run, args=(q,), name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+
+    def _lane(self, wa_id: str) -> queue.Queue:
+        return self._lanes[zlib.crc32(wa_id.encode("utf-8")) % self.workers]
+
+    def submit(self, job: SendJob) -> SendJob:
+        self._ensure_started()
+        with self._lock:
+            self.stats["enqueued"] += 1
+        self._lane(job.to).put(job)
+        return job
+
+    def _run(self, q: queue.Queue):
+        while True:
+            job = q.get()
+            if job is None:
+                return
+            try:
+                self._deliver(job)
+            except Exception as e:
+                print("Error sending to", job.to, ":", e)
+                # the outbox row keeps its lease and is picked up again once that runs out
+                job.result = (0, str(e))
+                self._count(job, "failed", send_ms=0.0)
+            finally:
+                job.done.set()
+
+    def _deliver(self, job: SendJob):
+        t0 = time.monotonic()
+        result = outbox_deliver(job)
+        self._count(job, result, send_ms=(time.monotonic() - t0) * 1000)
+
+    def _count(self, job: SendJob, result: str, send_ms: float):
+        wait_ms = (time.monotonic() - job.enqueued_at) * 1000 - send_ms
+        with self._lock:
+            st = self.stats
+            if result in st:
+                st[result] += 1
+            st["send_ms_sum"] += send_ms
+            st["send_ms_max"] = max(st["send_ms_max"], send_ms)
+            st["wait_ms_sum"] += wait_ms
+            st["wait_ms_max"] = max(st["wait_ms_max"], wait_ms)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            st = dict(self.stats)
+        done = st["sent"] + st["failed"] + st["retry"] + st["deferred"]
+        st["queue_depth"] = sum(q.qsize() for q in self._lanes) if self._pid == os.getpid() else 0
+        st["lanes"] = self.workers
+        st["send_ms_avg"] = round(st["send_ms_sum"] / done, 1) if done else 0.0
+        st["wait_ms_avg"] = round(st["wait_ms_sum"] / done, 1) if done else 0.0
+        return st
+
+    def stop(self, timeout: float = 10.0):
+        # Drain what's queued, then let the lane threads exit
+        if self._pid != os.getpid():
+            return
+        for q in self._lanes:
+            q.put(None)
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0.0, deadline - time.monotonic()))
+        self._pid = None
+
+OUTBOUND = OutboundDispatcher(OUTBOUND_WORKERS)     # PHONE_NUMBER_ID's lanes; other numbers get their own (Lines)
+METRICS.gauge("outbound_queue_depth", lambda: sum(ln.outbound.snapshot()["queue_depth"] for ln in LINES.values()))
+
+_REPLIES = threading.local()
+
+@contextmanager
+def reply_batch():
+    """
+    Replies sent inside the block are recorded with one WRITER.call when it
+    ends and only then handed to the send lanes, so a handler that answers
+    with several messages waits on one group commit, not one per message.
+    This is the one place the webhook waits on the writer: a reply must be
+    durable before it is sent. Normally that is at most LOG_FLUSH_MS; inbound
+    logging itself stays fire-and-forget.
+    """
+    if getattr(_REPLIES, "jobs", None) is not None:
+        yield           # nested: the outer batch records them
+        return
+    _REPLIES.jobs = []
+    try:
+        yield
+    finally:
+        jobs, _REPLIES.jobs = _REPLIES.jobs, None
+        if jobs:
+            outbox_record(jobs)
+            for job in jobs:
+                job.line.outbound.submit(job)
+
+def queue_send(to: str, payload: dict, mtype: str, log_text: str) -> SendJob:
+    # Logged (delivery='queued') and in the outbox before a lane of the serving number picks it up
+    job = SendJob(to, payload, mtype, log_text, current_line())
+    batch = getattr(_REPLIES, "jobs", None)
+    if batch is not None:
+        batch.append(job)
+        return job
+    outbox_record([job])
+    return job.line.outbound.submit(job)
+
+def send_text(to_wa_id: str, text: str) -> SendJob:
     payload = {"messaging_product": "whatsapp", "to": to_wa_id, "type": "text", "text": {"body": text}}
-    code, resp = wa_send(payload)
-    # Log outbound text
-    log_message(to_wa_id, "out", "text", text, payload)
-    return code, resp
+    return queue_send(to_wa_id, payload, "text", text)
 
-def send_buttons(to_wa_id: str, body_text: str, buttons: list[tuple[str,str]]):
+class Menu:
+    """Interactive payload + log line built once; only the recipient changes per send."""
+    __slots__ = ("mtype", "payload", "log_text")
+
+    def __init__(self, mtype: str, interactive: dict, log_text: str):
+        self.mtype = mtype
+        self.payload = {"messaging_product": "whatsapp", "type": "interactive", "interactive": interactive}
+        self.log_text = log_text
+
+    def for_recipient(self, to_wa_id: str) -> dict:
+        # shallow copy: the nested interactive dict is shared and never mutated
+        return {**self.payload, "to": to_wa_id}
+
+def buttons_menu(body_text: str, buttons: list[tuple[str,str]]) -> Menu:
     # max 3 buttons; titles ≤ 20 chars
     b = [{"type": "reply", "reply": {"id": bid, "title": title[:20]}} for bid, title in buttons[:3]]
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to_wa_id,
-        "type": "interactive",
-        "interactive": {"type": "button", "body": {"text": body_text}, "action": {"buttons": b}},
-    }
-    code, resp = wa_send(payload)
-    # Log outbound "system" describing the buttons offered
+    # Log line describes the buttons offered
     labels = " | ".join([btn["reply"]["title"] for btn in b])
-    log_message(to_wa_id, "out", "button", f"[Buttons] {body_text}  :: {labels}", payload)
-    return code, resp
-
-def send_list_menu(to_wa_id: str, header_text: str, body_text: str, rows: list[tuple[str,str]]):
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": to_wa_id,
-        "type": "interactive",
-        "interactive": {
-            "type": "list",
-            "header": {"type": "text", "text": header_text},
-            "body":   {"text": body_text},
-            "footer": {"text": "Paras Institute"},
-            "action": {
-                "button": "Open Menu",
-                "sections": [{"title": "Options", "rows": [{"id": rid, "title": title[:24]} for rid, title in rows]}],
-            },
+    return Menu("button", {"type": "button", "body": {"text": body_text}, "action": {"buttons": b}},
+                f"[Buttons] {body_text}  :: {labels}")
+
+def list_menu(header_text: str, body_text: str, rows: list[tuple[str,str]],
+              footer: str = "Paras Institute", button: str = "Open Menu") -> Menu:
+    interactive = {
+        "type": "list",
+        "header": {"type": "text", "text": header_text},
+        "body":   {"text": body_text},
+        "footer": {"text": footer},
+        "action": {
+            "button": button,
+            "sections": [{"title": "Options", "rows": [{"id": rid, "title": title[:24]} for rid, title in rows]}],
         },
     }
-    code, resp = wa_send(payload)
-    # Log outbound list menu
+    # Log line describes the list menu
     labels = " | ".join([title for _, title in rows])
-    log_message(to_wa_id, "out", "list", f"[List] {header_text} — {body_text}  :: {labels}", payload)
-    return code, resp
+    return Menu("list", interactive, f"[List] {header_text} — {body_text}  :: {labels}")
+
+def send_menu(to_wa_id: str, menu: Menu) -> SendJob:
+    return queue_send(to_wa_id, menu.for_recipient(to_wa_id), menu.mtype, menu.log_text)
+
+def send_buttons(to_wa_id: str, body_text: str, buttons: list[tuple[str,str]]) -> SendJob:
+    return send_menu(to_wa_id, buttons_menu(body_text, buttons))
+
+def send_list_menu(to_wa_id: str, header_text: str, body_text: str, rows: list[tuple[str,str]]) -> SendJob:
+    return send_menu(to_wa_id, list_menu(header_text, body_text, rows))
+
+# ----------------- Media (upload once, send by media id) -----------------
+MEDIA_MIME = {".pdf": "application/pdf", ".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png"}
+MEDIA_MAX_BYTES = {"document": 100 << 20, "image": 5 << 20}     # Cloud API limits
+
+class MediaError(Exception):
+    """A local file could not be turned into a Graph media id (missing, unsupported, upload refused)."""
+
+def media_kind(name: str) -> str:
+    return "image" if MEDIA_MIME.get(os.path.splitext(name)[1].lower(), "").startswith("image/") else "document"
+
+class MediaItem:
+    """A file from content.json, sent as a document or image; resolved to a media id at send time."""
+    __slots__ = ("file", "kind", "caption", "filename")
+
+    def __init__(self, file: str, caption: str = "", filename: str | None = None):
+        self.file = file
+        self.kind = media_kind(file)
+        self.caption = caption
+        self.filename = filename or os.path.basename(file)
+
+class MediaCache:
+    """
+    Local file -> Graph media id. Files are hashed once per (inode, mtime, size)
+    and uploaded once per content hash; the id is kept in media_cache and reused
+    by every worker until MEDIA_TTL_SEC runs out or the file changes. Uploads
+    hold a lock file, so workers starting together upload each file only once.
+    Media ids belong to the number that uploaded them: one cache per Line.
+    """
+    def __init__(self, base_dir: str, ttl: float, lock_path: str, graph: "GraphClient", number: str):
+        self.base_dir = base_dir
+        self.ttl = ttl
+        self.lock_path = lock_path
+        self.graph = graph
+        self.number = number
+        self._hashes: dict[str, tuple] = {}             # path -> (stat signature, sha256)
+        self._ids: dict[str, tuple[str, float]] = {}    # sha256 -> (media_id, expires_at)
+        self._lock = threading.Lock()
+        self.stats = {"hit": 0, "shared": 0, "upload": 0, "error": 0}
+
+    def path(self, name: str) -> str:
+        return name if os.path.isabs(name) else os.path.join(self.base_dir, name)
+
+    def _digest(self, path: str) -> tuple[str, int]:
+        st = os.stat(path)
+        sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+        known = self._hashes.get(path)
+        if known and known[0] == sig:
+            return known[1], st.st_size
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        self._hashes[path] = (sig, h.hexdigest())
+        return h.hexdigest(), st.st_size
+
+    def _count(self, result: str):
+        self.stats[result] += 1
+        METRICS.inc("media_lookups_total", (("result", result),))
+
+    def _stored(self, sha: str) -> str | None:
+        row = local_db().execute("SELECT media_id, expires_at FROM media_cache "
+                                 "WHERE phone_number_id = ? AND sha256 = ? AND expires_at > ?",
+                                 (self.number, sha, time.time())).fetchone()
+        if row:
+            self._ids[sha] = (row[0], row[1])
+            return row[0]
+        return None
+
+    def media_id(self, name: str) -> str:
+        """Graph media id for a file under base_dir, uploading it first if needed. Raises MediaError."""
+        path = self.path(name)
+        mime = MEDIA_MIME.get(os.path.splitext(name)[1].lower())
+        if not mime:
+            raise MediaError(f"{name}: unsupported file type")
+        try:
+            sha, size = self._digest(path)
+        except OSError as e:
+            raise MediaError(f"{name}: {e.strerror or e}")
+        known = self._ids.get(sha)
+        if known and known[1] > time.time():
+            self._count("hit")
+            return known[0]
+        mid = self._stored(sha)
+        if mid:
+            self._count("shared")
+            return mid
+        with self._lock:
+            lock_f = open(self.lock_path, "a+")
+            try:
+                if fcntl: fcntl.flock(lock_f, fcntl.LOCK_EX)
+                mid = self._stored(sha)      # another thread or worker may have just uploaded it
+                if mid:
+                    self._count("shared")
+                    return mid
+                return self._upload(name, path, sha, size, mime)
+            finally:
+                if fcntl: fcntl.flock(lock_f, fcntl.LOCK_UN)
+                lock_f.close()
+
+    def _upload(self, name: str, path: str, sha: str, size: int, mime: str) -> str:
+        if size > MEDIA_MAX_BYTES[media_kind(name)]:
+            self._count("error")
+            raise MediaError(f"{name}: {size} bytes is over the {media_kind(name)} limit")
+        with open(path, "rb") as f:
+            data = f.read()
+        t0 = time.perf_counter()
+        code, resp = self.graph.upload_media(data, mime, os.path.basename(path))
+        METRICS.observe("graph_upload_seconds", time.perf_counter() - t0, (("status", str(code)),))
+        try: mid = json.loads(resp).get("id") if 200 <= code < 300 else None
+        except (ValueError, AttributeError): mid = None
+        if not mid:
+            self._count("error")
+            raise MediaError(f"{name}: upload failed ({code} {resp[:200]})")
+        now = time.time()
+        local_db().execute("DELETE FROM media_cache WHERE expires_at <= ?", (now,))
+        local_db().execute("INSERT OR REPLACE INTO media_cache (phone_number_id, sha256, media_id, mime, size, path, "
+                           "uploaded_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           (self.number, sha, mid, mime, size, name, now, now + self.ttl))
+        self._ids[sha] = (mid, now + self.ttl)
+        self._count("upload")
+        print(f"[MEDIA] uploaded {name} ({size} bytes) for {self.number} -> {mid}")
+        return mid
+
+    def warm(self, names):
+        """Resolve these files in the background, so the first lead doesn't wait for an upload."""
+        def run():
+            for name in names:
+                try: self.media_id(name)
+                except MediaError as e: print("[MEDIA]", e)
+        if names:
+            threading.Thread(target=run, name="media-warm", daemon=True).start()
+
+MEDIA = MediaCache(MEDIA_DIR, MEDIA_TTL_SEC, DB_FILE + ".media.lock", GRAPH, PHONE_NUMBER_ID)
+
+def send_document(to_wa_id: str, name: str, caption: str = "", filename: str | None = None) -> SendJob:
+    """Send a file from MEDIA_DIR as a document by media id (uploaded on first use). Raises MediaError."""
+    doc = {"id": current_line().media.media_id(name), "filename": filename or os.path.basename(name)}
+    if caption: doc["caption"] = caption
+    payload = {"messaging_product": "whatsapp", "to": to_wa_id, "type": "document", "document": doc}
+    log_text = f"[Document] {doc['filename']}" + (f" — {caption}" if caption else "")
+    return queue_send(to_wa_id, payload, "document", log_text)
+
+def send_image(to_wa_id: str, name: str, caption: str = "") -> SendJob:
+    """Send an image from MEDIA_DIR by media id (uploaded on first use). Raises MediaError."""
+    image = {"id": current_line().media.media_id(name)}
+    if caption: image["caption"] = caption
+    payload = {"messaging_product": "whatsapp", "to": to_wa_id, "type": "image", "image": image}
+    log_text = f"[Image] {os.path.basename(name)}" + (f" — {caption}" if caption else "")
+    return queue_send(to_wa_id, payload, "image", log_text)
+
+def send_media(to_wa_id: str, item: MediaItem) -> SendJob:
+    if item.kind == "image":
+        return send_image(to_wa_id, item.file, item.caption)
+    return send_document(to_wa_id, item.file, item.caption, item.filename)
+
+# ----------------- Content catalogue (content.json, hot reloadable) -----------------
+BUTTON_TITLE_MAX = 20
+LIST_TITLE_MAX = 24
+BODY_MAX = 1024
+MENU_KEYS = ("main_menu", "know_menu", "course_menu", "attempt_menu", "group_menu", "mode_menu")
+
+class Catalogue:
+    """
+    Immutable snapshot of content.json with everything pre-rendered: menu
+    payloads, every reply text, and the button routes. Handlers grab
+    CONTENT.current once per message and only do dict lookups on it.
+    """
+    __slots__ = ("menus", "list_replies", "features", "messages", "greetings", "routes", "course_by_key", "loaded_at")
+
+    def __init__(self, data: dict, media_dirs: tuple[str, ...]):
+        errors = validate_catalogue(data, media_dirs)
+        if errors:
+            raise ValueError("content catalogue invalid:\n  " + "\n  ".join(errors))
+
+        def opts(key):
+            return [(o["id"], o["title"]) for o in data[key]["options"]]
+
+        know = data["know_menu"]
+        self.menus = MappingProxyType({
+            "main":    buttons_menu(data["main_menu"]["body"], opts("main_menu")),
+            "know":    list_menu(know["header"], know["body"], [(r["id"], r["title"]) for r in know["rows"]],
+                                 footer=data.get("footer", "Paras Institute"), button=know.get("button", "Open Menu")),
+            "course":  buttons_menu(data["course_menu"]["body"], opts("course_menu")),
+            "attempt": buttons_menu(data["attempt_menu"]["body"], opts("attempt_menu")),
+            "group":   buttons_menu(data["group_menu"]["body"], opts("group_menu")),
+            "mode":    buttons_menu(data["mode_menu"]["body"], opts("mode_menu")),
+        })
+        self.list_replies = MappingProxyType({
+            r["id"]: r["heading"] + "\n" + "\n".join(f"• {x}" for x in r["bullets"]) for r in know["rows"]
+        })
+        self.features = MappingProxyType({o["value"]: "\n".join(o["features"]) for o in data["mode_menu"]["options"]})
+        self.messages = MappingProxyType(dict(data["messages"]))
+        self.greetings = frozenset(g.lower() for g in data["greetings"])
+
+        courses = {o["value"]: MappingProxyType({
+            "course": o["value"],
+            "needs_group": bool(o.get("needs_group")),
+            "attempt_info": MappingProxyType(dict(o.get("attempt_info", {}))),
+            "documents": tuple(MediaItem(d["file"], d.get("caption", ""), d.get("filename"))
+                               for d in o.get("documents", [])),
+        }) for o in data["course_menu"]["options"]}
+        self.course_by_key = MappingProxyType(courses)
+        self.routes = MappingProxyType({
+            "KNOW":  (on_know, None),
+            "COACH": (on_coach, None),
+            **{o["id"]: (on_course, courses[o["value"]]) for o in data["course_menu"]["options"]},
+            **{o["id"]: (on_attempt, o["value"]) for o in data["attempt_menu"]["options"]},
+            **{o["id"]: (on_group, o["value"]) for o in data["group_menu"]["options"]},
+            **{o["id"]: (on_mode, o["value"]) for o in data["mode_menu"]["options"]},
+        })
+        self.loaded_at = datetime.now().isoformat(timespec="seconds")
+
+    def features_for(self, mode_label: str) -> str:
+        return self.features.get(mode_label) or self.messages["features_fallback"].format(mode=mode_label)
+
+    def media_files(self) -> list[str]:
+        return sorted({d.file for c in self.course_by_key.values() for d in c["documents"]})
+
+def media_problems(where: str, docs, media_dirs: tuple[str, ...]) -> list[str]:
+    if not isinstance(docs, list):
+        return [f"{where}.documents: must be a list"]
+    errors = []
+    for d in docs:
+        name = d.get("file") if isinstance(d, dict) else None
+        if not name or not isinstance(name, str):
+            errors.append(f"{where}.documents: every entry needs a file")
+            continue
+        if os.path.splitext(name)[1].lower() not in MEDIA_MIME:
+            errors.append(f"{where}: {name} is not one of {', '.join(sorted(MEDIA_MIME))}")
+            continue
+        # every number serving this content sends the file from its own media dir
+        for media_dir in media_dirs:
+            try: size = os.path.getsize(name if os.path.isabs(name) else os.path.join(media_dir, name))
+            except OSError:
+                errors.append(f"{where}: {name} not found in {media_dir}/")
+                continue
+            if size > MEDIA_MAX_BYTES[media_kind(name)]:
+                errors.append(f"{where}: {name} in {media_dir}/ is {size} bytes (max {MEDIA_MAX_BYTES[media_kind(name)]})")
+        caption = d.get("caption", "")
+        if not isinstance(caption, str) or len(caption) > BODY_MAX:
+            errors.append(f"{where}: caption for {name} must be text of at most {BODY_MAX} chars")
+        if not isinstance(d.get("filename", ""), str):
+            errors.append(f"{where}: filename for {name} must be text")
+    return errors
+
+def is_text(v, max_len: int) -> bool:
+    return isinstance(v, str) and 0 < len(v) <= max_len
+
+def menu_items(data: dict, key: str) -> list[dict]:
+    """The well-formed options/rows of one menu (validate_catalogue reports the rest)."""
+    menu = data.get(key)
+    items = menu.get("rows" if key == "know_menu" else "options") if isinstance(menu, dict) else None
+    return [o for o in items if isinstance(o, dict)] if isinstance(items, list) else []
+
+def validate_catalogue(data: dict, media_dirs: tuple[str, ...]) -> list[str]:
+    """Every WhatsApp limit we rely on, checked before a catalogue can go live."""
+    if not isinstance(data, dict):
+        return ["top level: must be an object"]
+    errors = []
+    messages = data.get("messages")
+    if not isinstance(messages, dict):
+        errors.append("messages: must be an object")
+        messages = {}
+    for key in ("restart", "unknown", "nudge", "thanks", "features_fallback"):
+        if not isinstance(messages.get(key), str):
+            errors.append(f"messages.{key}: missing")
+    greetings = data.get("greetings")
+    if not greetings or not isinstance(greetings, list) or not all(isinstance(g, str) for g in greetings):
+        errors.append("greetings: must be a non-empty list of strings")
+    if not isinstance(data.get("footer", ""), str):
+        errors.append("footer: must be text")
+    seen_ids = set()
+    for key in MENU_KEYS:
+        menu = data.get(key)
+        if not isinstance(menu, dict):
+            errors.append(f"{key}: missing")
+            continue
+        is_list = key == "know_menu"
+        field = "rows" if is_list else "options"
+        items = menu.get(field) or []
+        if not isinstance(items, list):
+            errors.append(f"{key}.{field}: must be a list")
+            continue
+        limit = LIST_TITLE_MAX if is_list else BUTTON_TITLE_MAX
+        if not items:
+            errors.append(f"{key}: no options")
+        if not is_list and len(items) > 3:
+            errors.append(f"{key}: {len(items)} buttons (max 3)")
+        if is_list and len(items) > 10:
+            errors.append(f"{key}: {len(items)} rows (max 10)")
+        if not is_text(menu.get("body"), BODY_MAX):
+            errors.append(f"{key}.body: must be 1-{BODY_MAX} chars")
+        if is_list and not is_text(menu.get("header"), 60):
+            errors.append(f"{key}.header: must be 1-60 chars")
+        if is_list and not isinstance(menu.get("button", ""), str):
+            errors.append(f"{key}.button: must be text")
+        for o in items:
+            if not isinstance(o, dict):
+                errors.append(f"{key}.{field}: every entry must be an object")
+                continue
+            oid, title = o.get("id", ""), o.get("title", "")
+            if not oid or not isinstance(oid, str) or oid in seen_ids:
+                errors.append(f"{key}: missing or duplicate id {oid!r}")
+                continue
+            seen_ids.add(oid)
+            if not is_text(title, limit):
+                errors.append(f"{key}.{oid}: title {title!r} must be 1-{limit} chars")
+            if key not in ("main_menu", "know_menu") and not (o.get("value") and isinstance(o.get("value"), str)):
+                errors.append(f"{key}.{oid}: missing value")
+            if is_list and not (o.get("heading") and isinstance(o.get("heading"), str) and isinstance(o.get("bullets"), list)):
+                errors.append(f"{key}.{oid}: needs heading + bullets")
+            if key == "mode_menu" and not (isinstance(o.get("features"), list) and all(isinstance(f, str) for f in o["features"])):
+                errors.append(f"{key}.{oid}: features must be a list of lines")
+    main_ids = {o.get("id") for o in menu_items(data, "main_menu")}
+    if not main_ids <= {"KNOW", "COACH"}:
+        errors.append(f"main_menu: ids must be KNOW/COACH, got {sorted(map(str, main_ids))}")
+    attempts = {o.get("value") for o in menu_items(data, "attempt_menu")}
+    for o in menu_items(data, "course_menu"):
+        info = o.get("attempt_info", {})
+        if not isinstance(info, dict):
+            errors.append(f"course_menu.{o.get('id')}.attempt_info: must be an object")
+            info = {}
+        extra = set(info) - attempts
+        if extra:
+            errors.append(f"course_menu.{o.get('id')}: attempt_info for unknown attempts {sorted(extra)}")
+        errors.extend(media_problems(f"course_menu.{o.get('id')}", o.get("documents", []), media_dirs))
+    return errors
+
+def load_catalogue(path: str, media_dirs: tuple[str, ...]) -> Catalogue:
+    with open(path, "r", encoding="utf-8") as f:
+        return Catalogue(json.load(f), media_dirs)
+
+class CatalogueStore:
+    """
+    Holds the live Catalogue. A watcher thread stats content.json every
+    CONTENT_RECHECK_SEC; on change the file is parsed, validated and rendered
+    off to the side, then swapped in with a single reference assignment.
+    A broken edit is reported and the previous catalogue stays live.
+    Documents are checked in the media dir of every number serving the file.
+    """
+    def __init__(self, path: str, recheck_sec: float, media_dir: str):
+        self.path = path
+        self.recheck_sec = recheck_sec
+        self.media_dirs: tuple[str, ...] = (media_dir,)
+        self._sig = self._signature()
+        try:
+            self.current = load_catalogue(path, self.media_dirs)
+        except (OSError, ValueError, TypeError, AttributeError, KeyError) as e:
+            raise SystemExit(f"[CONTENT] {path}: {e}")
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def add_media_dir(self, media_dir: str):
+        """Another number serves this file with its own media dir; its documents must be there too."""
+        if media_dir in self.media_dirs:
+            return
+        try:
+            self.current = load_catalogue(self.path, self.media_dirs + (media_dir,))
+        except (OSError, ValueError, TypeError, AttributeError, KeyError) as e:
+            raise SystemExit(f"[CONTENT] {self.path}: {e}")
+        self.media_dirs += (media_dir,)
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_ino, st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._watch, name="content-watch", daemon=True).start()
+
+    def get(self) -> Catalogue:
+        self._ensure_started()
+        return self.current
+
+    def reload(self) -> bool:
+        sig = self._signature()
+        if sig == self._sig or sig is None:
+            return False
+        self._sig = sig
+        try:
+            self.current = load_catalogue(self.path, self.media_dirs)
+        except (OSError, ValueError, TypeError, AttributeError, KeyError) as e:
+            print(f"[CONTENT] keeping previous catalogue, {self.path} rejected: {e}")
+            return False
+        print(f"[CONTENT] reloaded {self.path}")
+        for line in LINES.values():
+            if line.content is self:
+                line.media.warm(self.current.media_files())
+        return True
+
+    def _watch(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.recheck_sec)
+            try: self.reload()
+            except Exception as e: print("Error reloading content:", e)
+
+def send_main_menu(to: str):
+    return send_menu(to, current_line().content.get().menus["main"])
+
+def send_know_menu(to: str):
+    return send_menu(to, current_line().content.get().menus["know"])
+
+def send_course_menu(to: str):
+    return send_menu(to, current_line().content.get().menus["course"])
+
+def send_attempt_menu(to: str):
+    return send_menu(to, current_line().content.get().menus["attempt"])
+
+def send_group_menu(to: str):
+    return send_menu(to, current_line().content.get().menus["group"])
+
+def send_mode_menu(to: str):
+    return send_menu(to, current_line().content.get().menus["mode"])
+
+# ----------------- Leads (SQLite) -----------------
+# Used by migrate_leads (leads.csv import, before leads was keyed by number); keep as shipped
+LEAD_UPSERT_SQL = """
+    INSERT INTO leads (wa_id, course, attempt, grp, mode, flow, name, city, profile_name, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(wa_id, course, attempt, mode) DO UPDATE SET
+        grp          = excluded.grp,
+        flow         = excluded.flow,
+        name         = coalesce(nullif(excluded.name, ''), leads.name),
+        city         = coalesce(nullif(excluded.city, ''), leads.city),
+        profile_name = coalesce(nullif(excluded.profile_name, ''), leads.profile_name),
+        updated_at   = max(leads.updated_at, excluded.updated_at),
+        enquiries    = leads.enquiries + 1
+"""
+LEAD_SAVE_SQL = """
+    INSERT INTO leads (phone_number_id, wa_id, course, attempt, grp, mode, flow, name, city, profile_name,
+                       created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(phone_number_id, wa_id, course, attempt, mode) DO UPDATE SET
+        grp          = excluded.grp,
+        flow         = excluded.flow,
+        name         = coalesce(nullif(excluded.name, ''), leads.name),
+        city         = coalesce(nullif(excluded.city, ''), leads.city),
+        profile_name = coalesce(nullif(excluded.profile_name, ''), leads.profile_name),
+        updated_at   = max(leads.updated_at, excluded.updated_at),
+        enquiries    = leads.enquiries + 1
+"""
+LEAD_CSV_HEADER = ["timestamp","flow","course","attempt","group","mode","name","city","wa_id","profile_name",
+                   "first_seen","enquiries","phone_number_id"]
+
+def lead_params(row: dict, ts: str) -> tuple:
+    return (row.get("wa_id", ""), row.get("course") or "", row.get("attempt") or "", row.get("group") or "",
+            row.get("mode") or "", row.get("flow") or "", row.get("name") or "", row.get("city") or "",
+            row.get("profile_name") or "", ts, ts)
+
+def save_lead(row: dict):
+    # Returning users update their existing row instead of adding a duplicate;
+    # goes through WRITER so the webhook never waits on disk.
+    ts = row.get("timestamp") or datetime.now().isoformat(timespec="seconds")
+    WRITER.submit(LEAD_SAVE_SQL, (current_line().id,) + lead_params(row, ts), "lead")
+
+def iter_leads_csv(date_from: str | None, date_to: str | None, course: str | None, chunk: int = 500,
+                   number: str | None = None):
+    """Yield the CSV export a few hundred rows at a time; memory stays flat however many leads match."""
+    sql = ("SELECT updated_at, flow, course, attempt, grp, mode, name, city, wa_id, profile_name, created_at, enquiries, "
+           "phone_number_id FROM leads WHERE 1=1")
+    args = []
+    if number:
+        sql += " AND phone_number_id = ?"; args.append(number)
+    if course:
+        sql += " AND course = ?"; args.append(course)
+    if date_from:
+        sql += " AND updated_at >= ?"; args.append(date_from)
+    if date_to:
+        sql += " AND updated_at < ?"; args.append(date_to + "T99")   # inclusive of the whole 'to' day
+    sql += " ORDER BY updated_at"
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(LEAD_CSV_HEADER)
+    conn = db()
+    try:
+        cur = conn.execute(sql, args)
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            w.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0); buf.truncate()
+        if buf.tell():
+            yield buf.getvalue()
+    finally:
+        conn.close()
+
+# ----------------- Broadcasts (bulk sends to leads, resumable) -----------------
+BROADCAST_FILTERS = ("course", "attempt", "mode")
+
+def lead_filter_values(number: str) -> dict[str, list[str]]:
+    """Distinct course/attempt/mode values in one number's leads, for the broadcast form."""
+    with db() as conn:
+        return {f: [r[0] for r in conn.execute(
+                    f"SELECT DISTINCT {f} FROM leads WHERE phone_number_id = ? AND {f} != '' ORDER BY 1", (number,))]
+                for f in BROADCAST_FILTERS}
+
+def broadcast_where(filters: dict, number: str) -> tuple[str, list]:
+    # a broadcast goes out from one number, to the leads that enquired on it
+    where, args = "phone_number_id = ?", [number]
+    for f in BROADCAST_FILTERS:
+        if filters.get(f):
+            where += f" AND {f} = ?"; args.append(filters[f])
+    return where, args
+
+def count_broadcast_recipients(filters: dict, number: str) -> int:
+    where, args = broadcast_where(filters, number)
+    with db() as conn:
+        return conn.execute(f"SELECT COUNT(DISTINCT wa_id) FROM leads WHERE {where}", args).fetchone()[0]
+
+def create_broadcast(name: str, kind: str, body: str, lang: str | None, filters: dict, number: str) -> int:
+    """Snapshot the matching leads into broadcast_recipients (one row per wa_id) and queue the job."""
+    where, args = broadcast_where(filters, number)
+    conn = sqlite3.connect(DB_FILE, timeout=5, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        bid = conn.execute(
+            "INSERT INTO broadcasts (name, kind, body, lang, filters, status, created_at, phone_number_id) "
+            "VALUES (?, ?, ?, ?, ?, 'running', ?, ?)",
+            (name, kind, body, lang, json.dumps(filters), datetime.now().isoformat(timespec="seconds"), number)
+        ).lastrowid
+        n = conn.execute(f"""
+            INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, wa_id)
+            SELECT DISTINCT ?, wa_id FROM leads WHERE {where}""", [bid] + args).rowcount
+        conn.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (n, bid))
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction: conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    BROADCASTS.wake()
+    return bid
+
+def broadcast_progress(bid: int) -> dict | None:
+    with db() as conn:
+        b = conn.execute("SELECT * FROM broadcasts WHERE id = ?", (bid,)).fetchone()
+        if b is None:
+            return None
+        counts = dict(conn.execute(
+            "SELECT state, COUNT(*) FROM broadcast_recipients WHERE broadcast_id = ? GROUP BY state", (bid,)
+        ).fetchall())
+    return {"id": b["id"], "name": b["name"], "kind": b["kind"], "status": b["status"], "total": b["total"],
+            "number": b["phone_number_id"],
+            "filters": json.loads(b["filters"]), "created_at": b["created_at"], "finished_at": b["finished_at"],
+            "pending": counts.get("pending", 0), "sending": counts.get("sending", 0),
+            "sent": counts.get("sent", 0), "failed": counts.get("failed", 0)}
+
+def set_broadcast_status(bid: int, action: str):
+    conn = local_db()
+    if action == "pause":
+        conn.execute("UPDATE broadcasts SET status = 'paused' WHERE id = ? AND status = 'running'", (bid,))
+    elif action == "resume":
+        conn.execute("UPDATE broadcasts SET status = 'running' WHERE id = ? AND status = 'paused'", (bid,))
+    elif action == "cancel":
+        conn.execute("UPDATE broadcasts SET status = 'cancelled', finished_at = ? WHERE id = ? AND status IN ('running', 'paused')",
+                     (datetime.now().isoformat(timespec="seconds"), bid))
+    elif action == "retry":
+        # failed (incl. interrupted) recipients go back in the queue; sent ones are never touched
+        conn.execute("BEGIN IMMEDIATE")
+        n = conn.execute("UPDATE broadcast_recipients SET state = 'pending', error = NULL "
+                         "WHERE broadcast_id = ? AND state = 'failed'", (bid,)).rowcount
+        if n:
+            conn.execute("UPDATE broadcasts SET status = 'running', finished_at = NULL WHERE id = ? AND status != 'cancelled'", (bid,))
+        conn.execute("COMMIT")
+    BROADCASTS.wake()
+
+class BroadcastRunner:
+    """
+    Background sender for broadcast jobs. Any worker may run it; a lease on the
+    broadcasts row makes sure only one worker sends a given job at a time, and
+    a dead worker's job is taken over once its lease runs out.
+
+    Each recipient is marked 'sending' (committed) before its Graph request and
+    'sent'/'failed' after. A row still 'sending' when a job is taken over was
+    interrupted mid-request; it may or may not have been delivered, so it is
+    marked failed instead of being sent again. 'Retry failed' re-queues those.
+    While the Graph circuit breaker is open the job keeps its place and waits.
+    A job is sent from the number it was created for; if that number is no
+    longer configured the job is paused.
+    """
+    def __init__(self, concurrency: int, mps: float, lease_sec: float, poll_sec: float):
+        self.concurrency = max(1, concurrency)
+        self.bucket = TokenBucket(mps, max(1.0, mps))
+        self.lease_sec = lease_sec
+        self.poll_sec = poll_sec
+        self._lock = threading.Lock()
+        self._pid = None
+        self._wake = threading.Event()
+        self.owner = None
+
+    def ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self.owner = f"{socket.gethostname()}:{os.getpid()}"
+            self._pool = concurrent.futures.ThreadPoolExecutor(self.concurrency, thread_name_prefix="broadcast")
+            threading.Thread(target=self._run, name="broadcast-runner", daemon=True).start()
+
+    def stop(self):
+        # the current batch finishes; the job's lease lapses and another worker resumes it
+        self._pid = None
+
+    def wake(self):
+        # new job / resume in this worker: don't wait for the next poll
+        self.ensure_started()
+        self._wake.set()
+
+    def _run(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            try:
+                bid = self._claim()
+                if bid is None:
+                    self._wake.wait(self.poll_sec)
+                    self._wake.clear()
+                    continue
+                if self._work(bid) == "circuit open":
+                    time.sleep(max(self.poll_sec, BREAKER.retry_in()))
+            except Exception as e:
+                print("Error in broadcast runner:", e)
+                time.sleep(self.poll_sec)
+
+    def _claim(self) -> int | None:
+        """Take the lease on the oldest running job nobody (alive) holds; recover it if it was someone else's."""
+        conn = local_db()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("""
+                SELECT id, lease_owner FROM broadcasts
+                WHERE status = 'running' AND (lease_owner IS NULL OR lease_owner = ? OR lease_until < ?)
+                ORDER BY id LIMIT 1""", (self.owner, now)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            bid, prev = row
+            conn.execute("UPDATE broadcasts SET lease_owner = ?, lease_until = ? WHERE id = ?",
+                         (self.owner, now + self.lease_sec, bid))
+            if prev != self.owner:
+                conn.execute("""
+                    UPDATE broadcast_recipients SET state = 'failed', error = 'interrupted (not resent)', updated_at = ?
+                    WHERE broadcast_id = ? AND state = 'sending'""", (datetime.now().isoformat(timespec="seconds"), bid))
+            conn.execute("COMMIT")
+            return bid
+        except BaseException:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+
+    def _work(self, bid: int) -> str | None:
+        conn = local_db()
+        kind, body, lang, number = conn.execute(
+            "SELECT kind, body, lang, phone_number_id FROM broadcasts WHERE id = ?", (bid,)).fetchone()
+        line = LINES.get(number)
+        if line is None:
+            print(f"[broadcast] {bid}: number {number} is not configured, pausing the job")
+            conn.execute("UPDATE broadcasts SET status = 'paused', lease_owner = NULL WHERE id = ?", (bid,))
+            return None
+        while self._pid == os.getpid():
+            if BREAKER.state() == "open":
+                # let the lease lapse quietly; whoever claims the job next just carries on
+                conn.execute("UPDATE broadcasts SET lease_owner = NULL WHERE id = ? AND lease_owner = ?", (bid, self.owner))
+                return "circuit open"
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # still ours and still running? (pause/cancel from the admin, or lease lost)
+                ok = conn.execute("SELECT 1 FROM broadcasts WHERE id = ? AND status = 'running' AND lease_owner = ?",
+                                  (bid, self.owner)).fetchone()
+                batch = [r[0] for r in conn.execute(
+                    "SELECT wa_id FROM broadcast_recipients WHERE broadcast_id = ? AND state = 'pending' LIMIT ?",
+                    (bid, self.concurrency * 4))] if ok else []
+                if batch:
+                    conn.executemany("UPDATE broadcast_recipients SET state = 'sending' WHERE broadcast_id = ? AND wa_id = ?",
+                                     [(bid, w) for w in batch])
+                    conn.execute("UPDATE broadcasts SET lease_until = ? WHERE id = ?", (time.time() + self.lease_sec, bid))
+                elif ok:
+                    conn.execute("UPDATE broadcasts SET status = 'done', finished_at = ?, lease_owner = NULL WHERE id = ?",
+                                 (datetime.now().isoformat(timespec="seconds"), bid))
+                else:
+                    conn.execute("UPDATE broadcasts SET lease_owner = NULL WHERE id = ? AND lease_owner = ?", (bid, self.owner))
+                conn.execute("COMMIT")
+            except BaseException:
+                if conn.in_transaction: conn.execute("ROLLBACK")
+                raise
+            if not batch:
+                return
+            list(self._pool.map(lambda w: self._send(bid, w, kind, body, lang, line), batch))
+            WRITER.flush()
+        return None
+
+    def _send(self, bid: int, wa_id: str, kind: str, body: str, lang: str | None, line: "Line"):
+        wait = self.bucket.reserve()
+        if wait > 0:
+            time.sleep(wait)
+        if kind == "template":
+            payload = {"messaging_product": "whatsapp", "to": wa_id, "type": "template",
+                       "template": {"name": body, "language": {"code": lang or "en"}}}
+            log_text = f"[Broadcast template] {body}"
+        else:
+            payload = {"messaging_product": "whatsapp", "to": wa_id, "type": "text", "text": {"body": body}}
+            log_text = body
+        if not BREAKER.allow():
+            # never reached Graph: back to pending, sent once the circuit closes
+            WRITER.submit("UPDATE broadcast_recipients SET state = 'pending' WHERE broadcast_id = ? AND wa_id = ?",
+                          (bid, wa_id), "broadcast")
+            return
+        try:
+            code, resp = wa_send(payload, line=line)
+        except Exception as e:
+            code, resp = 0, str(e)
+        BREAKER.record(not graph_outage(code))
+        ok = 200 <= code < 300
+        METRICS.inc("broadcast_sent_total", (("result", "sent" if ok else "failed"),))
+        if ok:
+            log_message(wa_id, "out", kind, log_text, payload, response_wamid(code, resp), "sent", line.id)
+        WRITER.submit(
+            "UPDATE broadcast_recipients SET state = ?, error = ?, updated_at = ? WHERE broadcast_id = ? AND wa_id = ?",
+            ("sent" if ok else "failed", None if ok else f"{code} {resp[:200]}",
+             datetime.now().isoformat(timespec="seconds"), bid, wa_id),
+            "broadcast"
+        )
+
+BROADCASTS = BroadcastRunner(BROADCAST_CONCURRENCY, BROADCAST_MPS, BROADCAST_LEASE_SEC, BROADCAST_POLL_SEC)
+
+# ----------------- App factory & worker lifecycle -----------------
+# Import only reads config and renders content.json (CONTENT above), both of which
+# forked workers share. create_app() does the rest of the once-per-deployment work;
+# init_worker() starts what belongs to one process. gunicorn.conf.py wires them to
+# preload / post_fork / worker_exit; any other entry point gets them lazily.
+_LIFECYCLE = {"created": False, "worker_pid": None}
+STARTUP = {"import": 0.0, "create_app": 0.0}     # seconds; inherited by forked workers
+
+METRICS.gauge("startup_import_seconds", lambda: STARTUP["import"], shared=True)
+METRICS.gauge("startup_create_app_seconds", lambda: STARTUP["create_app"], shared=True)
+
+def create_app() -> Flask:
+    """Check env and migrate chat.db, once. Opens no lasting connection and starts no thread, so it is safe before fork."""
+    if _LIFECYCLE["created"]:
+        return app
+    if MISSING_ENV:
+        raise SystemExit(f"[ENV] {', '.join(MISSING_ENV)} missing. Put it in your .env")
+    t0 = time.perf_counter()
+    init_db()
+    _LIFECYCLE["created"] = True
+    STARTUP["import"], STARTUP["create_app"] = t0 - IMPORT_STARTED, time.perf_counter() - t0
+    for line in LINES.values():
+        print(f"[{line.label}] {line.graph.messages_url} (content {line.content.path}, {line.graph.number_bucket.rate:g} msg/s)")
+    print(f"[startup] import {STARTUP['import']:.3f}s, create_app {STARTUP['create_app']:.3f}s")
+    return app
+
+def init_worker():
+    """
+    Per-process setup, after fork: this process's DB connection, every number's
+    send lanes, log writer, metrics flusher and the outbox/broadcast pollers. Started here
+    instead of on the first webhook, so that one doesn't pay for them.
+    """
+    if _LIFECYCLE["worker_pid"] == os.getpid():
+        return
+    create_app()
+    t0 = time.perf_counter()
+    _LIFECYCLE["worker_pid"] = os.getpid()
+    local_db()
+    WRITER._ensure_started()
+    for line in LINES.values():
+        if isinstance(line.outbound, OutboundDispatcher):    # serve_async.py swaps in its own
+            line.outbound._ensure_started()
+        line.media.warm(line.content.get().media_files())
+    METRICS._ensure_started()
+    PAUSES._ensure_started()
+    SEEN._ensure_started()
+    if isinstance(STATE, SQLiteStateStore):
+        STATE._ensure_started()
+    OUTBOX.ensure_started()
+    BROADCASTS.ensure_started()
+    METRICS.observe("worker_init_seconds", time.perf_counter() - t0)
+
+def shutdown_worker():
+    """Stop taking new work, send what is queued, then commit the log rows it produced."""
+    if _LIFECYCLE["worker_pid"] != os.getpid():
+        return
+    _LIFECYCLE["worker_pid"] = None
+    OUTBOX.stop()
+    BROADCASTS.stop()
+    for line in LINES.values():
+        line.outbound.stop()
+    WRITER.stop()
+    METRICS.write_snapshot()
+
+atexit.register(shutdown_worker)    # plain `python app.py` / flask run; gunicorn calls it from worker_exit
+
+@app.before_request
+def start_background_jobs():
+    # no-op once this process is set up (gunicorn.conf.py does it in post_fork)
+    init_worker()
+
+# ----------------- Webhook endpoints -----------------
+@app.route("/webhook", methods=["GET"])
+def verify():
+    mode = request.args.get("hub.mode")
+    token = request.args.get("hub.verify_token")
+    challenge = request.args.get("hub.challenge")
+    if mode == "subscribe" and token == VERIFY_TOKEN:
+        return challenge, 200
+    return "Verification failed", 403
+
+@app.route("/webhook", methods=["POST"])
+def inbound():
+    t_start = time.perf_counter()
+    data = request.get_json(silent=True) or {}
+    try:
+        if process_webhook(data):
+            return "RETRY", 500     # Meta redelivers; handled messages are deduped
+        return "EVENT_RECEIVED", 200
+    except Exception as e:
+        print("Error handling webhook:", e)
+        return "OK", 200
+    finally:
+        METRICS.observe("webhook_seconds", time.perf_counter() - t_start)
+
+def webhook_line(value: dict) -> "Line | None":
+    """The Line a webhook change is addressed to (metadata.phone_number_id); None if we don't serve that number."""
+    number = (value.get("metadata") or {}).get("phone_number_id")
+    if not number:
+        return PRIMARY          # hand-made payloads without metadata
+    line = LINES.get(number)
+    if line is None:
+        METRICS.inc("webhook_unknown_number_total", (("number", number),))
+        if DEBUG: print(f"[webhook] number {number} not configured, change ignored")
+    return line
+
+def process_webhook(data: dict) -> int:
+    """
+    Handle one webhook body; shared by the Flask route and serve_async.py.
+    Returns how many messages failed; the routes answer 500 then so Meta
+    redelivers, and only those (forgotten by SEEN) are handled again.
+    """
+    # Meta may batch several entries/changes/messages into one delivery, and one
+    # app can be subscribed for several numbers. Group them per (number, sender),
+    # keeping the order they arrived in.
+    by_user: dict[tuple[Line, str], list[tuple[dict, str | None]]] = {}
+    for entry in data.get("entry", []):
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            line = webhook_line(value)
+            if line is None:
+                continue
+            if value.get("statuses"):
+                record_statuses(value["statuses"], line.id)
+            messages = value.get("messages", [])
+            if not messages:
+                continue
+            contacts = value.get("contacts") or [{}]
+            names = {c.get("wa_id"): c.get("profile", {}).get("name") for c in contacts}
+            for msg in messages:
+                wa_id = msg.get("from")
+                if not wa_id:
+                    continue
+                # Retried delivery of something we already handled
+                t0 = time.perf_counter()
+                first = not msg.get("id") or SEEN.first_time(msg["id"])
+                METRICS.observe("lookup_seconds", time.perf_counter() - t0, (("kind", "dedup"),))
+                if not first:
+                    if DEBUG: print(f"[dup] {msg['id']}")
+                    continue
+                profile_name = names.get(wa_id) or contacts[0].get("profile", {}).get("name")
+                by_user.setdefault((line, wa_id), []).append((msg, profile_name))
+
+    # Users in parallel, each user's messages in order
+    if len(by_user) == 1:
+        return sum(handle_user_messages(line, wa_id, items) for (line, wa_id), items in by_user.items())
+    if not by_user:
+        return 0
+    pool = inbound_pool()
+    futures = [pool.submit(handle_user_messages, line, wa_id, items) for (line, wa_id), items in by_user.items()]
+    return sum(f.result() for f in futures)
+
+_INBOUND_POOL: tuple[int, concurrent.futures.ThreadPoolExecutor] | None = None
+
+def inbound_pool() -> concurrent.futures.ThreadPoolExecutor:
+    # created lazily per process (executor threads don't survive fork)
+    global _INBOUND_POOL
+    if _INBOUND_POOL is None or _INBOUND_POOL[0] != os.getpid():
+        _INBOUND_POOL = (os.getpid(), concurrent.futures.ThreadPoolExecutor(INBOUND_WORKERS, thread_name_prefix="inbound"))
+    return _INBOUND_POOL[1]
+
+def handle_user_messages(line: "Line", wa_id: str, items: list[tuple[dict, str | None]]) -> int:
+    failed = []
+    try:
+        # state, pause, replies and logs below all belong to this number; the replies are recorded together at the end
+        with serving(line), reply_batch():
+            for msg, profile_name in items:
+                # one bad message must not stop the rest of the batch
+                try:
+                    handle_message(wa_id, msg, profile_name)
+                except Exception as e:
+                    failed.append(msg)
+                    print(f"Error handling message {msg.get('id')} from {wa_id} on {line.id}:", e)
+    except Exception as e:
+        failed = [msg for msg, _ in items]     # no reply went out for any of them
+        print(f"Error recording replies to {wa_id} on {line.id}:", e)
+    for msg in failed:
+        if msg.get("id"):
+            try: SEEN.forget(msg["id"])
+            except sqlite3.Error as e: print(f"Error forgetting message {msg['id']}:", e)
+    return len(failed)
+
+def handle_message(wa_id: str, msg: dict, profile_name: str | None):
+    mtype = msg.get("type")
+    METRICS.inc("messages_in_total", (("type", mtype or "unknown"),))
+
+    # If paused, do nothing (human takes over via admin)
+    if is_paused(wa_id):
+        if DEBUG: print(f"[paused] {wa_id}")
+        return
+
+    cat = current_line().content.get()   # one catalogue for the whole message, even if a reload lands mid-way
+
+    # ===== Interactive =====
+    if mtype == "interactive":
+        i = msg.get("interactive", {})
+
+        if i.get("type") == "button_reply":
+            br = i.get("button_reply", {})
+            bid = (br.get("id") or "").strip()
+            btitle = (br.get("title") or "").strip()
+            # Log inbound button choice
+            log_message(wa_id, "in", "button", f"[User tapped] {btitle} ({bid})", msg)
+            route = cat.routes.get(bid)
+            METRICS.inc("button_taps_total", (("button", bid if route else "other"),))
+            if route:
+                handler, arg = route
+                handler(cat, wa_id, arg, profile_name)
+            else:
+                send_text(wa_id, cat.messages["unknown"])
+            return
+
+        if i.get("type") == "list_reply":
+            lr = i.get("list_reply", {})
+            lid = (lr.get("id") or "").strip()
+            ltitle = (lr.get("title") or "").strip()
+            # Log inbound list selection
+            log_message(wa_id, "in", "list", f"[User chose] {ltitle} ({lid})", msg)
+            METRICS.inc("button_taps_total", (("button", lid if lid in cat.list_replies else "other"),))
+            send_text(wa_id, cat.list_replies.get(lid) or cat.messages["unknown"])
+            return
+
+    # ===== Free text =====
+    if mtype == "text":
+        text_raw = msg.get("text", {}).get("body", "").strip()
+        # Log inbound text
+        log_message(wa_id, "in", "text", text_raw, msg)
+
+        if text_raw.lower() in cat.greetings:
+            clear_state(wa_id)
+            send_menu(wa_id, cat.menus["main"])
+            return
+
+        # Nudge if unknown
+        send_text(wa_id, cat.messages["nudge"])
+        return
+
+# ----------------- Flow engine -----------------
+# Every button id maps to (handler, arg) in Catalogue.routes; handlers take
+# (catalogue, wa_id, arg, profile_name). Routes are generated from the menu
+# options in content.json, so a new course/attempt/group/mode is a content edit.
+def on_know(cat: Catalogue, wa_id: str, _, __):
+    set_state(wa_id, stage="KNOW")
+    send_menu(wa_id, cat.menus["know"])
+
+def on_coach(cat: Catalogue, wa_id: str, _, __):
+    set_state(wa_id, stage="COURSE")
+    send_menu(wa_id, cat.menus["course"])
+
+def on_course(cat: Catalogue, wa_id: str, flow, _):
+    set_state(wa_id, stage="ATTEMPT", course=flow["course"])
+    send_menu(wa_id, cat.menus["attempt"])
+
+def on_attempt(cat: Catalogue, wa_id: str, attempt: str, _):
+    flow = cat.course_by_key.get(get_state(wa_id).get("course"))
+    if flow is None:
+        send_text(wa_id, cat.messages["restart"])
+        return
+    info = flow["attempt_info"].get(attempt)
+    if info: send_text(wa_id, info)
+    if flow["needs_group"]:
+        set_state(wa_id, stage="GROUP", attempt=attempt)
+        send_menu(wa_id, cat.menus["group"])
+    else:
+        set_state(wa_id, stage="MODE", attempt=attempt)
+        send_menu(wa_id, cat.menus["mode"])
+
+def on_group(cat: Catalogue, wa_id: str, group: str, _):
+    set_state(wa_id, stage="MODE", group=group)
+    send_menu(wa_id, cat.menus["mode"])
 
-# ----------------- Menus -----------------
-def send_main_menu(to: str):
-    return send_buttons(to,
-        "Hi! Thanks for contacting Paras Institute of Commerce.\nHow can we help you?",
-        [("KNOW", "Know our Institute"), ("COACH", "CA Coaching")]
-    )
+def on_mode(cat: Catalogue, wa_id: str, mode_label: str, profile_name: str | None):
+    # Mode → features + brochures + thanks + log lead
+    st = get_state(wa_id)
 
-def send_know_menu(to: str):
-    rows = [
-        ("KNOW_SOCIAL",   "Social Media"),
-        ("KNOW_FEATURES", "Unique Features"),
-        ("KNOW_RESULTS",  "Results"),
-        ("KNOW_CONTACTS", "Important Contacts"),
-    ]
-    return send_list_menu(to, "Know about our Institute", "Choose one:", rows)
+    # Save minimal lead
+    save_lead({
+        "timestamp":    datetime.now().isoformat(timespec="seconds"),
+        "flow":         "COACHING_ENQUIRY",
+        "course":       st.get("course",""),
+        "attempt":      st.get("attempt",""),
+        "group":        st.get("group",""),
+        "mode":         mode_label,
+        "name":         "",
+        "city":         "",
+        "wa_id":        wa_id,
+        "profile_name": profile_name or "",
+    })
 
-def send_course_menu(to: str):
-    return send_buttons(to, "Which course are you looking for?", COURSES)
+    METRICS.inc("flow_stage_total", (("stage", "LEAD"),))
 
-def send_attempt_menu(to: str):
-    return send_buttons(to, "Choose your Attempt", ATTEMPTS_STD)
+    # Send features + the course's documents + follow-up
+    send_text(wa_id, cat.features_for(mode_label))
+    flow = cat.course_by_key.get(st.get("course"))
+    for item in flow["documents"] if flow else ():
+        try: send_media(wa_id, item)
+        except MediaError as e: print("Error sending document to", wa_id, ":", e)
+    send_text(wa_id, cat.messages["thanks"])
+    clear_state(wa_id, "LEAD", mode=mode_label)
 
-def send_group_menu(to: str):
-    return send_buttons(to, "Which Group are you considering?", GROUPS)
+# Parsed, validated and rendered once at import (before any fork); hot-swapped on change
+CONTENT = CatalogueStore(CONTENT_FILE, CONTENT_RECHECK_SEC, MEDIA_DIR)
 
-def send_mode_menu(to: str):
-    return send_buttons(to, "Which mode of classes are you looking for?", MODES)
-
-# ----------------- Leads CSV -----------------
-def append_csv(row: dict):
-    header = ["timestamp","flow","course","attempt","group","mode","name","city","wa_id","profile_name"]
-    file_exists = os.path.isfile(LEADS_CSV)
-    with open(LEADS_CSV, "a", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=header)
-        if not file_exists:
-            w.writeheader()
-        w.writerow(row)
+# ----------------- Lines (one per WhatsApp number) -----------------
+class Line:
+    """
+    One WhatsApp number served by this deployment: its own Graph client (so its
+    own msgs/sec token bucket), its own send lanes, its content catalogue and
+    its media ids. Numbers that share a content file share one CatalogueStore.
+    """
+    __slots__ = ("id", "label", "graph", "outbound", "content", "media")
 
-# ----------------- Webhook endpoints -----------------
-@app.route("/webhook", methods=["GET"])
-def verify():
-    mode = request.args.get("hub.mode")
-    token = request.args.get("hub.verify_token")
-    challenge = request.args.get("hub.challenge")
-    if mode == "subscribe" and token == VERIFY_TOKEN:
-        return challenge, 200
-    return "Verification failed", 403
+    def __init__(self, number: str, label: str, graph: GraphClient, outbound: OutboundDispatcher,
+                 content: CatalogueStore, media: MediaCache):
+        self.id = number
+        self.label = label
+        self.graph = graph
+        self.outbound = outbound
+        self.content = content
+        self.media = media
 
-@app.route("/webhook", methods=["POST"])
-def inbound():
-    data = request.get_json()
-    try:
-        for entry in data.get("entry", []):
-            for change in entry.get("changes", []):
-                value = change.get("value", {})
-                messages = value.get("messages", [])
-                if not messages:
-                    continue
+def load_lines(path: str) -> dict[str, Line]:
+    """
+    PHONE_NUMBER_ID (GRAPH, OUTBOUND, CONTENT, MEDIA above) plus every number in
+    NUMBERS_FILE, if it exists:
 
-                msg = messages[0]
-                mtype = msg.get("type")
-                wa_id = msg.get("from")
+      {"<phone_number_id>": {"label": "Delhi", "content": "content-delhi.json", "mps": 40,
+                             "lanes": 4, "token_env": "WHATSAPP_TOKEN_DELHI", "media_dir": "media/delhi"}}
 
-                # If paused, do nothing (human takes over via admin)
-                if is_paused(wa_id):
-                    if DEBUG: print(f"[paused] {wa_id}")
-                    return "OK", 200
-
-                contacts = value.get("contacts", [{}])
-                profile_name = contacts[0].get("profile", {}).get("name") if contacts else None
-
-                # ===== Interactive =====
-                if mtype == "interactive":
-                    i = msg.get("interactive", {})
-
-                    if i.get("type") == "button_reply":
-                        br = i.get("button_reply", {})
-                        bid = (br.get("id") or "").strip()
-                        btitle = (br.get("title") or "").strip()
-                        # Log inbound button choice
-                        log_message(wa_id, "in", "button", f"[User tapped] {btitle} ({bid})", msg)
-
-                        # Top level
-                        if bid == "KNOW":
-                            set_state(wa_id, stage="KNOW")
-                            send_know_menu(wa_id)
-                            return "OK", 200
-                        elif bid == "COACH":
-                            set_state(wa_id, stage="COURSE")
-                            send_course_menu(wa_id)
-                            return "OK", 200
-
-                        # Course
-                        elif bid in {"COURSE_FOUNDATION","COURSE_INTERMEDIATE","COURSE_FINAL_TS"}:
-                            set_state(wa_id, stage="ATTEMPT", course=bid.replace("COURSE_",""))
-                            send_attempt_menu(wa_id)
-                            return "OK", 200
-
-                        # Attempt
-                        elif bid in {"ATTEMPT_SEP","ATTEMPT_MAY","ATTEMPT_JAN"}:
-                            st = get_state(wa_id)
-                            course = st.get("course")
-                            attempt = bid.replace("ATTEMPT_","")
-                            if course is None:
-                                send_text(wa_id, "Please start with *CA Coaching* again.")
-                                return "OK", 200
-
-                            if course == "FINAL_TS":
-                                info = {
-                                    "SEP": "Test series for September attempt are held during July & August months.",
-                                    "MAY": "Test series for May attempt are held during March & April months.",
-                                    "JAN": "Test series for January attempt are held during November & December months.",
-                                }.get(attempt, "")
-                                if info: send_text(wa_id, info)
-                                set_state(wa_id, stage="GROUP", attempt=attempt)
-                                send_group_menu(wa_id)
-                                return "OK", 200
-
-                            if course == "FOUNDATION":
-                                set_state(wa_id, stage="MODE", attempt=attempt)
-                                send_mode_menu(wa_id)
-                                return "OK", 200
-
-                            if course == "INTERMEDIATE":
-                                set_state(wa_id, stage="GROUP", attempt=attempt)
-                                send_group_menu(wa_id)
-                                return "OK", 200
-
-                        # Group
-                        elif bid in {"GROUP_1","GROUP_2","GROUP_BOTH"}:
-                            set_state(wa_id, stage="MODE", group=bid.replace("GROUP_","").replace("_"," "))
-                            send_mode_menu(wa_id)
-                            return "OK", 200
-
-                        # Mode → features + thanks + log lead
-                        elif bid in {"MODE_FACE", "MODE_ONLINE", "MODE_VIRTUAL"}:
-                            mode_map = {"MODE_FACE": "Face to Face", "MODE_ONLINE": "Online", "MODE_VIRTUAL": "Virtual"}
-                            mode_label = mode_map[bid]
-                            st = get_state(wa_id)
-
-                            # Save minimal lead
-                            append_csv({
-                                "timestamp":    datetime.now().isoformat(timespec="seconds"),
-                                "flow":         "COACHING_ENQUIRY",
-                                "course":       st.get("course",""),
-                                "attempt":      st.get("attempt",""),
-                                "group":        st.get("group",""),
-                                "mode":         mode_label,
-                                "name":         "",
-                                "city":         "",
-                                "wa_id":        wa_id,
-                                "profile_name": profile_name or "",
-                            })
-
-                            # Send features + follow-up
-                            features = FEATURES_TEXT.get(mode_label, f"{mode_label} – key features will be shared by our team.")
-                            send_text(wa_id, features)
-                            send_text(wa_id, "Thanks for contacting Paras Institute. We'll soon connect with you via call.")
-                            clear_state(wa_id)
-                            return "OK", 200
-
-                        # Unknown button id
-                        send_text(wa_id, "Thanks! How can we help?")
-                        return "OK", 200
-
-                    if i.get("type") == "list_reply":
-                        lr = i.get("list_reply", {})
-                        lid = (lr.get("id") or "").strip()
-                        ltitle = (lr.get("title") or "").strip()
-                        # Log inbound list selection
-                        log_message(wa_id, "in", "list", f"[User chose] {ltitle} ({lid})", msg)
-
-                        if lid == "KNOW_SOCIAL":
-                            lines = [f"• {k}: {v}" for k,v in SOCIAL_LINKS.items()]
-                            send_text(wa_id, "Follow us on Social Media:\n" + "\n".join(lines))
-                            return "OK", 200
-                        if lid == "KNOW_FEATURES":
-                            lines = [f"• {x}" for x in UNIQUE_FEATURES]
-                            send_text(wa_id, "Unique Features:\n" + "\n".join(lines))
-                            return "OK", 200
-                        if lid == "KNOW_RESULTS":
-                            lines = [f"• {x}" for x in RESULTS_SUMMARY]
-                            send_text(wa_id, "Results:\n" + "\n".join(lines))
-                            return "OK", 200
-                        if lid == "KNOW_CONTACTS":
-                            lines = [f"• {x}" for x in IMPORTANT_CONTACTS]
-                            send_text(wa_id, "Important Contacts:\n" + "\n".join(lines))
-                            return "OK", 200
-
-                        send_text(wa_id, "Thanks! How can we help?")
-                        return "OK", 200
-
-                # ===== Free text =====
-                if mtype == "text":
-                    text_raw = msg.get("text", {}).get("body", "").strip()
-                    # Log inbound text
-                    log_message(wa_id, "in", "text", text_raw, msg)
-
-                    lower = text_raw.lower()
-                    if lower in {"hi","hello","menu","start"}:
-                        clear_state(wa_id)
-                        send_main_menu(wa_id)
-                        return "OK", 200
-
-                    # Nudge if unknown
-                    send_text(wa_id, "Please type *Hi* to see options, or share your query directly.")
-                    return "OK", 200
+    Every key is optional; paths are relative to the file. A content file's
+    documents must exist in the media_dir of every number that serves it.
+    An entry for PHONE_NUMBER_ID itself may only set its label.
+    """
+    lines = {PHONE_NUMBER_ID: Line(PHONE_NUMBER_ID, PHONE_NUMBER_LABEL or PHONE_NUMBER_ID, GRAPH, OUTBOUND, CONTENT, MEDIA)}
+    if not os.path.isfile(path):
+        return lines
+    try:
+        with open(path, encoding="utf-8") as f:
+            numbers = json.load(f)
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"[NUMBERS] {path}: {e}")
+    if not isinstance(numbers, dict):
+        raise SystemExit(f'[NUMBERS] {path}: expected {{"<phone_number_id>": {{...}}}}')
+    base = os.path.dirname(os.path.abspath(path))
+    stores = {os.path.abspath(CONTENT_FILE): CONTENT}
+    for number, cfg in numbers.items():
+        if number.startswith("_"):          # "_comment"
+            continue
+        if not isinstance(cfg, dict):
+            raise SystemExit(f"[NUMBERS] {path}: {number}: expected an object")
+        if number == PHONE_NUMBER_ID:
+            lines[number].label = cfg.get("label") or lines[number].label
+            continue
+        token = os.getenv(cfg["token_env"]) if cfg.get("token_env") else WHATSAPP_TOKEN
+        if not token:
+            raise SystemExit(f"[NUMBERS] {path}: {number}: {cfg.get('token_env') or 'WHATSAPP_TOKEN'} is not set")
+        try:
+            mps, lanes = float(cfg.get("mps", GRAPH_MPS)), int(cfg.get("lanes", OUTBOUND_WORKERS))
+        except (TypeError, ValueError) as e:
+            raise SystemExit(f"[NUMBERS] {path}: {number}: {e}")
+        media_dir = os.path.join(base, cfg["media_dir"]) if cfg.get("media_dir") else MEDIA_DIR
+        content_path = os.path.abspath(os.path.join(base, cfg["content"])) if cfg.get("content") else os.path.abspath(CONTENT_FILE)
+        content = stores.get(content_path)
+        if content is None:
+            content = stores[content_path] = CatalogueStore(content_path, CONTENT_RECHECK_SEC, media_dir)
+        else:
+            content.add_media_dir(media_dir)      # shared file: its documents must be in this number's media dir too
+        graph = GraphClient(f"{GRAPH_BASE_URL}/{GRAPH_API_VER}/{number}/messages", token, mps, GRAPH_PAIR_RATE,
+                            GRAPH_PAIR_BURST, timeout=GRAPH_TIMEOUT, max_retries=GRAPH_MAX_RETRIES,
+                            connect_timeout=GRAPH_CONNECT_TIMEOUT)
+        lines[number] = Line(number, cfg.get("label") or number, graph,
+                             OutboundDispatcher(lanes, f"outbound-{number}"), content,
+                             MediaCache(media_dir, MEDIA_TTL_SEC, DB_FILE + ".media.lock", graph, number))
+    return lines
 
-        return "EVENT_RECEIVED", 200
+LINES = load_lines(NUMBERS_FILE)
+PRIMARY = LINES[PHONE_NUMBER_ID]
+_SERVING = threading.local()
 
-    except Exception as e:
-        print("Error handling webhook:", e)
-        return "OK", 200
+def current_line() -> Line:
+    """The number this thread is handling a message for; PHONE_NUMBER_ID outside of one."""
+    return getattr(_SERVING, "line", None) or PRIMARY
+
+@contextmanager
+def serving(line: Line):
+    prev = getattr(_SERVING, "line", None)
+    _SERVING.line = line
+    try:
+        yield line
+    finally:
+        _SERVING.line = prev
 
 # ----------------- Admin UI -----------------
 ADMIN_LIST_TMPL = """
@@ -506,27 +3539,122 @@ th,td{border-bottom:1px solid #eee;padding:10px;text-align:left;font-size:14px}
 .badge.red{background:#fdd}.badge.green{background:#dfd}
 .small{font-size:12px;color:#666}
 </style></head><body>
-<h2>Paras Admin</h2>
+<h2>Paras Admin{% if number %} · {{ number_label(number) }}{% endif %}</h2>
+
+{% if numbers|length > 1 %}
+<div class="card">
+  <form method="get">Number {{ number_select(number) }} <button>Show</button></form>
+</div>
+{% endif %}
+
+<div class="card">
+  <form method="get" action="{{ url_for('admin_search') }}">
+    <input name="q" placeholder="Search all chats, e.g. Group 2 Virtual Jaipur" style="width:70%" required/>
+    {% if number %}<input type="hidden" name="number" value="{{ number }}"/>{% endif %}
+    <button>Search</button>
+  </form>
+</div>
 
 <div class="card">
   <h3>Recent Conversations</h3>
   <table>
-    <thead><tr><th>Last time</th><th>WA ID</th><th>Preview</th><th>Bot</th><th>Open</th></tr></thead>
+    <thead><tr><th>Last time</th><th>WA ID</th><th>Preview</th><th>Msgs</th><th>Bot</th><th>Open</th></tr></thead>
     <tbody>
     {% for r in convs %}
-      <tr>
-        <td>{{ r.last_ts }}</td>
-        <td>{{ r.wa_id }}</td>
-        <td class="small">{{ r.preview }}</td>
-        <td>{% if r.paused %}<span class="badge red">Paused</span>{% else %}<span class="badge green">Running</span>{% endif %}</td>
-        <td><a href="{{ url_for('admin_chat', wa_id=r.wa_id) }}">Open chat</a></td>
+      <tr data-number="{{ r.phone_number_id }}" data-wa="{{ r.wa_id }}">
+        <td class="c-ts">{{ r.last_ts }}</td>
+        <td>{{ r.wa_id }}{% if numbers|length > 1 %} <span class="badge">{{ number_label(r.phone_number_id) }}</span>{% endif %}</td>
+        <td class="small c-preview">{{ r.preview }}</td>
+        <td class="c-count">{{ r.msg_count }}</td>
+        <td class="c-bot">{% if r.paused %}<span class="badge red">Paused</span>{% else %}<span class="badge green">Running</span>{% endif %}</td>
+        <td><a href="{{ url_for('admin_chat', wa_id=r.wa_id, number=r.phone_number_id) }}">Open chat</a></td>
       </tr>
     {% endfor %}
     </tbody>
   </table>
 </div>
 
+<div class="card">
+  <h3>Export Leads (CSV)</h3>
+  <form method="get" action="{{ url_for('admin_leads_csv') }}">
+    From <input type="date" name="from"/> To <input type="date" name="to"/>
+    <select name="course" style="font:inherit;padding:8px 10px;border-radius:8px;border:1px solid #ccc">
+      <option value="">All courses</option>
+      {% for c in courses %}<option value="{{ c }}">{{ c }}</option>{% endfor %}
+    </select>
+    {{ number_select(number) }}
+    <button>Download</button>
+  </form>
+</div>
+
+<div class="card">
+  <h3>Enquiry funnel (7 days)</h3>
+  {% if funnel.started %}
+  <p>{{ funnel.started }} started · {{ funnel.lead }} leads ·
+     {{ '%.1f'|format(100 * funnel.lead / funnel.started) }}% conversion</p>
+  {% else %}<p class="small">No coaching enquiries yet.</p>{% endif %}
+  <a href="{{ url_for('admin_analytics', number=number) }}">Drop-off by step, course, attempt and mode →</a>
+</div>
+
+<div class="card">
+  <h3>Broadcasts</h3>
+  <a href="{{ url_for('admin_broadcasts', number=number) }}">Send an announcement to leads →</a>
+</div>
+
+<div class="card">
+  <h3>Delivery (7 days)</h3>
+  {% if delivery.sent %}
+  <p>{{ delivery.sent }} sent · {{ '%.1f'|format(100 * delivery.delivered / delivery.sent) }}% delivered ·
+     {{ '%.1f'|format(100 * delivery.read / delivery.sent) }}% read · {{ delivery.failed }} failed</p>
+  {% else %}<p class="small">No status callbacks yet.</p>{% endif %}
+  <a href="{{ url_for('admin_delivery', number=number) }}">Delivery and read latency by day →</a>
+</div>
+
 <form method="post" action="{{ url_for('admin_logout') }}"><button class="danger">Logout</button></form>
+<script>
+(function(){
+  // Live list: the stream sends changed conversation rows and pause flips
+  var tbody = document.querySelector('tbody');
+  var chatUrl = {{ url_for('admin_chat', wa_id='__WA__', number='__NUM__')|tojson }};
+  var labels = {{ number_labels|tojson }};   // null while only one number is served
+  function badge(td, paused){
+    td.innerHTML = paused ? '<span class="badge red">Paused</span>' : '<span class="badge green">Running</span>';
+  }
+  function find(num, wa){
+    return tbody.querySelector('tr[data-number="' + CSS.escape(num) + '"][data-wa="' + CSS.escape(wa) + '"]');
+  }
+  function row(num, wa){
+    var tr = find(num, wa);
+    if (tr) return tr;
+    tr = document.createElement('tr'); tr.dataset.number = num; tr.dataset.wa = wa;
+    ['c-ts', '', 'small c-preview', 'c-count', 'c-bot', ''].forEach(function(c){
+      var td = document.createElement('td'); if (c) td.className = c; tr.appendChild(td);
+    });
+    tr.children[1].textContent = wa;
+    if (labels) {
+      var l = document.createElement('span'); l.className = 'badge'; l.textContent = labels[num] || num;
+      tr.children[1].appendChild(document.createTextNode(' ')); tr.children[1].appendChild(l);
+    }
+    var a = document.createElement('a'); a.textContent = 'Open chat';
+    a.href = chatUrl.replace('__WA__', encodeURIComponent(wa)).replace('__NUM__', encodeURIComponent(num));
+    tr.children[5].appendChild(a);
+    return tr;
+  }
+  var es = new EventSource({{ url_for('admin_stream', after=last_id, number=number)|tojson }});
+  es.addEventListener('conversation', function(e){
+    var c = JSON.parse(e.data), tr = row(c.phone_number_id, c.wa_id);
+    tr.querySelector('.c-ts').textContent = c.last_ts;
+    tr.querySelector('.c-preview').textContent = c.preview || '';
+    tr.querySelector('.c-count').textContent = c.msg_count;
+    badge(tr.querySelector('.c-bot'), c.paused);
+    tbody.insertBefore(tr, tbody.firstChild);
+  });
+  es.addEventListener('pause', function(e){
+    var p = JSON.parse(e.data), tr = find(p.phone_number_id, p.wa_id);
+    if (tr) badge(tr.querySelector('.c-bot'), p.paused);
+  });
+})();
+</script>
 </body></html>
 """
 
@@ -536,43 +3664,429 @@ ADMIN_CHAT_TMPL = """
 body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;margin:24px;background:#fafafa;color:#222}
 a{color:#0a7}
 .wrap{max-width:900px;margin:auto}
-.bubble{max-width:70%;padding:10px 12px;border-radius:14px;margin:8px 0;box-shadow:0 1px 2px rgba(0,0,0,.05)}
+.bubble{max-width:70%;padding:10px 12px;border-radius:14px;margin:8px 0;box-shadow:0 1px 2px rgba(0,0,0,.05);white-space:pre-wrap}
 .in{background:#fff;border:1px solid #e5e5e5}
 .out{background:#e9fff5;border:1px solid #d4f4e5;margin-left:auto}
 .meta{font-size:11px;color:#777;margin-top:4px}
+.dlv-failed{color:#c33;font-weight:600}.dlv-retrying,.dlv-queued{color:#b80}.dlv-read{color:#07a}
 .header{display:flex;gap:12px;align-items:center;margin-bottom:12px}
 .badge{display:inline-block;padding:2px 8px;border-radius:20px;font-size:12px;background:#eee}
 .badge.red{background:#fdd}.badge.green{background:#dfd}
 input,button{font:inherit;padding:8px 10px;border-radius:8px;border:1px solid #ccc}
 button{background:#0b7;color:#fff;border:none;cursor:pointer}
 button.danger{background:#c33}
+#older{display:block;margin:8px auto;background:#eee;color:#333}
 </style></head><body><div class="wrap">
   <div class="header">
-    <h3 style="margin:0">Chat: {{ wa_id }}</h3>
-    {% if paused %}<span class="badge red">Bot Paused</span>{% else %}<span class="badge green">Bot Running</span>{% endif %}
+    <h3 style="margin:0">Chat: {{ wa_id }}{% if numbers|length > 1 %} <span class="badge">{{ number_label(number) }}</span>{% endif %}</h3>
+    <span id="bot-badge" class="badge {{ 'red' if paused else 'green' }}">{{ 'Bot Paused' if paused else 'Bot Running' }}</span>
     <form method="post" action="{{ url_for('admin_toggle') }}">
       <input type="hidden" name="wa_id" value="{{ wa_id }}"/>
-      {% if paused %}
-        <button class="danger" name="action" value="resume">Resume Bot</button>
-      {% else %}
-        <button class="danger" name="action" value="pause">Pause Bot</button>
-      {% endif %}
+      <input type="hidden" name="number" value="{{ number }}"/>
+      <button id="bot-toggle" class="danger" name="action" value="{{ 'resume' if paused else 'pause' }}">{{ 'Resume Bot' if paused else 'Pause Bot' }}</button>
       <a href="{{ url_for('admin_home') }}" style="margin-left:12px">← Back</a>
     </form>
   </div>
 
+  {% if cursor %}<button id="older" type="button">Load older messages</button>{% endif %}
+  <div id="msgs">
   {% for m in msgs %}
-    <div class="bubble {{ 'in' if m.direction=='in' else 'out' }}">
+    <div class="bubble {{ 'in' if m.direction=='in' else 'out' }}" data-id="{{ m.id }}">
       <div>{{ m.text|e if m.text else '' }}</div>
-      <div class="meta">{{ m.ts }} · {{ m.mtype }}</div>
+      <div class="meta">{{ m.ts }} · {{ m.mtype }}{% if m.delivery %} · <span class="dlv-{{ m.delivery }}">{{ m.delivery }}</span>{% endif %}</div>
     </div>
   {% endfor %}
+  </div>
 
-  <form method="post" action="{{ url_for('admin_chat', wa_id=wa_id) }}" style="margin-top:16px">
+  <form method="post" action="{{ url_for('admin_chat', wa_id=wa_id, number=number) }}" style="margin-top:16px">
     <input name="text" placeholder="Type a reply…" style="width:70%" required>
     <button>Send</button>
   </form>
-</div></body></html>
+</div>
+<script>
+(function(){
+  // Older pages come from the keyset API; scrolling to the top loads the next one
+  var cursor = {{ cursor|tojson }}, busy = false;
+  var api = {{ url_for('admin_chat_messages', wa_id=wa_id, number=number)|tojson }};
+  var box = document.getElementById('msgs'), btn = document.getElementById('older');
+  function bubble(m){
+    var d = document.createElement('div'); d.className = 'bubble ' + (m.direction == 'in' ? 'in' : 'out');
+    var t = document.createElement('div'); t.textContent = m.text || '';
+    var meta = document.createElement('div'); meta.className = 'meta'; meta.textContent = m.ts + ' · ' + m.mtype;
+    if (m.delivery) { meta.appendChild(document.createTextNode(' · ')); meta.appendChild(delivery(m.delivery)); }
+    d.appendChild(t); d.appendChild(meta); return d;
+  }
+  function delivery(state){
+    var s = document.createElement('span'); s.className = 'dlv-' + state; s.textContent = state; return s;
+  }
+  function loadOlder(){
+    if (!cursor || busy) return; busy = true;
+    fetch(api + '&before_ts=' + encodeURIComponent(cursor.ts) + '&before_id=' + cursor.id, {credentials: 'same-origin'})
+      .then(function(r){ return r.json(); })
+      .then(function(page){
+        var h = document.documentElement.scrollHeight, frag = document.createDocumentFragment();
+        page.messages.forEach(function(m){ frag.appendChild(bubble(m)); });
+        box.insertBefore(frag, box.firstChild);
+        window.scrollBy(0, document.documentElement.scrollHeight - h);  // keep the reader's place
+        cursor = page.cursor;
+        if (!cursor && btn) btn.remove();
+      })
+      .finally(function(){ busy = false; });
+  }
+  if (btn) btn.addEventListener('click', loadOlder);
+  window.addEventListener('scroll', function(){ if (window.scrollY < 50) loadOlder(); });
+  window.scrollTo(0, document.documentElement.scrollHeight);
+
+  // Live tail: new messages (id > last seen) and pause flips arrive over SSE
+  var es = new EventSource({{ url_for('admin_stream', wa_id=wa_id, number=number, after=last_id)|tojson }});
+  es.addEventListener('message', function(e){
+    var m = JSON.parse(e.data);
+    if (box.querySelector('[data-id="' + m.id + '"]')) return;
+    var atBottom = window.innerHeight + window.scrollY >= document.documentElement.scrollHeight - 80;
+    var b = bubble(m); b.dataset.id = m.id; box.appendChild(b);
+    if (atBottom) window.scrollTo(0, document.documentElement.scrollHeight);
+  });
+  es.addEventListener('pause', function(e){
+    var p = JSON.parse(e.data), badge = document.getElementById('bot-badge'), tog = document.getElementById('bot-toggle');
+    badge.className = 'badge ' + (p.paused ? 'red' : 'green'); badge.textContent = p.paused ? 'Bot Paused' : 'Bot Running';
+    tog.value = p.paused ? 'resume' : 'pause'; tog.textContent = p.paused ? 'Resume Bot' : 'Pause Bot';
+  });
+  es.addEventListener('delivery', function(e){
+    var d = JSON.parse(e.data), b = box.querySelector('[data-id="' + d.id + '"] .meta');
+    if (!b) return;
+    var old = b.querySelector('span');
+    if (old) old.replaceWith(delivery(d.delivery));
+    else { b.appendChild(document.createTextNode(' · ')); b.appendChild(delivery(d.delivery)); }
+  });
+})();
+</script>
+</body></html>
+"""
+
+ADMIN_SEARCH_TMPL = """
+<!doctype html><html><head><meta charset="utf-8"/><title>Search · Paras Admin</title>
+<style>
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;margin:24px;background:#fafafa;color:#222}
+a{color:#0a7}
+.card{background:#fff;border:1px solid #ddd;border-radius:12px;padding:16px;margin-bottom:20px;box-shadow:0 1px 2px rgba(0,0,0,.04)}
+input,button{font:inherit;padding:8px 10px;border-radius:8px;border:1px solid #ccc}
+button{background:#0b7;color:#fff;border:none;cursor:pointer}
+table{width:100%;border-collapse:collapse;margin-top:12px}
+th,td{border-bottom:1px solid #eee;padding:10px;text-align:left;font-size:14px}
+mark{background:#ffe58a;padding:0 2px}
+.small{font-size:12px;color:#666}
+</style></head><body>
+<h2>Search</h2>
+<div class="card">
+  <form method="get">
+    <input name="q" value="{{ q }}" style="width:70%" required/>
+    {{ number_select(number) }}
+    <button>Search</button>
+    <a href="{{ url_for('admin_home') }}" style="margin-left:12px">← Back</a>
+  </form>
+  {% if error %}<p style="color:#c33">{{ error }}</p>{% endif %}
+  {% if q and not error %}<p class="small">{{ hits|length }} result{{ '' if hits|length == 1 else 's' }} · {{ ms }} ms</p>{% endif %}
+  <table>
+    <thead><tr><th>Time</th><th>WA ID</th><th>Match</th><th>Open</th></tr></thead>
+    <tbody>
+    {% for h in hits %}
+      <tr>
+        <td>{{ h.ts }}</td>
+        <td>{{ h.wa_id }}{% if numbers|length > 1 %} <span class="small">{{ number_label(h.number) }}</span>{% endif %}</td>
+        <td class="small">{{ h.snippet }}</td>
+        <td><a href="{{ url_for('admin_chat', wa_id=h.wa_id, number=h.number) }}">Open chat</a></td>
+      </tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+</body></html>
+"""
+
+ADMIN_BROADCASTS_TMPL = """
+<!doctype html><html><head><meta charset="utf-8"/><title>Broadcasts · Paras Admin</title>
+<style>
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;margin:24px;background:#fafafa;color:#222}
+a{color:#0a7}
+.card{background:#fff;border:1px solid #ddd;border-radius:12px;padding:16px;margin-bottom:20px;box-shadow:0 1px 2px rgba(0,0,0,.04)}
+input,select,textarea,button{font:inherit;padding:8px 10px;border-radius:8px;border:1px solid #ccc}
+button{background:#0b7;color:#fff;border:none;cursor:pointer}
+table{width:100%;border-collapse:collapse;margin-top:12px}
+th,td{border-bottom:1px solid #eee;padding:10px;text-align:left;font-size:14px}
+.small{font-size:12px;color:#666}
+</style></head><body>
+<h2>Broadcasts <a href="{{ url_for('admin_home', number=number) }}" class="small" style="margin-left:12px">← Back</a></h2>
+
+<div class="card">
+  <h3>New broadcast</h3>
+  {% if error %}<p style="color:#c33">{{ error }}</p>{% endif %}
+  {% if numbers|length > 1 %}
+  <form method="get" style="margin-bottom:8px">From {{ number_select(number, None) }} <button>Switch</button></form>
+  {% endif %}
+  <form method="post">
+    <input type="hidden" name="number" value="{{ number }}"/>
+    <div><input name="name" placeholder="Name, e.g. May attempt announcement" style="width:60%" required/>
+      {% if numbers|length > 1 %} <span class="small">from {{ number_label(number) }}</span>{% endif %}</div>
+    <div style="margin-top:8px">
+      {% for f in ('course', 'attempt', 'mode') %}
+      <select name="{{ f }}">
+        <option value="">Any {{ f }}</option>
+        {% for v in values[f] %}<option value="{{ v }}">{{ v }}</option>{% endfor %}
+      </select>
+      {% endfor %}
+    </div>
+    <div style="margin-top:8px">
+      <select name="kind">
+        <option value="template">Approved template</option>
+        <option value="text">Plain text (only reaches users active in the last 24h)</option>
+      </select>
+      <input name="lang" placeholder="Template language, e.g. en" value="en" style="width:160px"/>
+    </div>
+    <div style="margin-top:8px"><textarea name="body" rows="4" style="width:80%" placeholder="Template name, or the message text" required></textarea></div>
+    <div style="margin-top:8px"><button>Start broadcast</button></div>
+  </form>
+</div>
+
+<div class="card">
+  <h3>Jobs{% if numbers|length > 1 %} <span class="small">from {{ number_label(number) }}</span>{% endif %}</h3>
+  <table>
+    <thead><tr><th>Created</th><th>Name</th><th>Status</th><th>Sent</th><th>Failed</th><th>Total</th><th>Open</th></tr></thead>
+    <tbody>
+    {% for b in jobs %}
+      <tr>
+        <td>{{ b.created_at }}</td>
+        <td>{{ b.name }}</td>
+        <td>{{ b.status }}</td>
+        <td>{{ b.sent }}</td><td>{{ b.failed }}</td><td>{{ b.total }}</td>
+        <td><a href="{{ url_for('admin_broadcast', bid=b.id) }}">Progress</a></td>
+      </tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+</body></html>
+"""
+
+ADMIN_BROADCAST_TMPL = """
+<!doctype html><html><head><meta charset="utf-8"/><title>{{ b.name }} · Broadcast</title>
+<style>
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;margin:24px;background:#fafafa;color:#222}
+a{color:#0a7}
+.card{background:#fff;border:1px solid #ddd;border-radius:12px;padding:16px;margin-bottom:20px;box-shadow:0 1px 2px rgba(0,0,0,.04)}
+button{font:inherit;padding:8px 10px;border-radius:8px;background:#0b7;color:#fff;border:none;cursor:pointer}
+button.danger{background:#c33}
+.bar{height:14px;background:#eee;border-radius:7px;overflow:hidden;display:flex}
+.bar div{height:100%}
+.stat{display:inline-block;margin-right:24px;font-size:20px}
+.small{font-size:12px;color:#666}
+</style></head><body>
+<h2>{{ b.name }} <a href="{{ url_for('admin_broadcasts', number=b.number) }}" class="small" style="margin-left:12px">← All broadcasts</a></h2>
+<div class="card">
+  <p class="small">{{ b.kind }} · {{ b.filters|tojson }} · from {{ number_label(b.number) }} · created {{ b.created_at }}</p>
+  <div class="bar"><div id="p-sent" style="background:#0b7"></div><div id="p-failed" style="background:#c33"></div></div>
+  <p>
+    <span class="stat">Status: <b id="s-status">{{ b.status }}</b></span>
+    <span class="stat">Sent: <b id="s-sent">{{ b.sent }}</b></span>
+    <span class="stat">Failed: <b id="s-failed">{{ b.failed }}</b></span>
+    <span class="stat">Pending: <b id="s-pending">{{ b.pending + b.sending }}</b></span>
+    <span class="stat">Total: <b id="s-total">{{ b.total }}</b></span>
+  </p>
+  <form method="post" action="{{ url_for('admin_broadcast_action', bid=b.id) }}">
+    <button name="action" value="pause">Pause</button>
+    <button name="action" value="resume">Resume</button>
+    <button name="action" value="retry">Retry failed</button>
+    <button name="action" value="cancel" class="danger">Cancel</button>
+  </form>
+</div>
+<script>
+(function(){
+  var url = {{ url_for('admin_broadcast_progress', bid=b.id)|tojson }};
+  function show(p){
+    ['status', 'sent', 'failed', 'total'].forEach(function(k){ document.getElementById('s-' + k).textContent = p[k]; });
+    document.getElementById('s-pending').textContent = p.pending + p.sending;
+    var t = Math.max(p.total, 1);
+    document.getElementById('p-sent').style.width = (100 * p.sent / t) + '%';
+    document.getElementById('p-failed').style.width = (100 * p.failed / t) + '%';
+    return p.status == 'running';
+  }
+  function poll(){
+    fetch(url, {credentials: 'same-origin'}).then(function(r){ return r.json(); })
+      .then(function(p){ setTimeout(poll, show(p) ? 1000 : 5000); })
+      .catch(function(){ setTimeout(poll, 5000); });
+  }
+  poll();
+})();
+</script>
+</body></html>
+"""
+
+ADMIN_DELIVERY_TMPL = """
+<!doctype html><html><head><meta charset="utf-8"/><title>Delivery · Paras Admin</title>
+<style>
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;margin:24px;background:#fafafa;color:#222}
+a{color:#0a7}
+.card{background:#fff;border:1px solid #ddd;border-radius:12px;padding:16px;margin-bottom:20px;box-shadow:0 1px 2px rgba(0,0,0,.04)}
+table{width:100%;border-collapse:collapse;margin-top:12px}
+th,td{border-bottom:1px solid #eee;padding:10px;text-align:left;font-size:14px}
+.small{font-size:12px;color:#666}
+</style></head><body>
+<h2>Delivery (last {{ days }} days){% if number %} · {{ number_label(number) }}{% endif %} <a href="{{ url_for('admin_home', number=number) }}" class="small" style="margin-left:12px">← Back</a></h2>
+{% if numbers|length > 1 %}
+<form method="get"><input type="hidden" name="days" value="{{ days }}"/>{{ number_select(number) }}
+  <button style="font:inherit;padding:8px 10px;border-radius:8px;background:#0b7;color:#fff;border:none;cursor:pointer">Show</button></form>
+{% endif %}
+<p class="small">From WhatsApp status callbacks. Latency = delivered/read time minus sent time, as reported by WhatsApp (histogram buckets).
+Read receipts only arrive from users who have them enabled.</p>
+
+{% macro rate(n, d) %}{{ '%.1f'|format(100 * n / d) if d else '–' }}%{% endmacro %}
+{% macro lat(l) %}{% if l.n %}avg {{ '%.1f'|format(l.avg) }}s · p50 ≤{{ l.p50 }} · p95 ≤{{ l.p95 }}{% else %}–{% endif %}{% endmacro %}
+
+<div class="card">
+  <h3>By day</h3>
+  <table>
+    <thead><tr><th>Day</th><th>Sent</th><th>Delivered</th><th>Read</th><th>Failed</th><th>Delivery latency</th><th>Read latency</th></tr></thead>
+    <tbody>
+    {% for d in by_day %}
+      <tr><td>{{ d.day }}</td><td>{{ d.sent }}</td>
+        <td>{{ d.delivered }} ({{ rate(d.delivered, d.sent) }})</td>
+        <td>{{ d.read }} ({{ rate(d.read, d.sent) }})</td>
+        <td>{{ d.failed }} ({{ rate(d.failed, d.sent + d.failed) }})</td>
+        <td class="small">{{ lat(d.lat_delivered) }}</td><td class="small">{{ lat(d.lat_read) }}</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+
+<div class="card">
+  <h3>By message type</h3>
+  <table>
+    <thead><tr><th>Type</th><th>Sent</th><th>Delivered</th><th>Read</th><th>Failed</th></tr></thead>
+    <tbody>
+    {% for t in by_type %}
+      <tr><td>{{ t.mtype }}</td><td>{{ t.sent }}</td><td>{{ rate(t.delivered, t.sent) }}</td>
+        <td>{{ rate(t.read, t.sent) }}</td><td>{{ t.failed }} ({{ rate(t.failed, t.sent + t.failed) }})</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+
+<div class="card">
+  <h3>Top failure reasons</h3>
+  <table>
+    <thead><tr><th>Code</th><th>Reason</th><th>Count</th></tr></thead>
+    <tbody>
+    {% for f in failures %}<tr><td>{{ f.error_code }}</td><td class="small">{{ f.error_title }}</td><td>{{ f.n }}</td></tr>{% endfor %}
+    </tbody>
+  </table>
+</div>
+</body></html>
+"""
+
+ADMIN_ANALYTICS_TMPL = """
+<!doctype html><html><head><meta charset="utf-8"/><title>Analytics · Paras Admin</title>
+<style>
+body{font-family:system-ui,-apple-system,Segoe UI,Roboto,Helvetica,Arial,sans-serif;margin:24px;background:#fafafa;color:#222}
+a{color:#0a7}
+.card{background:#fff;border:1px solid #ddd;border-radius:12px;padding:16px;margin-bottom:20px;box-shadow:0 1px 2px rgba(0,0,0,.04)}
+table{width:100%;border-collapse:collapse;margin-top:12px}
+th,td{border-bottom:1px solid #eee;padding:10px;text-align:left;font-size:14px}
+.small{font-size:12px;color:#666}
+.bar{background:#0b7;height:18px;border-radius:4px;min-width:2px}
+.cols{display:flex;align-items:flex-end;gap:2px;height:120px;border-bottom:1px solid #ddd}
+.cols div{flex:1;display:flex;flex-direction:column;justify-content:flex-end;gap:1px}
+.cols .s{background:#9dd9c3}.cols .l{background:#0b7}
+.grid{display:grid;grid-template-columns:repeat(auto-fit,minmax(220px,1fr));gap:20px}
+select,input,button{font:inherit;padding:8px 10px;border-radius:8px;border:1px solid #ccc}
+button{background:#0b7;color:#fff;border:none;cursor:pointer}
+</style></head><body>
+<h2>Enquiry funnel{% if number %} · {{ number_label(number) }}{% endif %} <a href="{{ url_for('admin_home', number=number) }}" class="small" style="margin-left:12px">← Back</a></h2>
+<form method="get">
+  Last <input type="number" name="days" value="{{ days }}" min="1" max="365" style="width:70px"/> days
+  <select name="course"><option value="">All courses</option>
+    {% for c in courses %}<option value="{{ c }}" {{ 'selected' if c == course }}>{{ c }}</option>{% endfor %}
+  </select>
+  {{ number_select(number) }}
+  <button>Show</button>
+</form>
+<p class="small">Counts are flow transitions (a user who goes through a step twice counts twice), read from
+hourly/daily rollups kept current as they happen.{% if first_day %} History starts {{ first_day }}.{% endif %}</p>
+
+{% macro pct(n, d) %}{{ '%.1f'|format(100 * n / d) if d else '–' }}%{% endmacro %}
+
+<div class="card">
+  <h3>Funnel{% if course %} · {{ course }}{% endif %}</h3>
+  {% set top = totals[steps[0][0]] %}
+  <table>
+    <thead><tr><th>Step</th><th style="width:40%"></th><th>Count</th><th>From previous</th><th>From first step</th></tr></thead>
+    <tbody>
+    {% for key, label in steps %}
+      <tr><td>{{ label }}</td>
+        <td><div class="bar" style="width:{{ (100 * totals[key] / top) if top else 0 }}%"></div></td>
+        <td>{{ totals[key] }}</td>
+        <td>{% if not loop.first %}{{ pct(totals[key], totals[steps[loop.index0 - 1][0]]) }}{% endif %}</td>
+        <td>{{ pct(totals[key], top) }}</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+
+<div class="card">
+  <h3>Last 48 hours</h3>
+  {% set peak = by_hour|map(attribute=steps[0][0])|max if by_hour else 0 %}
+  <div class="cols">
+    {% for h in by_hour %}
+      <div title="{{ h.hour }}:00 · {{ h[steps[0][0]] }} {{ steps[0][1]|lower }}, {{ h.lead }} leads">
+        <span class="s" style="height:{{ (110 * (h[steps[0][0]] - h.lead) / peak) if peak else 0 }}px"></span>
+        <span class="l" style="height:{{ (110 * h.lead / peak) if peak else 0 }}px"></span>
+      </div>
+    {% endfor %}
+  </div>
+  <p class="small">Light: {{ steps[0][1]|lower }} · dark: leads. Hover a column for the hour.</p>
+</div>
+
+<div class="card">
+  <h3>By day</h3>
+  <table>
+    <thead><tr><th>Day</th>{% for key, label in steps %}<th>{{ label }}</th>{% endfor %}<th>Conversion</th></tr></thead>
+    <tbody>
+    {% for d in by_day %}
+      <tr><td>{{ d.day }}</td>{% for key, label in steps %}<td>{{ d[key] }}</td>{% endfor %}
+        <td>{{ pct(d.lead, d[steps[0][0]]) }}</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+
+{% if not course %}
+<div class="card">
+  <h3>By course</h3>
+  <table>
+    <thead><tr><th>Course</th>{% for key, label in steps[1:] %}<th>{{ label }}</th>{% endfor %}<th>Conversion</th></tr></thead>
+    <tbody>
+    {% for c in by_course %}
+      <tr><td><a href="?days={{ days }}&course={{ c.course|urlencode }}">{{ c.course }}</a></td>
+        {% for key, label in steps[1:] %}<td>{{ c[key] }}</td>{% endfor %}
+        <td>{{ pct(c.lead, c.course_chosen) }}</td></tr>
+    {% endfor %}
+    </tbody>
+  </table>
+</div>
+{% endif %}
+
+<div class="grid">
+  {% for title, rows in leads_by %}
+  <div class="card">
+    <h3>Leads by {{ title }}</h3>
+    <table>{% for value, n in rows %}<tr><td>{{ value or '–' }}</td><td>{{ n }}</td></tr>{% endfor %}</table>
+  </div>
+  {% endfor %}
+  <div class="card">
+    <h3>Restarted from</h3>
+    <table>{% for prev, n in restarts %}<tr><td>{{ prev }}</td><td>{{ n }}</td></tr>{% endfor %}</table>
+    <p class="small">Users who said hi again instead of answering the menu they were on.</p>
+  </div>
+</div>
+</body></html>
 """
 
 LOGIN_TMPL = """
@@ -599,6 +4113,34 @@ button{background:#0b7;color:#fff;border:none;cursor:pointer}
 
 def authed(): return session.get("admin") is True
 
+def request_number(default: str | None = None) -> str | None:
+    """The ?number= (or form field) being looked at, if it's one we serve; else default (None = every number)."""
+    n = request.values.get("number") or ""
+    return n if n in LINES else default
+
+def number_label(number: str) -> str:
+    return LINES[number].label if number in LINES else number
+
+def number_select(selected: str | None = None, blank: str | None = "All numbers") -> Markup:
+    """<select name="number"> for the admin filters; empty while only one number is served."""
+    if len(LINES) < 2:
+        return Markup("")
+    opts = [f'<option value="">{escape(blank)}</option>'] if blank else []
+    opts += [f'<option value="{escape(n)}"{" selected" if n == selected else ""}>{escape(ln.label)}</option>'
+             for n, ln in LINES.items()]
+    return Markup('<select name="number" style="font:inherit;padding:8px 10px;border-radius:8px;border:1px solid #ccc">'
+                  + "".join(opts) + "</select>")
+
+def course_keys(number: str | None = None) -> list[str]:
+    """Courses in one number's content (or every number's), for the admin filters."""
+    lines = [LINES[number]] if number else LINES.values()
+    return list(dict.fromkeys(c for ln in lines for c in ln.content.get().course_by_key))
+
+@app.context_processor
+def number_helpers():
+    return {"numbers": LINES, "number_label": number_label, "number_select": number_select,
+            "number_labels": {n: ln.label for n, ln in LINES.items()} if len(LINES) > 1 else None}
+
 @app.route("/admin/login", methods=["GET","POST"])
 def admin_login():
     if request.method == "POST":
@@ -617,40 +4159,419 @@ def admin_logout():
 @app.route("/admin", methods=["GET"])
 def admin_home():
     if not authed(): return redirect(url_for("admin_login"))
-    # Build recent conversations list
+    number = request_number()
+    where, args = ("phone_number_id = ?", [number]) if number else ("1=1", [])
+    week = (datetime.now() - timedelta(days=6)).strftime("%Y-%m-%d")
+    # Recent conversations straight from the summary table (kept current by trigger)
     with db() as conn:
-        rows = conn.execute("""
-            SELECT wa_id, MAX(ts) AS last_ts
-            FROM messages
-            GROUP BY wa_id
+        convs = conn.execute(f"""
+            SELECT phone_number_id, wa_id, last_ts, last_preview AS preview, msg_count, paused
+            FROM conversations WHERE {where}
             ORDER BY last_ts DESC
             LIMIT 200
-        """).fetchall()
-        convs = []
-        for r in rows:
-            last = conn.execute(
-                "SELECT text FROM messages WHERE wa_id=? ORDER BY ts DESC, id DESC LIMIT 1", (r["wa_id"],)
-            ).fetchone()
-            convs.append({
-                "wa_id": r["wa_id"],
-                "last_ts": r["last_ts"],
-                "preview": (last["text"] if last and last["text"] else "")[:160],
-                "paused": is_paused(r["wa_id"])
-            })
-    return render_template_string(ADMIN_LIST_TMPL, convs=convs)
+        """, args).fetchall()
+        last_id = conn.execute("SELECT coalesce(MAX(id), 0) FROM messages").fetchone()[0]
+        delivery = conn.execute(f"""
+            SELECT coalesce(SUM(sent), 0) AS sent, coalesce(SUM(delivered), 0) AS delivered,
+                   coalesce(SUM(read), 0) AS read, coalesce(SUM(failed), 0) AS failed
+            FROM status_rollup WHERE day >= ? AND {where}""", [week] + args).fetchone()
+        funnel = conn.execute(f"SELECT {FUNNEL_SUMS} FROM funnel_daily WHERE day >= ? AND {where}",
+                              [week] + args).fetchone()
+    return render_template_string(ADMIN_LIST_TMPL, convs=convs, last_id=last_id, delivery=delivery, funnel=funnel,
+                                  courses=course_keys(number), number=number)
+
+def fts_query(q: str) -> str:
+    # Each word becomes a quoted term (AND-ed), so user input can't inject FTS5 syntax;
+    # the last word also matches as a prefix while the counsellor is mid-word.
+    words = ["".join(ch for ch in w if ch.isalnum()) for w in q.split()]
+    words = [w for w in words if w]
+    if not words:
+        return ""
+    return " ".join(f'"{w}"' for w in words[:-1]) + (" " if len(words) > 1 else "") + f'"{words[-1]}"*'
+
+def search_messages(q: str, limit: int = 50, window: int = 2000, number: str | None = None) -> list[dict]:
+    """
+    Ranked (bm25) hits with the matching words wrapped in <mark>.
+    Common words can match a large share of millions of rows, so only the
+    newest `window` matches are ranked: a cheap rowid-ordered probe finds
+    the cut-off, and bm25 runs on rows above it.
+    """
+    match = fts_query(q)
+    if not match:
+        return []
+    with db() as conn:
+        cut = conn.execute(
+            "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+            (match, window)
+        ).fetchone()
+        rows = conn.execute(f"""
+            SELECT m.id, m.phone_number_id, m.wa_id, m.ts,
+                   snippet(messages_fts, 0, char(2), char(3), '…', 16) AS snip
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ? AND messages_fts.rowid > ?{" AND m.phone_number_id = ?" if number else ""}
+            ORDER BY rank
+            LIMIT ?
+        """, [match, cut[0] if cut else 0] + ([number] if number else []) + [limit]).fetchall()
+    hits = []
+    for r in rows:
+        # escape the message text first, then turn the sentinels into <mark>
+        snip = str(escape(r["snip"] or "")).replace("\x02", "<mark>").replace("\x03", "</mark>")
+        hits.append({"id": r["id"], "number": r["phone_number_id"], "wa_id": r["wa_id"], "ts": r["ts"],
+                     "snippet": Markup(snip)})
+    return hits
+
+@app.route("/admin/search", methods=["GET"])
+def admin_search():
+    if not authed(): return redirect(url_for("admin_login"))
+    q = (request.args.get("q") or "").strip()
+    number = request_number()
+    hits, error, t0 = [], None, time.perf_counter()
+    if q:
+        try:
+            hits = search_messages(q, number=number)
+        except sqlite3.OperationalError as e:
+            error = f"Search unavailable: {e}"
+    ms = round((time.perf_counter() - t0) * 1000, 1)
+    return render_template_string(ADMIN_SEARCH_TMPL, q=q, hits=hits, error=error, ms=ms, number=number)
+
+@app.route("/admin/leads.csv", methods=["GET"])
+def admin_leads_csv():
+    if not authed(): return redirect(url_for("admin_login"))
+    gen = iter_leads_csv(request.args.get("from") or None, request.args.get("to") or None,
+                         request.args.get("course") or None, number=request_number())
+    fname = f"leads-{datetime.now():%Y%m%d-%H%M%S}.csv"
+    return Response(stream_with_context(gen), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename={fname}"})
+
+def latency_summary(buckets: dict[float, list]) -> dict:
+    """{le: [n, total_sec]} histogram -> n, avg and bucketed p50/p95 labels."""
+    n = sum(v[0] for v in buckets.values())
+    out = {"n": n, "avg": sum(v[1] for v in buckets.values()) / n if n else 0.0}
+    for name, q in (("p50", 0.5), ("p95", 0.95)):
+        seen, label = 0, "–"
+        for le in sorted(buckets):
+            seen += buckets[le][0]
+            if n and seen >= q * n:
+                label = "∞" if le == float("inf") else (f"{le // 60:g}m" if le >= 60 else f"{le:g}s")
+                break
+        out[name] = label
+    return out
+
+def delivery_report(days: int, number: str | None = None) -> dict:
+    since = (datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    where, args = ("phone_number_id = ?", [number]) if number else ("1=1", [])
+    with db() as conn:
+        by_day = [dict(r) for r in conn.execute(f"""
+            SELECT day, SUM(sent) AS sent, SUM(delivered) AS delivered, SUM(read) AS read, SUM(failed) AS failed
+            FROM status_rollup WHERE day >= ? AND {where} GROUP BY day ORDER BY day DESC""", [since] + args)]
+        by_type = [dict(r) for r in conn.execute(f"""
+            SELECT mtype, SUM(sent) AS sent, SUM(delivered) AS delivered, SUM(read) AS read, SUM(failed) AS failed
+            FROM status_rollup WHERE day >= ? AND {where} GROUP BY mtype ORDER BY sent DESC""", [since] + args)]
+        hist: dict[tuple[str, str], dict[float, list]] = {}
+        for r in conn.execute(f"SELECT day, kind, le, SUM(n) AS n, SUM(total_sec) AS total_sec FROM status_latency "
+                              f"WHERE day >= ? AND {where} GROUP BY day, kind, le", [since] + args):
+            hist.setdefault((r["day"], r["kind"]), {})[r["le"]] = [r["n"], r["total_sec"]]
+        failures = conn.execute(f"""
+            SELECT error_code, error_title, COUNT(*) AS n FROM statuses
+            WHERE status = 'failed' AND ts >= CAST(strftime('%s', ?) AS INTEGER) AND {where}
+            GROUP BY error_code, error_title ORDER BY n DESC LIMIT 10""", [since] + args).fetchall()
+    for d in by_day:
+        for kind in ("delivered", "read"):
+            d[f"lat_{kind}"] = latency_summary(hist.get((d["day"], kind), {}))
+    return {"by_day": by_day, "by_type": by_type, "failures": failures}
+
+@app.route("/admin/delivery", methods=["GET"])
+def admin_delivery():
+    if not authed(): return redirect(url_for("admin_login"))
+    days = max(1, min(int(request.args.get("days") or 14), 90))
+    number = request_number()
+    return render_template_string(ADMIN_DELIVERY_TMPL, days=days, number=number, **delivery_report(days, number))
+
+# (key, label, condition on a funnel rollup row); counts are SUM(n) over matching rows
+FUNNEL_STEPS = (
+    ("started", "Started enquiry", "stage = 'COURSE'"),
+    ("course_chosen", "Chose course", "stage = 'ATTEMPT'"),
+    ("attempt_chosen", "Chose attempt", "stage IN ('GROUP', 'MODE') AND prev = 'ATTEMPT'"),
+    ("mode_menu", "Reached mode menu", "stage = 'MODE'"),
+    ("lead", "Lead", "stage = 'LEAD'"),
+)
+FUNNEL_SUMS = ", ".join(f"coalesce(SUM(CASE WHEN {cond} THEN n END), 0) AS {key}" for key, _, cond in FUNNEL_STEPS)
+
+def funnel_report(days: int, course: str | None = None, number: str | None = None) -> dict:
+    """Everything /admin/analytics shows, from funnel_daily / funnel_hourly only."""
+    where, hour_where = "day >= ?", "hour >= ?"
+    args = [(datetime.now() - timedelta(days=days - 1)).strftime("%Y-%m-%d")]
+    hour_args = [(datetime.now() - timedelta(hours=47)).strftime("%Y-%m-%d %H")]
+    if number:
+        where += " AND phone_number_id = ?"
+        hour_where += " AND phone_number_id = ?"
+        args.append(number)
+        hour_args.append(number)
+    if course:
+        where += " AND course = ?"
+        hour_where += " AND course = ?"
+        args.append(course)
+        hour_args.append(course)
+    with db() as conn:
+        totals = dict(conn.execute(f"SELECT {FUNNEL_SUMS} FROM funnel_daily WHERE {where}", args).fetchone())
+        by_day = [dict(r) for r in conn.execute(
+            f"SELECT day, {FUNNEL_SUMS} FROM funnel_daily WHERE {where} GROUP BY day ORDER BY day DESC", args)]
+        by_hour = [dict(r) for r in conn.execute(
+            f"SELECT hour, {FUNNEL_SUMS} FROM funnel_hourly WHERE {hour_where} GROUP BY hour ORDER BY hour",
+            hour_args)]
+        by_course = [dict(r) for r in conn.execute(
+            f"SELECT course, {FUNNEL_SUMS} FROM funnel_daily WHERE {where} AND course != '' "
+            "GROUP BY course ORDER BY lead DESC, course_chosen DESC", args)]
+        leads_by = [(title, conn.execute(
+            f"SELECT {col}, SUM(n) FROM funnel_daily WHERE {where} AND stage = 'LEAD' GROUP BY 1 ORDER BY 2 DESC",
+            args).fetchall()) for title, col in (("attempt", "attempt"), ("group", "grp"), ("mode", "mode"))]
+        restarts = conn.execute(
+            f"SELECT prev, SUM(n) FROM funnel_daily WHERE {where} AND stage = 'RESTART' GROUP BY prev ORDER BY 2 DESC",
+            args).fetchall()
+        first_day = conn.execute("SELECT min(day) FROM funnel_daily").fetchone()[0]
+    # with a course picked, the first step (before any course is chosen) doesn't apply
+    steps = [(key, label) for key, label, _ in FUNNEL_STEPS][1 if course else 0:]
+    return {"steps": steps, "totals": totals, "by_day": by_day, "by_hour": by_hour, "by_course": by_course,
+            "leads_by": leads_by, "restarts": restarts, "first_day": first_day}
+
+@app.route("/admin/analytics", methods=["GET"])
+def admin_analytics():
+    if not authed(): return redirect(url_for("admin_login"))
+    days = max(1, min(request.args.get("days", 30, type=int), 365))
+    course = request.args.get("course") or None
+    number = request_number()
+    return render_template_string(ADMIN_ANALYTICS_TMPL, days=days, course=course, number=number,
+                                  courses=course_keys(number), **funnel_report(days, course, number))
+
+@app.route("/admin/broadcasts", methods=["GET","POST"])
+def admin_broadcasts():
+    if not authed(): return redirect(url_for("admin_login"))
+    error = None
+    number = request_number(PRIMARY.id)     # the form and the job list are this number's
+    if request.method == "POST":
+        f = request.form
+        kind = "text" if f.get("kind") == "text" else "template"
+        body = (f.get("body") or "").strip()
+        filters = {k: f.get(k) for k in BROADCAST_FILTERS if f.get(k)}
+        if not body:
+            error = "Message text / template name is required"
+        elif count_broadcast_recipients(filters, number) == 0:
+            error = "No leads match those filters"
+        else:
+            bid = create_broadcast((f.get("name") or "").strip() or body[:40], kind, body,
+                                   (f.get("lang") or "").strip() or None, filters, number)
+            return redirect(url_for("admin_broadcast", bid=bid))
+    with db() as conn:
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM broadcasts WHERE phone_number_id = ? ORDER BY id DESC LIMIT 50", (number,))]
+    jobs = [broadcast_progress(i) for i in ids]
+    return render_template_string(ADMIN_BROADCASTS_TMPL, jobs=jobs, values=lead_filter_values(number), number=number,
+                                  error=error)
+
+@app.route("/admin/broadcasts/<int:bid>", methods=["GET"])
+def admin_broadcast(bid):
+    if not authed(): return redirect(url_for("admin_login"))
+    b = broadcast_progress(bid)
+    if b is None: return "Not found", 404
+    return render_template_string(ADMIN_BROADCAST_TMPL, b=b)
+
+@app.route("/admin/broadcasts/<int:bid>/progress", methods=["GET"])
+def admin_broadcast_progress(bid):
+    if not authed(): return jsonify({"error": "unauthorized"}), 401
+    b = broadcast_progress(bid)
+    if b is None: return jsonify({"error": "not found"}), 404
+    return jsonify(b)
+
+@app.route("/admin/broadcasts/<int:bid>/action", methods=["POST"])
+def admin_broadcast_action(bid):
+    if not authed(): return redirect(url_for("admin_login"))
+    set_broadcast_status(bid, request.form.get("action", ""))
+    return redirect(url_for("admin_broadcast", bid=bid))
 
 @app.route("/admin/chat/<wa_id>", methods=["GET","POST"])
 def admin_chat(wa_id):
     if not authed(): return redirect(url_for("admin_login"))
+    number = request_number(PRIMARY.id)
     if request.method == "POST":
         text = (request.form.get("text") or "").strip()
         if text:
-            send_text(wa_id, text)  # logged automatically
+            # logged automatically; wait so the reply shows up in the transcript below
+            with serving(LINES[number]):
+                send_text(wa_id, text).wait(ADMIN_SEND_WAIT)
+            WRITER.flush()
+    msgs, cursor = transcript_page(wa_id, number=number)
+    if msgs:
+        last_id = msgs[-1]["id"]
+    else:
+        with db() as conn:
+            last_id = conn.execute("SELECT coalesce(MAX(id), 0) FROM messages").fetchone()[0]
+    return render_template_string(ADMIN_CHAT_TMPL, wa_id=wa_id, number=number, msgs=msgs, cursor=cursor,
+                                  last_id=last_id, paused=is_paused(wa_id, number))
+
+@app.route("/admin/api/chat/<wa_id>/messages", methods=["GET"])
+def admin_chat_messages(wa_id):
+    if not authed(): return jsonify({"error": "unauthorized"}), 401
+    before = None
+    if request.args.get("before_ts") and request.args.get("before_id", "").isdigit():
+        before = (request.args["before_ts"], int(request.args["before_id"]))
+    limit = min(max(request.args.get("limit", TRANSCRIPT_PAGE, type=int), 1), 200)
+    msgs, cursor = transcript_page(wa_id, before, limit, request_number(PRIMARY.id))
+    return jsonify({"messages": [dict(m) for m in msgs], "cursor": cursor})
+
+# Delivery state of an outbound row: the outbox's queued/retrying/failed until Graph accepts
+# it, then the furthest status callback (failed > read > delivered) for its wamid
+DELIVERY_SQL = """CASE WHEN messages.delivery = 'sent' AND messages.wamid IS NOT NULL THEN coalesce(
+    (SELECT CASE WHEN max(s.status = 'failed') THEN 'failed' WHEN max(s.status = 'read') THEN 'read'
+                 WHEN max(s.status = 'delivered') THEN 'delivered' END
+     FROM statuses s WHERE s.wamid = messages.wamid), 'sent') ELSE messages.delivery END"""
+
+DELIVERY_FINAL = (None, "read", "failed")
+
+def transcript_page(wa_id: str, before: tuple[str, int] | None = None, limit: int = TRANSCRIPT_PAGE,
+                    number: str | None = None):
+    """
+    One page of a transcript, oldest first, ending just before the (ts, id)
+    cursor (or at the newest message). Walks idx_messages_wa_ts backwards, so
+    cost depends on the page size, not on how long the conversation is.
+    Once chat.db runs out, the same query continues into the archive files
+    (newest month first), so paging reaches back through archived history.
+    The conversation is the one with `number` (default PHONE_NUMBER_ID).
+    Returns (rows, cursor for the next older page or None).
+    """
+    # rows from before numbers were told apart have no number: they are PHONE_NUMBER_ID's
+    sql = ("SELECT id, direction, mtype, text, ts, {delivery} AS delivery FROM messages "
+           "WHERE wa_id=? AND {number} = ?")
+    args: list = [wa_id, number or PHONE_NUMBER_ID]
+    if before:
+        sql += " AND (ts, id) < (?, ?)"
+        args += list(before)
+    sql += " ORDER BY ts DESC, id DESC LIMIT ?"
     with db() as conn:
-        msgs = conn.execute(
-            "SELECT direction, mtype, text, ts FROM messages WHERE wa_id=? ORDER BY ts ASC, id ASC", (wa_id,)
-        ).fetchall()
-    return render_template_string(ADMIN_CHAT_TMPL, wa_id=wa_id, msgs=msgs, paused=is_paused(wa_id))
+        rows = conn.execute(sql.format(delivery=DELIVERY_SQL, number="phone_number_id"), args + [limit + 1]).fetchall()
+    for path in archive_files() if len(rows) <= limit else ():
+        conn = open_archive(path)
+        try:
+            cols = [r[1] for r in conn.execute("PRAGMA table_info(messages)")]
+            expr = "coalesce(phone_number_id, ?)" if "phone_number_id" in cols else "?"
+            rows += conn.execute(sql.format(delivery="NULL", number=expr),
+                                 [wa_id, PHONE_NUMBER_ID] + args[1:] + [limit + 1 - len(rows)]).fetchall()
+        except sqlite3.Error as e:
+            print("Error reading archive", path, ":", e)
+        finally:
+            conn.close()
+        if len(rows) > limit:
+            break
+    more = len(rows) > limit
+    rows = rows[:limit][::-1]
+    cursor = {"ts": rows[0]["ts"], "id": rows[0]["id"]} if more and rows else None
+    return rows, cursor
+
+def sse(event: str, data: dict, event_id: int | None = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# Streams hold a request thread for SSE_MAX_SEC; /webhook must always find one free
+STREAM_SLOTS = threading.BoundedSemaphore(SSE_MAX_STREAMS)
+
+def live_events(after: int, wa_id: str | None, number: str | None = None):
+    """
+    SSE generator behind /admin/stream. Every SSE_POLL_SEC it runs one
+    primary-key range query for rows with id > the last one sent. A chat view
+    gets the new messages plus 'delivery' events as its recent outbound rows
+    move through queued/retrying/sent/delivered/read; the list view gets the
+    changed conversations rows. `number` narrows either to one number.
+    Pause flips come from the in-process PauseRegistry, so they cost no query.
+    Ends after SSE_MAX_SEC; EventSource reconnects with Last-Event-ID.
+    When SSE_MAX_STREAMS are already open it answers with a longer retry and
+    ends at once (a 503 would make EventSource give up for good).
+    """
+    # taken here, not in the view: a generator that never starts never runs its finally
+    if not STREAM_SLOTS.acquire(blocking=False):
+        METRICS.inc("admin_streams_busy_total")
+        yield f"retry: {int(SSE_BUSY_RETRY_SEC * random.uniform(1000, 1500))}\n\n: busy\n\n"
+        return
+    try:
+        yield "retry: 2000\n\n"
+        yield from _live_events(after, wa_id, number)
+    finally:
+        STREAM_SLOTS.release()
+
+def _live_events(after: int, wa_id: str | None, number: str | None):
+    version, paused = PAUSES.snapshot()
+    deadline = time.monotonic() + SSE_MAX_SEC
+    last_sent = time.monotonic()
+    conn = db()
+    tracked: dict[int, str] = {}     # outbound row id -> delivery state last sent (chat view only)
+    if wa_id:
+        tracked = {r[0]: r[1] for r in conn.execute(
+            f"SELECT id, {DELIVERY_SQL} FROM messages WHERE wa_id = ? AND phone_number_id = ? AND direction = 'out' "
+            "ORDER BY ts DESC, id DESC LIMIT 50", (wa_id, number or PHONE_NUMBER_ID)) if r[1] not in DELIVERY_FINAL}
+    try:
+        while time.monotonic() < deadline:
+            sql = (f"SELECT id, phone_number_id, wa_id, direction, mtype, text, ts, {DELIVERY_SQL} AS delivery "
+                   "FROM messages WHERE id > ?")
+            args: list = [after]
+            if wa_id:
+                sql += " AND wa_id = ?"
+                args.append(wa_id)
+            if number or wa_id:
+                sql += " AND phone_number_id = ?"
+                args.append(number or PHONE_NUMBER_ID)
+            rows = conn.execute(sql + " ORDER BY id LIMIT 500", args).fetchall()
+            if rows:
+                after = rows[-1]["id"]
+                if wa_id:
+                    for r in rows:
+                        yield sse("message", dict(r), r["id"])
+                        if r["direction"] == "out" and r["delivery"] not in DELIVERY_FINAL:
+                            tracked[r["id"]] = r["delivery"]
+                else:
+                    keys = list(dict.fromkeys((r["phone_number_id"], r["wa_id"]) for r in rows))
+                    convs = conn.execute(
+                        "SELECT phone_number_id, wa_id, last_ts, last_preview AS preview, msg_count, paused "
+                        f"FROM conversations WHERE (phone_number_id, wa_id) IN (VALUES {','.join(['(?, ?)'] * len(keys))}) "
+                        "ORDER BY last_ts", [x for k in keys for x in k]
+                    ).fetchall()
+                    for c in convs:
+                        yield sse("conversation", dict(c), after)
+                last_sent = time.monotonic()
+
+            if tracked:
+                ids = list(tracked)[-200:]
+                for mid, state in conn.execute(
+                        f"SELECT id, {DELIVERY_SQL} FROM messages WHERE id IN ({','.join('?' * len(ids))})", ids):
+                    if state != tracked[mid]:
+                        yield sse("delivery", {"id": mid, "delivery": state})
+                        last_sent = time.monotonic()
+                    tracked[mid] = state
+                tracked = {k: v for k, v in tracked.items() if k in ids and v not in DELIVERY_FINAL}
+
+            new_version, new_paused = PAUSES.snapshot()
+            if new_version != version:
+                for key in set(paused) | set(new_paused):
+                    n, w = key
+                    if ((key in paused) != (key in new_paused) and (not wa_id or w == wa_id)
+                            and (not (number or wa_id) or n == (number or PHONE_NUMBER_ID))):
+                        yield sse("pause", {"phone_number_id": n, "wa_id": w, "paused": key in new_paused})
+                version, paused = new_version, new_paused
+                last_sent = time.monotonic()
+
+            if time.monotonic() - last_sent > 15:
+                yield ": keep-alive\n\n"     # keeps proxies from closing an idle stream
+                last_sent = time.monotonic()
+            if len(rows) < 500:
+                time.sleep(SSE_POLL_SEC)
+    finally:
+        conn.close()
+
+@app.route("/admin/stream", methods=["GET"])
+def admin_stream():
+    if not authed(): return "unauthorized", 401
+    last = request.headers.get("Last-Event-ID") or request.args.get("after") or "0"
+    after = int(last) if last.isdigit() else 0
+    wa_id = request.args.get("wa_id") or None
+    return Response(stream_with_context(live_events(after, wa_id, request_number())), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/admin/toggle", methods=["POST"])
 def admin_toggle():
@@ -658,12 +4579,39 @@ def admin_toggle():
     wa_id = request.form.get("wa_id","").strip()
     action = request.form.get("action","")
     if wa_id:
-        set_paused(wa_id, action == "pause")
+        set_paused(request_number(PRIMARY.id), wa_id, action == "pause")
     # redirect back to chat page if referer contains it
     ref = request.headers.get("Referer","")
     if "/admin/chat/" in ref: return redirect(ref)
     return redirect(url_for("admin_home"))
 
+@app.route("/admin/stats/outbound", methods=["GET"])
+def admin_outbound_stats():
+    if not authed(): return redirect(url_for("admin_login"))
+    with db() as conn:
+        outbox = dict(conn.execute("SELECT state, count(*) FROM outbox GROUP BY state").fetchall())
+    # top level: PHONE_NUMBER_ID's lanes, as before; "numbers": every number's own lanes and Graph client
+    numbers = {ln.id: {"label": ln.label, **ln.outbound.snapshot(), "graph": dict(ln.graph.stats),
+                       "media": dict(ln.media.stats)} for ln in LINES.values()}
+    return jsonify({**OUTBOUND.snapshot(), "graph": dict(GRAPH.stats), "db_writer": dict(WRITER.stats),
+                    "dedup": dict(SEEN.stats), "outbox": {**outbox, **OUTBOX.stats},
+                    "breaker": {"state": BREAKER.state(), "failures": BREAKER.failures, **BREAKER.stats},
+                    "media": dict(MEDIA.stats), "numbers": numbers})
+
+@app.cli.command("archive")
+@click.option("--before", "cutoff", required=True, help="First month to keep in chat.db, e.g. 2025-01")
+def archive_command(cutoff):
+    """Move messages older than --before into ARCHIVE_DIR/chat-YYYY-MM.db."""
+    for month, n in archive_before(cutoff):
+        print(f"{month}: {n} messages archived")
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Prometheus scrape target; summed over every gunicorn worker (see Metrics)
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return "unauthorized", 401
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
 # ----------------- Run server -----------------
 @app.route("/webhook", methods=["GET"])
 def verify_webhook_alias():
@@ -671,4 +4619,4 @@ def verify_webhook_alias():
     return verify()
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000)
+    create_app().run(host="0.0.0.0", port=5000)
@@ -0,0 +1,189 @@
+"""
+Local stand-in for the WhatsApp Cloud API (Graph) used by the benchmarks.
+
+  POST /<version>/<phone_number_id>/messages  → {"messages":[{"id":"wamid.…"}]}
+  POST /<version>/<phone_number_id>/media     → {"id":"<media id>"} (multipart upload, field "file")
+  GET  /_bench/log                            → [[to, unix_time, status], …] since last reset
+  GET  /_bench/media                          → [[media_id, filename, mime, bytes, sha256], …] uploads
+  POST /_bench/reset                          → clears the log and counters
+
+Latency is log-normal around --latency-ms; --error-rate answers 500,
+--throttle-rate answers 429 with Graph error 130429, and --mps caps the
+accepted messages per second the way a real phone number does (excess → 429).
+--media-error-rate answers that fraction of uploads with 500.
+A document/image message naming a media id that was never uploaded gets a 400.
+
+  python bench/fake_graph.py --port 9100 --latency-ms 120 --throttle-rate 0.01
+"""
+import json
+import math
+import hashlib
+import time
+import random
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class GraphState:
+    def __init__(self, latency_ms: float, jitter: float, error_rate: float, throttle_rate: float, mps: float,
+                 media_error_rate: float = 0.0):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.media_error_rate = media_error_rate
+        self.throttle_rate = throttle_rate
+        self.mps = mps
+        self.lock = threading.Lock()
+        self.media: dict[str, list] = {}      # kept across resets, like real uploads
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.log: list[list] = []
+            self.seq = 0
+            self.tokens = self.mps
+            self.refilled = time.monotonic()
+
+    def take_token(self) -> bool:
+        if self.mps <= 0:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.mps, self.tokens + (now - self.refilled) * self.mps)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def delay(self) -> float:
+        if self.latency_ms <= 0:
+            return 0.0
+        return self.latency_ms / 1000 * math.exp(random.gauss(0, self.jitter))
+
+    def record(self, to: str, status: int) -> int:
+        with self.lock:
+            self.seq += 1
+            self.log.append([to, time.time(), status])
+            return self.seq
+
+    def store_media(self, filename: str, mime: str, data: bytes) -> str:
+        sha = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            media_id = f"{int(sha[:13], 16)}{len(self.media)}"     # numeric, like Graph's; a re-upload gets a new one
+            self.media[media_id] = [media_id, filename, mime, len(data), sha]
+        return media_id
+
+def multipart_file(content_type: str, body: bytes) -> tuple[str, str, bytes] | None:
+    """(filename, mime, data) of the "file" part of a multipart/form-data body."""
+    msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    if not msg.is_multipart():
+        return None
+    for part in msg.iter_parts():
+        if part.get_param("name", header="content-disposition") == "file":
+            return part.get_filename() or "file", part.get_content_type(), part.get_payload(decode=True) or b""
+    return None
+
+def graph_error(code: int, message: str) -> dict:
+    return {"error": {"message": message, "type": "OAuthException", "code": code, "fbtrace_id": "bench"}}
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"     # keep-alive, like graph.facebook.com
+    state: GraphState = None
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def reply(self, status: int, body, headers: dict | None = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def read_json(self, raw: bytes) -> dict:
+        try: return json.loads(raw or b"{}")
+        except ValueError: return {}
+
+    def do_GET(self):
+        if self.path == "/_bench/log":
+            with self.state.lock:
+                log = list(self.state.log)
+            return self.reply(200, log)
+        if self.path == "/_bench/media":
+            with self.state.lock:
+                media = list(self.state.media.values())
+            return self.reply(200, media)
+        self.reply(404, graph_error(100, "Unknown path"))
+
+    def do_POST(self):
+        st = self.state
+        raw = self.read_body()
+        if self.path == "/_bench/reset":
+            st.reset()
+            return self.reply(200, {"ok": True})
+        if self.path.endswith("/media"):
+            upload = multipart_file(self.headers.get("Content-Type", ""), raw)
+            if upload is None:
+                return self.reply(400, graph_error(100, "The parameter file is required"))
+            time.sleep(st.delay())
+            if random.random() < st.media_error_rate:
+                return self.reply(500, graph_error(1, "An unknown error occurred"))
+            return self.reply(200, {"id": st.store_media(*upload)})
+        if not self.path.endswith("/messages"):
+            return self.reply(404, graph_error(100, "Unknown path"))
+
+        body = self.read_json(raw)
+        media = body.get(body.get("type", ""), {})
+        if isinstance(media, dict) and "id" in media and media["id"] not in st.media:
+            return self.reply(400, graph_error(131053, "Media upload error"))
+
+        to = str(body.get("to", ""))
+        time.sleep(st.delay())
+        r = random.random()
+        if r < st.error_rate:
+            st.record(to, 500)
+            return self.reply(500, graph_error(1, "An unknown error occurred"))
+        if r < st.error_rate + st.throttle_rate or not st.take_token():
+            st.record(to, 429)
+            return self.reply(429, graph_error(130429, "Rate limit hit"), {"Retry-After": "1"})
+        seq = st.record(to, 200)
+        self.reply(200, {"messaging_product": "whatsapp",
+                         "contacts": [{"input": to, "wa_id": to}],
+                         "messages": [{"id": f"wamid.bench{seq}"}]})
+
+def serve(port: int, state: GraphState) -> ThreadingHTTPServer:
+    Handler.state = state
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    return server
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake Graph /messages + /media endpoints for load tests")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--latency-ms", type=float, default=100, help="median response time")
+    ap.add_argument("--jitter", type=float, default=0.5, help="log-normal sigma of the latency")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="fraction answered with HTTP 500")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="fraction answered with HTTP 429")
+    ap.add_argument("--mps", type=float, default=0, help="accepted messages/sec before 429s (0 = unlimited)")
+    ap.add_argument("--media-error-rate", type=float, default=0.0, help="fraction of uploads answered with HTTP 500")
+    a = ap.parse_args()
+    state = GraphState(a.latency_ms, a.jitter, a.error_rate, a.throttle_rate, a.mps, a.media_error_rate)
+    server = serve(a.port, state)
+    print(f"fake graph on http://127.0.0.1:{a.port} (latency {a.latency_ms}ms, "
+          f"errors {a.error_rate:.1%}, 429s {a.throttle_rate:.1%}, mps {a.mps or 'unlimited'})", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,328 @@
+"""
+Load test: app.py under gunicorn against the fake Graph server.
+
+For every --configs entry (WORKERSxTHREADS, or "async" for serve_async.py)
+it starts a fresh server in a temp directory (own chat.db), replays synthetic users from webhook_gen at
+--rate new users/sec (open loop: each step is sent at its scheduled time,
+whether or not the server kept up) and reports:
+
+  webhook/s   acknowledged webhook POSTs per second
+  ack p50/95/99   scheduled send → 200 from /webhook  (ms)
+  reply p50/95/99 scheduled send → first reply reaching Graph  (ms)
+  msg rows/s, lead rows/s   chat.db writes during the run
+  db p95      enqueue→commit of buffered writes, from /metrics  (ms)
+  boot s      process start → first answered request (gunicorn.conf.py, preloaded)
+
+  python bench/run.py --users 2000 --rate 40 --configs 1x8,2x8,4x8
+  python bench/run.py --json bench/last.json --baseline bench/baseline.json
+
+With --baseline the run fails (exit 1) if throughput drops or reply p95
+grows by more than --tolerance against the saved results.
+"""
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+import subprocess
+import itertools
+import requests
+
+import webhook_gen
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_http(url: str, timeout: float = 20):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+def pct(values: list[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def hist_quantile(metrics_text: str, name: str, q: float) -> float:
+    """Quantile from a Prometheus histogram (all label sets summed), linear within the bucket."""
+    buckets: dict[float, float] = {}
+    for line in metrics_text.splitlines():
+        if not line.startswith(f"parasbot_{name}_bucket"):
+            continue
+        le = line.split('le="', 1)[1].split('"', 1)[0]
+        bound = float("inf") if le == "+Inf" else float(le)
+        buckets[bound] = buckets.get(bound, 0) + float(line.rsplit(" ", 1)[1])
+    if not buckets:
+        return float("nan")
+    bounds = sorted(buckets)
+    total = buckets[bounds[-1]]
+    if total == 0:
+        return float("nan")
+    rank, prev_bound, prev_count = q * total, 0.0, 0.0
+    for b in bounds:
+        if buckets[b] >= rank:
+            if b == float("inf"):
+                return prev_bound
+            return prev_bound + (b - prev_bound) * (rank - prev_count) / max(buckets[b] - prev_count, 1e-9)
+        prev_bound, prev_count = b, buckets[b]
+    return prev_bound
+
+def hist_mean(metrics_text: str, name: str) -> float:
+    total = {"sum": 0.0, "count": 0.0}
+    for line in metrics_text.splitlines():
+        for part in total:
+            if line.startswith(f"parasbot_{name}_{part}"):
+                total[part] += float(line.rsplit(" ", 1)[1])
+    return total["sum"] / total["count"] if total["count"] else float("nan")
+
+def schedule(users: list[dict], rate: float, think_ms: float, dup_rate: float, seed: int) -> list[tuple]:
+    """(send_at_offset, wa_id, step_index, body, is_duplicate) sorted by time."""
+    rng = random.Random(seed)
+    events = []
+    for i, u in enumerate(users):
+        t = i / rate
+        for k, body in enumerate(u["steps"]):
+            events.append((t, u["wa_id"], k, body, False))
+            if rng.random() < dup_rate:          # Meta redelivering the same message
+                events.append((t + rng.uniform(0.05, 0.5), u["wa_id"], k, body, True))
+            t += think_ms / 1000 * rng.uniform(0.5, 1.5)
+    events.sort(key=lambda e: e[0])
+    return events
+
+def drive(base_url: str, events: list[tuple], senders: int) -> tuple[list, float]:
+    """Replay events open-loop; returns [(wa_id, step, scheduled, acked, status, dup)] and start time."""
+    results, lock = [], threading.Lock()
+    counter = itertools.count()
+    local = threading.local()
+    start = time.time() + 0.5
+
+    def worker():
+        local.s = requests.Session()
+        while True:
+            i = next(counter)
+            if i >= len(events):
+                return
+            offset, wa_id, k, body, dup = events[i]
+            at = start + offset
+            delay = at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                status = local.s.post(base_url + "/webhook", json=body, timeout=30).status_code
+            except requests.RequestException:
+                status = 0
+            row = (wa_id, k, at, time.time(), status, dup)
+            with lock:
+                results.append(row)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(senders)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return results, start
+
+def wait_drained(graph_url: str, quiet_sec: float = 1.5, timeout: float = 120) -> list:
+    """Poll the fake Graph log until no new sends arrive for quiet_sec."""
+    deadline, last_n, last_change = time.monotonic() + timeout, -1, time.monotonic()
+    while time.monotonic() < deadline:
+        log = requests.get(graph_url + "/_bench/log", timeout=10).json()
+        if len(log) != last_n:
+            last_n, last_change = len(log), time.monotonic()
+        elif time.monotonic() - last_change >= quiet_sec:
+            return log
+        time.sleep(0.25)
+    return log
+
+def reply_latencies(results: list, graph_log: list) -> tuple[list[float], int]:
+    """For each (non-duplicate) step: first successful send to that wa_id after it, before the user's next step."""
+    sends: dict[str, list[float]] = {}
+    for to, ts, status in graph_log:
+        if status == 200:
+            sends.setdefault(to, []).append(ts)
+    steps: dict[str, list[tuple[int, float]]] = {}
+    for wa_id, k, at, _, status, dup in results:
+        if not dup and status == 200:
+            steps.setdefault(wa_id, []).append((k, at))
+    out, missing = [], 0
+    for wa_id, st in steps.items():
+        st.sort()
+        times = sorted(sends.get(wa_id, []))
+        for idx, (_, at) in enumerate(st):
+            until = st[idx + 1][1] if idx + 1 < len(st) else float("inf")
+            j = next((t for t in times if at <= t < until), None)
+            if j is None: missing += 1
+            else: out.append(j - at)
+    return out, missing
+
+def count_rows(db_path: str) -> dict:
+    conn = sqlite3.connect(db_path)
+    try:
+        return {"messages": conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+                "leads": conn.execute("SELECT COUNT(*) FROM leads").fetchone()[0]}
+    finally:
+        conn.close()
+
+def run_config(workers: int, threads: int, users: list[dict], a, graph_url: str) -> dict:
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    workdir = tempfile.mkdtemp(prefix=f"parasbot-bench-{workers}x{threads}-")
+    env = dict(os.environ,
+               VERIFY_TOKEN="bench", WHATSAPP_TOKEN="bench", PHONE_NUMBER_ID="bench",
+               ADMIN_USER="bench", ADMIN_PASS="bench", SECRET_KEY="bench",
+               GRAPH_BASE_URL=graph_url, CONTENT_FILE=os.path.join(REPO, "content.json"))
+    for kv in a.env:
+        k, _, v = kv.partition("=")
+        env[k] = v
+    if workers == 0:        # "async": serve_async.py, one process
+        env.update(PORT=str(port), HOST="127.0.0.1", PYTHONPATH=REPO)
+        cmd = [sys.executable, os.path.join(REPO, "serve_async.py")]
+    else:
+        cmd = [sys.executable, "-m", "gunicorn", "-c", os.path.join(REPO, "gunicorn.conf.py"),
+               "-w", str(workers), "--threads", str(threads),
+               "-b", f"127.0.0.1:{port}", "--pythonpath", REPO, "--log-level", "warning"]
+    spawned = time.monotonic()
+    proc = subprocess.Popen(cmd, cwd=workdir, env=env,
+                            stdout=subprocess.DEVNULL if not a.verbose else None,
+                            stderr=subprocess.DEVNULL if not a.verbose else None)
+    try:
+        wait_http(f"{base}/webhook?hub.mode=subscribe&hub.verify_token=bench&hub.challenge=ok")
+        boot_sec = time.monotonic() - spawned
+        requests.post(graph_url + "/_bench/reset", timeout=5)
+        before = count_rows(os.path.join(workdir, "chat.db"))
+
+        events = schedule(users, a.rate, a.think_ms, a.dup_rate, a.seed)
+        results, start = drive(base, events, a.senders)
+        log = wait_drained(graph_url)
+        metrics_text = requests.get(base + "/metrics", timeout=10).text
+    finally:
+        proc.send_signal(signal.SIGTERM)       # workers run atexit → DBWriter flushes
+        try: proc.wait(timeout=30)
+        except subprocess.TimeoutExpired: proc.kill()
+    after = count_rows(os.path.join(workdir, "chat.db"))
+
+    acked = [r for r in results if r[4] == 200]
+    end = max([r[3] for r in results] + [t for _, t, _ in log])
+    elapsed = max(end - start, 1e-9)
+    ack_ms = [(r[3] - r[2]) * 1000 for r in acked]
+    replies, missing = reply_latencies(results, log)
+    reply_ms = [x * 1000 for x in replies]
+    return {
+        "config": f"{workers}x{threads}" if workers else "async",
+        "webhooks": len(results), "errors": len(results) - len(acked),
+        "webhook_per_sec": len(acked) / elapsed,
+        "ack_p50": pct(ack_ms, 50), "ack_p95": pct(ack_ms, 95), "ack_p99": pct(ack_ms, 99),
+        "reply_p50": pct(reply_ms, 50), "reply_p95": pct(reply_ms, 95), "reply_p99": pct(reply_ms, 99),
+        "replies_missing": missing,
+        "graph_sends": sum(1 for _, _, s in log if s == 200),
+        "graph_throttled": sum(1 for _, _, s in log if s == 429),
+        "message_rows_per_sec": (after["messages"] - before["messages"]) / elapsed,
+        "lead_rows_per_sec": (after["leads"] - before["leads"]) / elapsed,
+        "leads": after["leads"] - before["leads"],
+        "db_write_p95": hist_quantile(metrics_text, "db_write_seconds", 0.95) * 1000,
+        "boot_sec": boot_sec,
+        "worker_init_ms": hist_mean(metrics_text, "worker_init_seconds") * 1000,
+        "elapsed_sec": elapsed,
+        "workdir": workdir,
+    }
+
+COLUMNS = [("config", "{:>7}"), ("webhook_per_sec", "{:>10.1f}"), ("ack_p50", "{:>8.1f}"), ("ack_p95", "{:>8.1f}"),
+           ("ack_p99", "{:>8.1f}"), ("reply_p50", "{:>9.1f}"), ("reply_p95", "{:>9.1f}"), ("reply_p99", "{:>9.1f}"),
+           ("message_rows_per_sec", "{:>10.1f}"), ("lead_rows_per_sec", "{:>10.1f}"), ("db_write_p95", "{:>8.1f}"),
+           ("boot_sec", "{:>6.2f}"), ("errors", "{:>6}"), ("replies_missing", "{:>7}")]
+HEADERS = ["config", "webhook/s", "ack p50", "ack p95", "ack p99", "reply p50", "reply p95", "reply p99",
+           "msg rows/s", "lead rows/s", "db p95", "boot s", "errors", "no-reply"]
+
+def print_table(rows: list[dict]):
+    widths = [len(fmt.format(rows[0][k])) if rows else 8 for k, fmt in COLUMNS]
+    print("  ".join(h.rjust(w) for h, w in zip(HEADERS, widths)))
+    for r in rows:
+        print("  ".join(fmt.format(r[k]) for k, fmt in COLUMNS))
+
+def compare(rows: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    with open(baseline_path, encoding="utf-8") as f:
+        base = {r["config"]: r for r in json.load(f)["results"]}
+    problems = []
+    for r in rows:
+        b = base.get(r["config"])
+        if not b:
+            continue
+        if r["webhook_per_sec"] < b["webhook_per_sec"] * (1 - tolerance):
+            problems.append(f"{r['config']}: throughput {r['webhook_per_sec']:.1f}/s vs {b['webhook_per_sec']:.1f}/s")
+        if r["reply_p95"] > b["reply_p95"] * (1 + tolerance):
+            problems.append(f"{r['config']}: reply p95 {r['reply_p95']:.0f}ms vs {b['reply_p95']:.0f}ms")
+    return problems
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark app.py under gunicorn against a fake Graph API")
+    ap.add_argument("--configs", default="1x8,2x8,4x8", help="comma list of WORKERSxTHREADS, or 'async' for serve_async.py")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--rate", type=float, default=20, help="new users per second")
+    ap.add_argument("--think-ms", type=float, default=1500, help="mean gap between one user's messages")
+    ap.add_argument("--dup-rate", type=float, default=0.02, help="fraction of webhooks delivered twice")
+    ap.add_argument("--coach-ratio", type=float, default=0.5)
+    ap.add_argument("--senders", type=int, default=64, help="client threads posting webhooks")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--latency-ms", type=float, default=100, help="fake Graph median latency")
+    ap.add_argument("--error-rate", type=float, default=0.0)
+    ap.add_argument("--throttle-rate", type=float, default=0.0)
+    ap.add_argument("--graph-mps", type=float, default=0, help="fake Graph accepted msgs/sec (0 = unlimited)")
+    ap.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra env for app.py")
+    ap.add_argument("--json", help="write results to this file")
+    ap.add_argument("--baseline", help="compare against a previous --json file")
+    ap.add_argument("--tolerance", type=float, default=0.15)
+    ap.add_argument("--verbose", action="store_true", help="show gunicorn output")
+    a = ap.parse_args()
+
+    gport = free_port()
+    graph_url = f"http://127.0.0.1:{gport}"
+    graph = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_graph.py"), "--port", str(gport),
+                              "--latency-ms", str(a.latency_ms), "--error-rate", str(a.error_rate),
+                              "--throttle-rate", str(a.throttle_rate), "--mps", str(a.graph_mps)],
+                             stdout=subprocess.DEVNULL)
+    rows = []
+    try:
+        wait_http(graph_url + "/_bench/log")
+        users = list(webhook_gen.users(a.users, a.seed, a.coach_ratio))
+        for cfg in a.configs.split(","):
+            if cfg.strip().lower() == "async":
+                w, t = 0, 0
+                print(f"running serve_async.py, {a.users} users at {a.rate}/s ...", flush=True)
+            else:
+                w, t = (int(x) for x in cfg.lower().split("x"))
+                print(f"running {w} worker(s) x {t} thread(s), {a.users} users at {a.rate}/s ...", flush=True)
+            rows.append(run_config(w, t, users, a, graph_url))
+    finally:
+        graph.terminate()
+        graph.wait()
+
+    print()
+    print_table(rows)
+    if a.json:
+        with open(a.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(a), "results": rows}, f, indent=2)
+    if a.baseline:
+        problems = compare(rows, a.baseline, a.tolerance)
+        for p in problems:
+            print("REGRESSION", p)
+        if problems:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Synthetic webhook traffic: every user walks one complete flow, built from
+the menus in content.json so the ids always match what app.py routes.
+
+  KNOW : "hi" → KNOW → one or two info rows
+  COACH: "hi" → COACH → course → attempt → [group] → mode   (ends in a lead)
+
+Each step is one webhook body exactly as Meta posts it. As a script it
+writes one JSON line per user ({"wa_id": …, "flow": …, "steps": [...]}):
+
+  python bench/webhook_gen.py --users 5000 --coach-ratio 0.6 > bench/users.jsonl
+"""
+import os
+import sys
+import json
+import random
+import argparse
+
+CONTENT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "content.json")
+PHONE_NUMBER_ID = "bench"
+
+GREETINGS = ["hi", "Hi", "hello", "Hello sir", "hey", "Hii", "good morning", "I want details"]
+
+def webhook(wa_id: str, name: str, msg: dict, ts: int) -> dict:
+    msg = {"from": wa_id, "timestamp": str(ts), **msg}
+    return {"object": "whatsapp_business_account", "entry": [{"id": "0", "changes": [{"field": "messages", "value": {
+        "messaging_product": "whatsapp",
+        "metadata": {"display_phone_number": "910000000000", "phone_number_id": PHONE_NUMBER_ID},
+        "contacts": [{"profile": {"name": name}, "wa_id": wa_id}],
+        "messages": [msg],
+    }}]}]}
+
+def text(body: str) -> dict:
+    return {"type": "text", "text": {"body": body}}
+
+def button(opt: dict) -> dict:
+    return {"type": "interactive", "interactive": {"type": "button_reply",
+            "button_reply": {"id": opt["id"], "title": opt["title"]}}}
+
+def list_row(row: dict) -> dict:
+    return {"type": "interactive", "interactive": {"type": "list_reply",
+            "list_reply": {"id": row["id"], "title": row["title"]}}}
+
+def walk(content: dict, rng: random.Random, coach_ratio: float) -> tuple[str, list[dict]]:
+    """One user's messages (without envelope): flow name + steps."""
+    main = {o["id"]: o for o in content["main_menu"]["options"]}
+    steps = [text(rng.choice(GREETINGS))]
+    if rng.random() >= coach_ratio:
+        steps.append(button(main["KNOW"]))
+        rows = content["know_menu"]["rows"]
+        for row in rng.sample(rows, k=min(len(rows), rng.choice((1, 1, 2)))):
+            steps.append(list_row(row))
+        return "KNOW", steps
+    steps.append(button(main["COACH"]))
+    course = rng.choice(content["course_menu"]["options"])
+    steps.append(button(course))
+    steps.append(button(rng.choice(content["attempt_menu"]["options"])))
+    if course.get("needs_group"):
+        steps.append(button(rng.choice(content["group_menu"]["options"])))
+    steps.append(button(rng.choice(content["mode_menu"]["options"])))
+    return "COACH", steps
+
+def users(n: int, seed: int = 1, coach_ratio: float = 0.5, content_file: str = CONTENT_FILE, first_id: int = 0):
+    """Yield n synthetic users as {"wa_id", "flow", "steps": [webhook bodies]}."""
+    with open(content_file, encoding="utf-8") as f:
+        content = json.load(f)
+    rng = random.Random(seed)
+    for i in range(first_id, first_id + n):
+        wa_id = f"91{7000000000 + i}"
+        flow, msgs = walk(content, rng, coach_ratio)
+        steps = []
+        for k, m in enumerate(msgs):
+            m["id"] = f"wamid.in.{seed}.{i}.{k}"
+            steps.append(webhook(wa_id, f"Bench User {i}", m, 1700000000 + i + k))
+        yield {"wa_id": wa_id, "flow": flow, "steps": steps}
+
+def main():
+    ap = argparse.ArgumentParser(description="Generate synthetic webhook payloads for load tests")
+    ap.add_argument("--users", type=int, default=1000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--coach-ratio", type=float, default=0.5, help="share of users who go through COACH (→ lead)")
+    ap.add_argument("--content", default=CONTENT_FILE)
+    a = ap.parse_args()
+    for u in users(a.users, a.seed, a.coach_ratio, a.content):
+        sys.stdout.write(json.dumps(u) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""
+gunicorn settings for app.py:
+
+  gunicorn -c gunicorn.conf.py                 # WEB_CONCURRENCY workers x THREADS threads on BIND
+
+The app is preloaded: the master imports app.py (config, content.json parsed
+and rendered) and runs create_app() (env check, chat.db migrations) once;
+workers are forked from it and only run init_worker(). Recycling a worker
+(MAX_REQUESTS) therefore costs a fork plus thread start-up, not an import.
+/metrics reports parasbot_startup_import_seconds, ..._create_app_seconds
+and the parasbot_worker_init_seconds histogram.
+
+Preloading means code changes need a full restart (not HUP) to take effect;
+content.json edits are still picked up live.
+"""
+import os
+
+wsgi_app = "app:create_app()"
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+threads = int(os.getenv("THREADS", "8"))       # SSE streams hold a thread each, at most SSE_MAX_STREAMS (4) of them
+worker_class = "gthread"
+preload_app = True
+max_requests = int(os.getenv("MAX_REQUESTS", "0"))
+max_requests_jitter = int(os.getenv("MAX_REQUESTS_JITTER", "0"))
+graceful_timeout = int(os.getenv("GRACEFUL_TIMEOUT", "30"))   # time to drain send lanes on shutdown
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
+    server.log.info("worker %s ready", worker.pid)
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown_worker()
@@ -0,0 +1,352 @@
+"""
+Optional asyncio entry point for app.py (needs `pip install aiohttp`).
+
+  python serve_async.py            # PORT (default 5000), one process
+
+Same routes, same chat.db, same content.json — app.py is imported as-is:
+- POST /webhook is answered on the event loop; the flow engine (SQLite state,
+  pause/dedup lookups) runs in a small thread pool so the loop never blocks.
+- Outbound sends go through AsyncOutbound instead of the lane threads: the
+  flow's send_text()/send_menu() (app.py, on those executor threads) hand
+  each outbox job to AsyncOutbound.submit(). Coroutines use this module's
+  async send_text()/send_menu()/send_buttons()/send_list_menu() (or
+  send_batch() for several replies) and await the result. One coroutine per
+  recipient keeps each user's messages in order, and up to ASYNC_SENDS Graph
+  requests are in flight at once over one aiohttp pool.
+  Every number (app.LINES) gets its own AsyncOutbound and pool.
+  Replies still go through app.py's outbox and circuit breaker; only the
+  Graph request itself is a coroutine.
+- Everything else (/admin, /metrics, login, SSE) is the Flask app behind a
+  WSGI bridge running on its own executor.
+
+Use it instead of gunicorn, not alongside it: one process, no workers.
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+import collections
+import concurrent.futures
+
+try:
+    from aiohttp import web, ClientSession, ClientTimeout, TCPConnector, ClientError
+except ImportError:
+    raise SystemExit("serve_async.py needs aiohttp: pip install aiohttp")
+
+import app as bot
+
+ASYNC_SENDS       = int(os.getenv("ASYNC_SENDS", "256"))       # Graph requests in flight at once
+ASYNC_WSGI_THREADS = int(os.getenv("ASYNC_WSGI_THREADS", "16")) # admin pages + SSE streams served concurrently
+PORT              = int(os.getenv("PORT", "5000"))
+
+# ----------------- Graph API client (aiohttp) -----------------
+class AsyncGraphClient:
+    """
+    Non-blocking twin of GraphClient. Shares its token buckets, backoff and
+    stats so limits hold no matter which client sends.
+    """
+    def __init__(self, sync: bot.GraphClient, connections: int):
+        self.sync = sync
+        self.connections = connections
+        self.session: ClientSession | None = None
+
+    async def start(self):
+        self.session = ClientSession(headers=self.sync.headers,
+                                     timeout=ClientTimeout(total=self.sync.connect_timeout + self.sync.timeout,
+                                                           sock_connect=self.sync.connect_timeout),
+                                     connector=TCPConnector(limit=self.connections, keepalive_timeout=60))
+
+    async def close(self):
+        if self.session: await self.session.close()
+
+    async def post(self, url: str, payload: dict, to: str | None = None, max_retries: int | None = None):
+        """POST JSON with rate limiting + retries. Returns (status_code, body_text)."""
+        g, attempt = self.sync, 0
+        max_retries = g.max_retries if max_retries is None else max_retries
+        while True:
+            wait = g.number_bucket.reserve()
+            if to:
+                wait = max(wait, g._pair(to).reserve())
+            if wait > 0:
+                await asyncio.sleep(wait)
+            g.count("requests")
+            try:
+                async with self.session.post(url, json=payload) as r:
+                    status, text, retry_after = r.status, await r.text(), r.headers.get("Retry-After")
+            except (ClientError, asyncio.TimeoutError) as e:
+                g.count("errors")
+                if attempt >= max_retries:
+                    return 0, str(e)
+                await asyncio.sleep(g._backoff(attempt, None))
+                attempt += 1
+                g.count("retries")
+                continue
+            if (bot.graph_throttled(status, text) or status >= 500) and attempt < max_retries:
+                if status < 500:
+                    g.count("throttled")
+                await asyncio.sleep(g._backoff(attempt, retry_after))
+                attempt += 1
+                g.count("retries")
+                continue
+            return status, text
+
+    async def send_message(self, payload: dict, max_retries: int | None = None):
+        return await self.post(self.sync.messages_url, payload, to=payload.get("to"), max_retries=max_retries)
+
+# ----------------- Outbound (coroutines instead of lane threads) -----------------
+class AsyncOutbound:
+    """
+    Drop-in for OutboundDispatcher: submit() may be called from any thread
+    (the flow engine runs in executors). Each recipient gets a queue drained
+    by one coroutine, so per-user order holds; ASYNC_SENDS caps concurrency.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, graph: AsyncGraphClient, limit: int):
+        self.loop = loop
+        self.graph = graph
+        self._sem = asyncio.Semaphore(limit)
+        self._queues: dict[str, collections.deque] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._waiters: dict[bot.SendJob, asyncio.Future] = {}
+        self.workers = limit
+        self.stats = {"enqueued": 0, "sent": 0, "failed": 0, "retry": 0, "deferred": 0,
+                      "send_ms_sum": 0.0, "send_ms_max": 0.0,
+                      "wait_ms_sum": 0.0, "wait_ms_max": 0.0}
+
+    def submit(self, job: bot.SendJob) -> bot.SendJob:
+        self.loop.call_soon_threadsafe(self._enqueue, job)
+        return job
+
+    def send(self, job: bot.SendJob) -> asyncio.Future:
+        """Queue a job from the loop; the future resolves to its (code, resp)."""
+        fut = self._waiters[job] = self.loop.create_future()
+        self._enqueue(job)
+        return fut
+
+    def _enqueue(self, job: bot.SendJob):
+        self.stats["enqueued"] += 1
+        q = self._queues.get(job.to)
+        if q is not None:
+            q.append(job)
+            return
+        self._queues[job.to] = collections.deque([job])
+        task = self.loop.create_task(self._drain(job.to))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, wa_id: str):
+        q = self._queues[wa_id]
+        while q:
+            job = q.popleft()
+            try:
+                async with self._sem:
+                    await self._deliver(job)
+            except Exception as e:
+                print("Error sending to", job.to, ":", e)
+                job.result = (0, str(e))
+                self._count(job, "failed", send_ms=0.0)
+            finally:
+                job.done.set()
+                fut = self._waiters.pop(job, None)
+                if fut and not fut.done(): fut.set_result(job.result)
+        del self._queues[wa_id]
+
+    async def _deliver(self, job: bot.SendJob):
+        # same steps as app.outbox_deliver(); the outbox bookkeeping is SQLite, so it runs off the loop
+        skip = await self.loop.run_in_executor(None, bot.outbox_ready, job)
+        if skip:
+            self._count(job, skip, send_ms=0.0)
+            return
+        t0 = time.monotonic()
+        try:
+            code, resp = await self.graph.send_message(job.payload, bot.OUTBOX_INLINE_RETRIES)
+        except BaseException:
+            bot.BREAKER.release()   # errored or cancelled before outbox_finish(): free the half-open probe
+            raise
+        send_ms = (time.monotonic() - t0) * 1000
+        bot.METRICS.observe("graph_send_seconds", send_ms / 1000, (("status", str(code)),))
+        job.result = (code, resp)
+        result = await self.loop.run_in_executor(None, bot.outbox_finish, job, code, resp)
+        self._count(job, result, send_ms=send_ms)
+
+    def _count(self, job: bot.SendJob, result: str, send_ms: float):
+        wait_ms = (time.monotonic() - job.enqueued_at) * 1000 - send_ms
+        st = self.stats
+        if result in st:
+            st[result] += 1
+        st["send_ms_sum"] += send_ms
+        st["send_ms_max"] = max(st["send_ms_max"], send_ms)
+        st["wait_ms_sum"] += wait_ms
+        st["wait_ms_max"] = max(st["wait_ms_max"], wait_ms)
+
+    def snapshot(self) -> dict:
+        st = dict(self.stats)
+        done = st["sent"] + st["failed"] + st["retry"] + st["deferred"]
+        st["queue_depth"] = sum(len(q) for q in list(self._queues.values()))
+        st["lanes"] = self.workers
+        st["send_ms_avg"] = round(st["send_ms_sum"] / done, 1) if done else 0.0
+        st["wait_ms_avg"] = round(st["wait_ms_sum"] / done, 1) if done else 0.0
+        return st
+
+    async def drain(self, timeout: float = 10.0):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def stop(self, timeout: float = 10.0):
+        pass    # drained in on_cleanup while the loop is still running
+
+# ----------------- Async send helpers -----------------
+# line: the number to send from (default PHONE_NUMBER_ID). Like app.py's
+# send_text()/send_menu(), a reply is in the outbox before it is sent;
+# send_batch() records several replies with one outbox commit (reply_batch()).
+async def send_batch(jobs: list[bot.SendJob]) -> list:
+    """Record the jobs with one outbox_record() (off the loop), send them in order, return each (code, resp)."""
+    await asyncio.get_running_loop().run_in_executor(None, bot.outbox_record, jobs)
+    return await asyncio.gather(*[job.line.outbound.send(job) for job in jobs])
+
+def text_job(to_wa_id: str, text: str, line: bot.Line | None = None) -> bot.SendJob:
+    payload = {"messaging_product": "whatsapp", "to": to_wa_id, "type": "text", "text": {"body": text}}
+    return bot.SendJob(to_wa_id, payload, "text", text, line or bot.PRIMARY)
+
+def menu_job(to_wa_id: str, menu: bot.Menu, line: bot.Line | None = None) -> bot.SendJob:
+    return bot.SendJob(to_wa_id, menu.for_recipient(to_wa_id), menu.mtype, menu.log_text, line or bot.PRIMARY)
+
+async def send_text(to_wa_id: str, text: str, line: bot.Line | None = None):
+    return (await send_batch([text_job(to_wa_id, text, line)]))[0]
+
+async def send_menu(to_wa_id: str, menu: bot.Menu, line: bot.Line | None = None):
+    return (await send_batch([menu_job(to_wa_id, menu, line)]))[0]
+
+async def send_buttons(to_wa_id: str, body_text: str, buttons: list[tuple[str, str]], line: bot.Line | None = None):
+    return await send_menu(to_wa_id, bot.buttons_menu(body_text, buttons), line)
+
+async def send_list_menu(to_wa_id: str, header_text: str, body_text: str, rows: list[tuple[str, str]],
+                         line: bot.Line | None = None):
+    return await send_menu(to_wa_id, bot.list_menu(header_text, body_text, rows), line)
+
+# ----------------- Routes -----------------
+async def webhook_post(request: web.Request) -> web.Response:
+    t_start = time.perf_counter()
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    try:
+        # flow engine touches SQLite (state, pauses, dedup): keep it off the loop
+        if await asyncio.get_running_loop().run_in_executor(request.app["flow_pool"], bot.process_webhook, data or {}):
+            return web.Response(text="RETRY", status=500)   # Meta redelivers; handled messages are deduped
+        return web.Response(text="EVENT_RECEIVED")
+    except Exception as e:
+        print("Error handling webhook:", e)
+        return web.Response(text="OK")
+    finally:
+        bot.METRICS.observe("webhook_seconds", time.perf_counter() - t_start)
+
+async def wsgi_bridge(request: web.Request) -> web.StreamResponse:
+    """Run the Flask app for any other path; body chunks are pulled in the executor so SSE streams work."""
+    loop = asyncio.get_running_loop()
+    pool = request.app["wsgi_pool"]
+    body = await request.read()
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": request.path,
+        "QUERY_STRING": request.query_string,
+        "SERVER_NAME": request.host.split(":")[0],
+        "SERVER_PORT": str(request.url.port or PORT),
+        "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+        "REMOTE_ADDR": request.remote or "",
+        "CONTENT_TYPE": request.headers.get("Content-Type", ""),
+        "CONTENT_LENGTH": str(len(body)),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for k, v in request.headers.items():
+        key = "HTTP_" + k.upper().replace("-", "_")
+        if key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+            environ[key] = f"{environ[key]},{v}" if key in environ else v
+
+    # Call the app and iterate its body on one executor thread: Flask's request
+    # context (stream_with_context for SSE) lives in that thread's contextvars.
+    chunks: asyncio.Queue = asyncio.Queue(maxsize=64)
+    started, done, stop = {}, object(), []
+
+    def start_response(status, headers, exc_info=None):
+        started["status"], started["headers"] = status, headers
+
+    def pump():
+        result = bot.app.wsgi_app(environ, start_response)
+        try:
+            for chunk in result:
+                if stop: break
+                asyncio.run_coroutine_threadsafe(chunks.put(chunk), loop).result()
+        finally:
+            if hasattr(result, "close"): result.close()
+            asyncio.run_coroutine_threadsafe(chunks.put(done), loop).result()
+
+    job = loop.run_in_executor(pool, pump)
+    try:
+        chunk = await chunks.get()
+        status = started["status"]
+        resp = web.StreamResponse(status=int(status.split(" ", 1)[0]), reason=status.split(" ", 1)[1])
+        for k, v in started["headers"]:
+            if k.lower() not in ("content-length", "transfer-encoding", "connection"):
+                resp.headers.add(k, v)
+        await resp.prepare(request)
+        try:
+            while chunk is not done:
+                if chunk:
+                    await resp.write(chunk)
+                chunk = await chunks.get()
+            await resp.write_eof()
+        except ConnectionResetError:
+            pass                    # browser closed the page / EventSource
+        return resp
+    finally:
+        stop.append(True)           # client gone: pump stops at its next chunk
+        while not job.done():
+            try: chunks.get_nowait()
+            except asyncio.QueueEmpty: await asyncio.sleep(0.05)
+
+async def on_startup(aio: web.Application):
+    loop = asyncio.get_running_loop()
+    aio["graphs"] = []
+    for line in bot.LINES.values():
+        # one pool per number, on top of that number's own token bucket (line.graph)
+        graph = AsyncGraphClient(line.graph, ASYNC_SENDS)
+        await graph.start()
+        aio["graphs"].append(graph)
+        # send_text()/send_menu() in app.py look line.outbound up at call time
+        line.outbound = AsyncOutbound(loop, graph, ASYNC_SENDS)
+    bot.OUTBOUND = bot.PRIMARY.outbound
+    aio["flow_pool"] = concurrent.futures.ThreadPoolExecutor(bot.INBOUND_WORKERS, thread_name_prefix="flow")
+    aio["wsgi_pool"] = concurrent.futures.ThreadPoolExecutor(ASYNC_WSGI_THREADS, thread_name_prefix="wsgi")
+    bot.init_worker()       # writer, pollers etc.; /webhook doesn't pass through Flask's before_request here
+
+async def on_cleanup(aio: web.Application):
+    bot.OUTBOX.stop()
+    bot.BROADCASTS.stop()
+    for line in bot.LINES.values():
+        await line.outbound.drain()
+    for graph in aio["graphs"]:
+        await graph.close()
+    aio["flow_pool"].shutdown(wait=True)
+    aio["wsgi_pool"].shutdown(wait=False, cancel_futures=True)
+    bot.WRITER.flush()
+
+def make_app() -> web.Application:
+    bot.create_app()
+    aio = web.Application(client_max_size=4 * 1024 * 1024)
+    aio.router.add_post("/webhook", webhook_post)
+    aio.router.add_route("*", "/{tail:.*}", wsgi_bridge)
+    aio.on_startup.append(on_startup)
+    aio.on_cleanup.append(on_cleanup)
+    return aio
+
+if __name__ == "__main__":
+    web.run_app(make_app(), host=os.getenv("HOST", "0.0.0.0"), port=PORT)
@@ -0,0 +1,52 @@
+"""
+app.py reads its settings and content.json at import and keeps chat.db and
+overrides.json in the working directory, so the tests import it from a
+scratch directory with a throwaway environment. Graph is bench/fake_graph.py,
+served from a thread on a free port.
+"""
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="parasbot-tests-")
+os.makedirs(os.path.join(WORKDIR, "media"))
+os.chdir(WORKDIR)
+os.environ.update({
+    "VERIFY_TOKEN": "verify", "WHATSAPP_TOKEN": "token", "PHONE_NUMBER_ID": "test",
+    "ADMIN_USER": "admin", "ADMIN_PASS": "pass", "SECRET_KEY": "secret",
+    "CONTENT_FILE": os.path.join(ROOT, "content.json"), "MEDIA_DIR": os.path.join(WORKDIR, "media"),
+    "METRICS_DIR": os.path.join(WORKDIR, "metrics"), "NUMBERS_FILE": os.path.join(WORKDIR, "numbers.json"),
+})
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+
+import app as bot        # noqa: E402
+import fake_graph        # noqa: E402
+
+@pytest.fixture(scope="session", autouse=True)
+def migrated():
+    bot.create_app()
+    return WORKDIR
+
+@pytest.fixture
+def graph_server():
+    """A fresh fake Graph: its GraphState, with .base_url. Tune rates on the state before sending."""
+    state = fake_graph.GraphState(latency_ms=0, jitter=0, error_rate=0, throttle_rate=0, mps=0)
+    server = fake_graph.serve(0, state)
+    state.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, name="fake-graph", daemon=True).start()
+    yield state
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def graph_client(graph_server):
+    """GraphClient(number, **overrides) pointed at graph_server; unthrottled unless told otherwise."""
+    def make(number: str = "test", **kw):
+        kw = {"mps": 1000, "pair_rate": 1000, "pair_burst": 1000, "timeout": 5, "max_retries": 4, **kw}
+        return bot.GraphClient(f"{graph_server.base_url}/v22.0/{number}/messages", "token", kw.pop("mps"),
+                               kw.pop("pair_rate"), kw.pop("pair_burst"), **kw)
+    return make
@@ -0,0 +1,25 @@
+"""archive_before keeps every message column and cuts raw events at the same local month boundary."""
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import app as bot
+
+def test_archive_keeps_delivery_state_and_local_cutoff():
+    db = bot.local_db()
+    db.execute("INSERT INTO messages (phone_number_id, wa_id, direction, mtype, text, ts, wamid, delivery) "
+               "VALUES ('test', '919000000002', 'out', 'text', 'old', '2001-01-31T23:30:00', 'wamid.arc-1', 'read')")
+    # just before and just after local midnight on the cutoff day
+    boundary = int(time.mktime(datetime(2001, 2, 1).timetuple()))
+    for wamid, ts in (("wamid.arc-before", boundary - 1), ("wamid.arc-after", boundary + 1)):
+        db.execute("INSERT INTO statuses (wamid, status, ts) VALUES (?, 'read', ?)", (wamid, ts))
+
+    moved = dict(bot.archive_before("2001-02"))
+    assert moved["2001-01"] >= 1
+
+    arc = sqlite3.connect(os.path.join(bot.ARCHIVE_DIR, "chat-2001-01.db"))
+    assert arc.execute("SELECT wamid, delivery, phone_number_id FROM messages WHERE text = 'old'").fetchall() == \
+        [("wamid.arc-1", "read", "test")]
+    left = {r[0] for r in db.execute("SELECT wamid FROM statuses WHERE wamid LIKE 'wamid.arc-%'")}
+    assert left == {"wamid.arc-after"}
@@ -0,0 +1,30 @@
+"""serve_async.py's send helpers: outbox first, then the aiohttp client, per-user order kept."""
+import asyncio
+
+import pytest
+
+import app as bot
+
+serve_async = pytest.importorskip("serve_async")
+
+def test_async_helpers_send_through_the_outbox(graph_server, graph_client, monkeypatch):
+    async def run():
+        graph = serve_async.AsyncGraphClient(graph_client(), 8)
+        await graph.start()
+        monkeypatch.setattr(bot.PRIMARY, "outbound", serve_async.AsyncOutbound(asyncio.get_running_loop(), graph, 8))
+        try:
+            first = await serve_async.send_text("919000000003", "hello")
+            menu = await serve_async.send_buttons("919000000003", "Pick one", [("A", "Alpha"), ("B", "Beta")])
+            batch = await serve_async.send_batch([serve_async.text_job("919000000003", f"n{i}") for i in range(3)])
+        finally:
+            await graph.close()
+        return first, menu, batch
+
+    first, menu, batch = asyncio.run(run())
+    assert [code for code, _ in (first, menu, *batch)] == [200] * 5
+    with graph_server.lock:
+        assert [(to, status) for to, _, status in graph_server.log] == [("919000000003", 200)] * 5
+    bot.WRITER.flush()
+    rows = bot.local_db().execute(
+        "SELECT mtype, text, delivery FROM messages WHERE wa_id = '919000000003' AND direction = 'out' ORDER BY id")
+    assert [(m, d) for m, _, d in rows] == [("text", "sent"), ("button", "sent")] + [("text", "sent")] * 3
@@ -0,0 +1,55 @@
+"""validate_catalogue reports malformed content.json instead of raising; reload keeps the last good one."""
+import copy
+import json
+import os
+
+import pytest
+
+import app as bot
+from conftest import ROOT
+
+with open(os.path.join(ROOT, "content.json"), encoding="utf-8") as f:
+    GOOD = json.load(f)
+
+def broken(path: list, value):
+    data = copy.deepcopy(GOOD)
+    target = data
+    for key in path[:-1]:
+        target = target[key]
+    target[path[-1]] = value
+    return data
+
+def media_dirs():
+    return (os.environ["MEDIA_DIR"],)
+
+def test_shipped_content_is_valid():
+    assert bot.validate_catalogue(GOOD, media_dirs()) == []
+
+@pytest.mark.parametrize("data", [
+    [],
+    broken(["messages"], ["thanks"]),
+    broken(["greetings"], "hi"),
+    broken(["main_menu"], "menu"),
+    broken(["course_menu", "options"], {"id": "X"}),
+    broken(["course_menu", "options", 0], "CA"),
+    broken(["know_menu", "rows", 0, "heading"], 7),
+    broken(["mode_menu", "options", 0, "features"], [1, 2]),
+    broken(["course_menu", "options", 0, "attempt_info"], "May"),
+    broken(["course_menu", "options", 0, "documents"], [{"file": 3}]),
+    broken(["attempt_menu", "options", 0, "id"], ["a"]),
+])
+def test_malformed_structure_is_reported(data):
+    errors = bot.validate_catalogue(data, media_dirs())
+    assert errors
+    with pytest.raises(ValueError):
+        bot.Catalogue(data, media_dirs())
+
+def test_bad_reload_keeps_previous(tmp_path):
+    path = tmp_path / "content.json"
+    path.write_text(json.dumps(GOOD), encoding="utf-8")
+    store = bot.CatalogueStore(str(path), 3600, os.environ["MEDIA_DIR"])
+    before = store.current
+    path.write_text(json.dumps(broken(["course_menu", "options"], {"id": "X"})), encoding="utf-8")
+    os.utime(path, ns=(0, 1))
+    assert store.reload() is False
+    assert store.current is before
@@ -0,0 +1,21 @@
+"""Webhook redelivery: handled messages are deduped, failed ones are handled again."""
+import app as bot
+
+def delivery(msg_id: str) -> dict:
+    msg = {"from": "919000000001", "id": msg_id, "type": "text", "text": {"body": "hi"}}
+    return {"entry": [{"changes": [{"value": {"metadata": {"phone_number_id": "test"}, "messages": [msg]}}]}]}
+
+def test_redelivery_after_failure_is_handled(monkeypatch):
+    handled = []
+
+    def failing(wa_id, msg, profile_name):
+        raise RuntimeError("boom")
+
+    client = bot.app.test_client()
+    monkeypatch.setattr(bot, "handle_message", failing)
+    assert client.post("/webhook", json=delivery("wamid.fail-1")).status_code == 500
+
+    monkeypatch.setattr(bot, "handle_message", lambda wa_id, msg, profile_name: handled.append(msg["id"]))
+    assert client.post("/webhook", json=delivery("wamid.fail-1")).status_code == 200
+    assert client.post("/webhook", json=delivery("wamid.fail-1")).status_code == 200
+    assert handled == ["wamid.fail-1"]
@@ -0,0 +1,102 @@
+"""GraphClient rate limits, 429 handling and retry caps, against bench/fake_graph.py."""
+import threading
+import time
+
+import app as bot
+
+def text(to: str, i: int = 0) -> dict:
+    return {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": f"m{i}"}}
+
+def statuses(state) -> list[int]:
+    with state.lock:
+        return [status for _, _, status in state.log]
+
+class RecordingClient(bot.GraphClient):
+    """Keeps every backoff it chose."""
+    def __init__(self, *a, **kw):
+        super().__init__(*a, **kw)
+        self.delays = []
+
+    def _backoff(self, attempt, retry_after):
+        delay = super()._backoff(attempt, retry_after)
+        self.delays.append(delay)
+        return delay
+
+def test_number_bucket_paces_after_burst(graph_client):
+    g = graph_client(mps=20)
+    t0 = time.monotonic()
+    for i in range(30):
+        assert g.send_message(text(f"91000{i:05d}", i))[0] == 200
+    # 20 go out on the burst, the other 10 at 20/s
+    assert 0.45 <= time.monotonic() - t0 < 2
+
+def test_each_number_has_its_own_bucket(graph_client):
+    a, b = graph_client("a", mps=5), graph_client("b", mps=5)
+    took = {}
+
+    def busy():
+        t0 = time.monotonic()
+        for i in range(15):
+            a.send_message(text(f"91100{i:05d}", i))
+        took["a"] = time.monotonic() - t0
+
+    t = threading.Thread(target=busy)
+    t.start()
+    time.sleep(0.1)
+    t0 = time.monotonic()
+    for i in range(5):
+        b.send_message(text(f"91200{i:05d}", i))
+    took["b"] = time.monotonic() - t0
+    t.join()
+    assert took["a"] >= 1.8                            # 5 on the burst, 10 more at 5/s
+    assert took["b"] < 0.5                             # b is not held back by a
+
+def test_pair_bucket_paces_one_recipient_only(graph_client):
+    g = graph_client(pair_rate=5, pair_burst=1)
+    t0 = time.monotonic()
+    for i in range(4):
+        g.send_message(text("9130000000", i))
+    assert time.monotonic() - t0 >= 0.55               # 1 on the burst, 3 more at 5/s
+    t0 = time.monotonic()
+    for i in range(4):
+        g.send_message(text(f"91400{i:05d}", i))
+    assert time.monotonic() - t0 < 0.45
+
+def test_429_waits_retry_after_then_retries(graph_server):
+    graph_server.mps = 1                               # the stand-in accepts 1 msg/s, then answers 429
+    graph_server.reset()
+    g = RecordingClient(f"{graph_server.base_url}/v22.0/test/messages", "token", 1000, 1000, 1000, timeout=5)
+    assert g.send_message(text("9150000001"))[0] == 200
+    t0 = time.monotonic()
+    code, _ = g.send_message(text("9150000002"))
+    assert code == 200
+    assert time.monotonic() - t0 >= 0.95
+    assert statuses(graph_server) == [200, 429, 200]
+    assert g.delays and g.delays[0] >= 1.0             # Retry-After: 1 is a floor for the backoff
+    assert g.stats["throttled"] == 1 and g.stats["retries"] == 1
+
+def test_backoff_is_jittered_and_capped():
+    g = bot.GraphClient("http://127.0.0.1:9/v22.0/test/messages", "token", 10, 10, 10,
+                        backoff_base=0.5, backoff_cap=3.0)
+    for attempt in range(6):
+        delays = {g._backoff(attempt, None) for _ in range(50)}
+        assert len(delays) > 1
+        assert all(0 <= d <= min(3.0, 0.5 * 2 ** attempt) for d in delays)
+    assert g._backoff(0, "2") >= 2.0
+    assert g._backoff(0, "soon") <= 0.5                # unparseable Retry-After is ignored
+
+def test_5xx_attempts_are_capped(graph_server, graph_client):
+    graph_server.error_rate = 1.0
+    g = graph_client(max_retries=3, backoff_base=0.01)
+    code, _ = g.send_message(text("9160000000"))
+    assert code == 500
+    assert statuses(graph_server) == [500] * 4          # first try + max_retries
+    assert g.stats["retries"] == 3
+
+def test_429_attempts_are_capped(graph_server, graph_client):
+    graph_server.throttle_rate = 1.0
+    g = graph_client(max_retries=1)
+    code, _ = g.send_message(text("9170000000"), max_retries=1)
+    assert code == 429
+    assert statuses(graph_server) == [429, 429]
+    assert g.stats["throttled"] == 1                   # the last 429 is returned, not retried
@@ -0,0 +1,90 @@
+"""MediaCache uploads against bench/fake_graph.py: once per content, again on change or expiry, and the fallback."""
+import json
+import os
+import time
+import uuid
+
+import pytest
+
+import app as bot
+from conftest import ROOT
+
+def uploads(state) -> list[str]:
+    with state.lock:
+        return [sha for *_, sha in state.media.values()]
+
+@pytest.fixture
+def cache(graph_server, graph_client, tmp_path):
+    """cache(ttl=...) -> a MediaCache for a number of its own, files under tmp_path."""
+    number = f"media-{uuid.uuid4().hex[:8]}"
+
+    def make(ttl: float = 3600):
+        return bot.MediaCache(str(tmp_path), ttl, str(tmp_path / "media.lock"), graph_client(number, max_retries=1), number)
+    return make
+
+def write(tmp_path, name: str, data: bytes, mtime: int | None = None):
+    path = tmp_path / name
+    path.write_bytes(data)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+def test_uploaded_once(cache, graph_server, tmp_path):
+    write(tmp_path, "a.pdf", b"%PDF-1.4 brochure")
+    first = cache()
+    mid = first.media_id("a.pdf")
+    assert first.media_id("a.pdf") == mid
+    assert cache().media_id("a.pdf") == mid         # another worker finds it in media_cache
+    assert len(uploads(graph_server)) == 1
+    assert first.stats["upload"] == 1 and first.stats["hit"] == 1
+
+def test_reuploaded_when_the_file_changes(cache, graph_server, tmp_path):
+    c = cache()
+    write(tmp_path, "b.pdf", b"%PDF-1.4 v1", mtime=1_700_000_000)
+    old = c.media_id("b.pdf")
+    write(tmp_path, "b.pdf", b"%PDF-1.4 v2", mtime=1_700_000_100)
+    new = c.media_id("b.pdf")
+    assert new != old
+    assert len(set(uploads(graph_server))) == 2
+
+def test_reuploaded_when_the_media_id_expires(cache, graph_server, tmp_path):
+    c = cache(ttl=0.3)
+    write(tmp_path, "c.pdf", b"%PDF-1.4 expiring")
+    old = c.media_id("c.pdf")
+    time.sleep(0.4)
+    assert c.media_id("c.pdf") != old
+    assert len(uploads(graph_server)) == 2
+
+def test_failed_upload_raises_media_error(cache, graph_server, tmp_path):
+    graph_server.media_error_rate = 1
+    c = cache()
+    write(tmp_path, "d.pdf", b"%PDF-1.4 unlucky")
+    with pytest.raises(bot.MediaError):
+        c.media_id("d.pdf")
+    assert c.stats["error"] == 1 and not uploads(graph_server)
+    graph_server.media_error_rate = 0
+    assert c.media_id("d.pdf")                  # nothing bad was cached: the next try uploads
+
+def test_lead_gets_text_and_thanks_when_the_upload_fails(cache, graph_server, monkeypatch):
+    with open(os.path.join(ROOT, "content.json"), encoding="utf-8") as f:
+        data = json.load(f)
+    media_dir = os.environ["MEDIA_DIR"]
+    with open(os.path.join(media_dir, "brochure.pdf"), "wb") as f:
+        f.write(b"%PDF-1.4 brochure")
+    course = data["course_menu"]["options"][0]
+    course["documents"] = [{"file": "brochure.pdf", "caption": "Brochure"}]
+    cat = bot.Catalogue(data, (media_dir,))
+
+    graph_server.media_error_rate = 1
+    failing = cache()
+    failing.base_dir = media_dir
+    sent = []
+    monkeypatch.setattr(bot.PRIMARY, "media", failing)
+    monkeypatch.setattr(bot, "queue_send", lambda to, payload, mtype, log_text: sent.append(mtype))
+    monkeypatch.setattr(bot, "save_lead", lambda row: None)
+
+    wa_id = "919000000020"
+    bot.set_state(wa_id, stage="MODE", course=course["value"])
+    mode = data["mode_menu"]["options"][0]["value"]
+    bot.on_mode(cat, wa_id, mode, None)
+    assert sent == ["text", "text"]             # features and thanks still go out, without the document
+    assert failing.stats["error"] == 1
@@ -0,0 +1,47 @@
+"""Outbox delivery edge cases: the breaker's half-open probe, and leases."""
+import pytest
+
+import app as bot
+
+def job(to: str, text: str = "hi") -> bot.SendJob:
+    payload = {"messaging_product": "whatsapp", "to": to, "type": "text", "text": {"body": text}}
+    j = bot.SendJob(to, payload, "text", text, bot.PRIMARY)
+    bot.outbox_record([j])
+    return j
+
+@pytest.fixture(autouse=True)
+def no_leftovers():
+    yield
+    bot.local_db().execute("DELETE FROM outbox WHERE wa_id LIKE '9190000000%'")    # nothing for the poller to resend
+
+@pytest.fixture
+def half_open(monkeypatch):
+    breaker = bot.CircuitBreaker(1, 0)
+    breaker.record(False)
+    monkeypatch.setattr(bot, "BREAKER", breaker)
+    return breaker
+
+def test_probe_released_when_send_raises(half_open, monkeypatch):
+    def boom(*a, **kw):
+        raise RuntimeError("not a RequestException")
+    monkeypatch.setattr(bot, "wa_send", boom)
+    with pytest.raises(RuntimeError):
+        bot.outbox_deliver(job("919000000010"))
+    assert half_open.allow()        # the next send may probe
+
+def test_probe_not_taken_by_a_lost_job(half_open, monkeypatch):
+    j = job("919000000011")
+    j.claimed_at -= bot.OUTBOX_LEASE_SEC          # sat in a lane past half its lease ...
+    bot.local_db().execute("UPDATE outbox SET lease_owner = 'elsewhere:1' WHERE id = ?", (j.outbox_id,))
+    assert bot.outbox_ready(j) == "lost"          # ... and another worker took it over
+    assert half_open.state() == "half-open" and half_open.allow()
+
+def test_reclaimed_row_is_sent_once(monkeypatch):
+    old = job("919000000012")
+    # the lane is backed up past the lease: the poller claims the row again in this same process
+    bot.local_db().execute("UPDATE outbox SET due_at = 0 WHERE id = ?", (old.outbox_id,))
+    old.claimed_at -= bot.OUTBOX_LEASE_SEC
+    new = [j for j in bot.outbox_claim() if j.outbox_id == old.outbox_id]
+    assert len(new) == 1 and new[0].lease != old.lease
+    assert bot.outbox_ready(old) == "lost"
+    assert bot.outbox_ready(new[0]) is None
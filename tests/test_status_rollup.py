@@ -0,0 +1,38 @@
+"""A status callback that arrives before the wamid is stored still ends up under the message's mtype."""
+import time
+
+import app as bot
+
+def rollup(mtype: str) -> tuple:
+    return bot.local_db().execute(
+        "SELECT coalesce(sum(sent), 0), coalesce(sum(delivered), 0) FROM status_rollup "
+        "WHERE phone_number_id = 'test' AND mtype = ?", (mtype,)).fetchone()
+
+def status(wamid: str, kind: str):
+    bot.local_db().execute("INSERT INTO statuses (wamid, status, ts, phone_number_id) VALUES (?, ?, ?, 'test')",
+                           (wamid, kind, int(time.time())))
+
+def test_early_status_is_reattributed_when_the_wamid_lands():
+    db = bot.local_db()
+    before_unknown, before_menu = rollup("unknown"), rollup("list")
+    mid = db.execute("INSERT INTO messages (phone_number_id, wa_id, direction, mtype, text, ts, delivery) "
+                     "VALUES ('test', '919000000004', 'out', 'list', 'menu', '2026-01-01T10:00:00', 'queued')").lastrowid
+    status("wamid.early-1", "sent")
+    assert rollup("unknown")[0] == before_unknown[0] + 1
+
+    db.execute("UPDATE messages SET delivery = 'sent', wamid = 'wamid.early-1' WHERE id = ?", (mid,))
+    assert rollup("unknown") == before_unknown
+    assert rollup("list") == (before_menu[0] + 1, before_menu[1])
+
+    # later callbacks find the wamid straight away
+    status("wamid.early-1", "delivered")
+    assert rollup("list") == (before_menu[0] + 1, before_menu[1] + 1)
+
+def test_broadcast_log_row_reattributes_too():
+    before_unknown, before_text = rollup("unknown"), rollup("text")
+    status("wamid.early-2", "sent")
+    bot.local_db().execute("INSERT INTO messages (phone_number_id, wa_id, direction, mtype, text, ts, wamid, delivery) "
+                           "VALUES ('test', '919000000005', 'out', 'text', 'hi', '2026-01-01T10:00:00', "
+                           "'wamid.early-2', 'sent')")
+    assert rollup("unknown") == before_unknown
+    assert rollup("text")[0] == before_text[0] + 1